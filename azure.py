@@ -99,7 +99,7 @@ options:
     aliases: []
   wait_timeout_redirects:
     description:
-      - how long before wait gives up for redirects, in seconds
+      - how long to keep retrying a call that is redirected, throttled, blocked by another operation in progress or fails with a network error, in seconds
     default: 300
     aliases: []
   state:
@@ -109,6 +109,8 @@ options:
     default: 'present'
     aliases: []
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: John Whitbeck
 '''
@@ -197,27 +199,9 @@ except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-from distutils.version import LooseVersion
-from types import MethodType
 import json
 
 
-def _wait_for_completion(azure, promise, wait_timeout, msg):
-    if not promise: return
-    wait_timeout = time.time() + wait_timeout
-    while wait_timeout > time.time():
-        operation_result = azure.get_operation_status(promise.request_id)
-        time.sleep(5)
-        if operation_result.status == "Succeeded":
-            return
-        elif operation_result.status == "InProgress":
-            continue
-        else:
-            raise WindowsAzureError('Failed to wait for async operation ' + msg + ': [' + operation_result.error.code + '] ' + operation_result.error.message)
-
-    raise WindowsAzureError('Timed out waiting for async operation ' + msg + ' "' + str(promise.request_id) + '" to complete.')
-
-
 def get_ssh_certificate_tokens(module, ssh_cert_path):
     """
     Returns the sha1 fingerprint and a base64-encoded PKCS12 version of the certificate.
@@ -261,11 +245,21 @@ def create_virtual_machine(module, azure):
     reserved_ip_name = module.params.get('reserved_ip_name')
     wait = module.boolean(module.params.get('wait'))
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'create_virtual_machine_deployment', name)
+
+    # Attach to a deployment an earlier, interrupted run left in flight
+    try:
+        if resume_journaled_operation(azure, journal_key, True, wait_timeout, "create_virtual_machine_deployment"):
+            deployment = azure.get_deployment_by_name(service_name=name, deployment_name=name)
+            return (True, urlparse(deployment.url).hostname, deployment)
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to wait for the pending virtual machine deployment: %s" % str(e))
 
     # Check if a cloud service with the same name already exists
-    cloud_service_name_available = azure.check_hosted_service_name_availability(name)
+    known, service = snapshot_lookup(module, azure, 'hosted_services', name)
+    service_exists = service is not None if known else not azure.check_hosted_service_name_availability(name).result
     deployment = None
-    if not cloud_service_name_available.result:
+    if service_exists:
         # Check if a deployment with the same name already exists
         try:
             deployment = azure.get_deployment_by_name(service_name=name, deployment_name=name)
@@ -279,7 +273,8 @@ def create_virtual_machine(module, azure):
         # Create cloud service if necessary
         try:
             result = azure.create_hosted_service(service_name=name, label=name, location=location, affinity_group=affinity_group)
-            _wait_for_completion(azure, result, wait_timeout, "create_hosted_service")
+            invalidate_snapshot(module, 'hosted_services', name)
+            wait_for_completion(azure, result, wait_timeout, "create_hosted_service")
         except WindowsAzureError as e:
             module.fail_json(msg="failed to create the new service name: %s" % str(e))
 
@@ -295,7 +290,7 @@ def create_virtual_machine(module, azure):
             # Add certificate to cloud service
             try:
                 result = azure.add_service_certificate(name, pkcs12_base64, 'pfx', '')
-                _wait_for_completion(azure, result, wait_timeout, "add_service_certificate")
+                wait_for_completion(azure, result, wait_timeout, "add_service_certificate")
             except WindowsAzureError as e:
                 module.fail_json(msg="failed to add service certificate: %s" % str(e))
 
@@ -339,7 +334,8 @@ def create_virtual_machine(module, azure):
                                                              role_type='PersistentVMRole',
                                                              virtual_network_name=virtual_network_name,
                                                              reserved_ip_name=reserved_ip_name)
-            _wait_for_completion(azure, result, wait_timeout, "create_virtual_machine_deployment")
+            journal_operation(journal_key, result)
+            wait_for_completion(azure, result, wait_timeout, "create_virtual_machine_deployment", journal_key=journal_key)
             deployment = azure.get_deployment_by_name(service_name=name, deployment_name=name)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to create the new virtual machine, error was: %s" % str(e))
@@ -369,18 +365,23 @@ def terminate_virtual_machine(module, azure):
     wait_timeout = int(module.params.get('wait_timeout'))
     name = module.params.get('name')
     delete_empty_services = module.params.get('delete_empty_services')
+    journal_key = operation_journal_key(module, 'delete_deployment', name)
 
     changed = False
 
     deployment = None
     public_dns_name = None
     disk_names = []
-    try:
-        deployment = azure.get_deployment_by_name(service_name=name, deployment_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such deployment or service
-    except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the deployment, error was: %s" % str(e))
+
+    # There can be no deployment if the cloud service is not in the snapshot
+    known, service = snapshot_lookup(module, azure, 'hosted_services', name)
+    if not known or service is not None:
+        try:
+            deployment = azure.get_deployment_by_name(service_name=name, deployment_name=name)
+        except WindowsAzureMissingResourceError as e:
+            pass  # no such deployment or service
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to find the deployment, error was: %s" % str(e))
 
     # Delete deployment
     if deployment:
@@ -393,15 +394,19 @@ def terminate_virtual_machine(module, azure):
                 if role_props.os_virtual_hard_disk.disk_name not in disk_names:
                     disk_names.append(role_props.os_virtual_hard_disk.disk_name)
 
-            result = azure.delete_deployment(name, deployment.name)
-            _wait_for_completion(azure, result, wait_timeout, "delete_deployment")
+            # Attach to a delete an earlier run left in flight rather than deleting twice
+            if not resume_journaled_operation(azure, journal_key, True, wait_timeout, "delete_deployment"):
+                result = azure.delete_deployment(name, deployment.name)
+                journal_operation(journal_key, result)
+                wait_for_completion(azure, result, wait_timeout, "delete_deployment", journal_key=journal_key)
 
             for disk_name in disk_names:
                 azure.delete_disk(disk_name, True)
 
             # Now that the vm is deleted, remove the cloud service
             result = azure.delete_hosted_service(service_name=name)
-            _wait_for_completion(azure, result, wait_timeout, "delete_hosted_service")
+            invalidate_snapshot(module, 'hosted_services', name)
+            wait_for_completion(azure, result, wait_timeout, "delete_hosted_service")
         except WindowsAzureError as e:
             module.fail_json(msg="failed to delete the service %s, error was: %s" % (name, str(e)))
         public_dns_name = urlparse(deployment.url).hostname
@@ -454,11 +459,8 @@ def main():
     subscription_id, management_cert_path = get_azure_creds(module)
 
     wait_timeout_redirects = int(module.params.get('wait_timeout_redirects'))
-    if LooseVersion(windows_azure.__version__) <= "0.8.0":
-        # wrapper for handling redirects which the sdk <= 0.8.0 is not following
-        azure = Wrapper(ServiceManagementService(subscription_id, management_cert_path), wait_timeout_redirects)
-    else:
-        azure = ServiceManagementService(subscription_id, management_cert_path)
+    # retry redirects, throttling, conflicting operations and network errors
+    azure = connect_service_management(subscription_id, management_cert_path, wait_timeout_redirects)
 
     cloud_service_raw = None
     if module.params.get('state') == 'absent':
@@ -483,38 +485,8 @@ def main():
     module.exit_json(changed=changed, public_dns_name=public_dns_name, deployment=json.loads(json.dumps(deployment, default=lambda o: o.__dict__)))
 
 
-class Wrapper(object):
-    def __init__(self, obj, wait_timeout):
-        self.other = obj
-        self.wait_timeout = wait_timeout
-
-    def __getattr__(self, name):
-        if hasattr(self.other, name):
-            func = getattr(self.other, name)
-            return lambda *args, **kwargs: self._wrap(func, args, kwargs)
-        raise AttributeError(name)
-
-    def _wrap(self, func, args, kwargs):
-        if type(func) == MethodType:
-            result = self._handle_temporary_redirects(lambda: func(*args, **kwargs))
-        else:
-            result = self._handle_temporary_redirects(lambda: func(self.other, *args, **kwargs))
-        return result
-
-    def _handle_temporary_redirects(self, f):
-        wait_timeout = time.time() + self.wait_timeout
-        while wait_timeout > time.time():
-            try:
-                return f()
-            except WindowsAzureError as e:
-                if not str(e).lower().find("temporary redirect") == -1:
-                    time.sleep(5)
-                    pass
-                else:
-                    raise e
-
-
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
 
 main()
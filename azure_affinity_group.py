@@ -52,7 +52,7 @@ options:
     aliases: []
   wait_timeout_redirects:
     description:
-      - how long before wait gives up for redirects, in seconds
+      - how long to keep retrying a call that is redirected, throttled, blocked by another operation in progress or fails with a network error, in seconds
     default: 300
     aliases: []
   state:
@@ -62,6 +62,8 @@ options:
     default: 'present'
     aliases: []
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -114,25 +116,8 @@ except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-from distutils.version import LooseVersion
-from types import MethodType
 import json
 
-def _wait_for_completion(azure, promise, wait_timeout, msg):
-    if not promise: return
-    wait_timeout = time.time() + wait_timeout
-    while wait_timeout > time.time():
-        operation_result = azure.get_operation_status(promise.request_id)
-        time.sleep(5)
-        if operation_result.status == "Succeeded":
-            return
-        elif operation_result.status == "InProgress":
-            continue
-        else:
-            raise WindowsAzureError('Failed to wait for async operation ' + msg + ': [' + operation_result.error.code + '] ' + operation_result.error.message)
-
-    raise WindowsAzureError('Timed out waiting for async operation ' + msg + ' "' + str(promise.request_id) + '" to complete.')
-
 def create_affinity_group(module, azure):
     """
     Create new affinity group
@@ -149,24 +134,26 @@ def create_affinity_group(module, azure):
     description = module.params.get('description')
     wait = module.boolean(module.params.get('wait'))
     wait_timeout = int(module.params.get('wait_timeout'))
+    result = None
 
     # Check if the affinity group already exists
-    affinity_group = None
-    try:
-        affinity_group = azure.get_affinity_group_properties(affinity_group_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such service
-    except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the affinity group '%s': %s" % (name, str(e)))
+    known, affinity_group = snapshot_lookup(module, azure, 'affinity_groups', name)
+    if not known:
+        try:
+            affinity_group = to_dict(azure.get_affinity_group_properties(affinity_group_name=name))
+        except WindowsAzureMissingResourceError as e:
+            pass  # no such service
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to find the affinity group '%s': %s" % (name, str(e)))
 
     # See if the affinity group needs to be changed
     update = False
     if affinity_group:
-        if affinity_group.description != description:
+        if affinity_group['description'] != description:
             update = True
-        if affinity_group.label != label:
+        if affinity_group['label'] != label:
             update = True
-        if affinity_group.location != location:
+        if affinity_group['location'] != location:
             module.fail_json(msg="cannot change the location of an existing affinity group")
 
     # Create/change the affinity group
@@ -176,16 +163,18 @@ def create_affinity_group(module, azure):
         changed = True
         try:
             result = azure.update_affinity_group(affinity_group_name=name, label=label, description=description)
+            invalidate_snapshot(module, 'affinity_groups', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "create_affinity_group")
+                wait_for_completion(azure, result, wait_timeout, "create_affinity_group")
         except WindowsAzureError as e:
             module.fail_json(msg="failed to create the new affinity group: %s" % str(e))
     else:
         changed = True
         try:
             result = azure.create_affinity_group(name=name, label=label, location=location, description=description)
+            invalidate_snapshot(module, 'affinity_groups', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "create_affinity_group")
+                wait_for_completion(azure, result, wait_timeout, "create_affinity_group")
         except WindowsAzureError as e:
             module.fail_json(msg="failed to create the new affinity group: %s" % str(e))
 
@@ -196,7 +185,7 @@ def create_affinity_group(module, azure):
         except WindowsAzureError as e:
             module.fail_json(msg="failed to lookup the affinity group '%s': %s" % (name, str(e)))
 
-    return (changed, affinity_group)
+    return (changed, affinity_group, getattr(result, 'request_id', None))
 
 def delete_affinity_group(module, azure):
     """
@@ -212,28 +201,40 @@ def delete_affinity_group(module, azure):
     name = module.params.get('name')
     wait = module.params.get('wait')
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'delete_affinity_group', name)
 
     changed = False
 
-    affinity_group = None
+    # Attach to a delete an earlier run left in flight
     try:
-        affinity_group = azure.get_affinity_group_properties(affinity_group_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such service
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "delete_affinity_group")
     except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the affinity group '%s': %s" % (name, str(e)))
+        module.fail_json(msg="failed to wait for the pending affinity group deletion: %s" % str(e))
+    if result:
+        return True, None, result.request_id
+
+    known, affinity_group = snapshot_lookup(module, azure, 'affinity_groups', name)
+    if not known:
+        try:
+            affinity_group = azure.get_affinity_group_properties(affinity_group_name=name)
+        except WindowsAzureMissingResourceError as e:
+            pass  # no such service
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to find the affinity group '%s': %s" % (name, str(e)))
 
     # Delete affinity group
     if affinity_group:
         changed = True
         try:
             result = azure.delete_affinity_group(affinity_group_name=name)
+            journal_operation(journal_key, result)
+            invalidate_snapshot(module, 'affinity_groups', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "delete_affinity_group")
+                wait_for_completion(azure, result, wait_timeout, "delete_affinity_group", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to delete the affinity group '%s': %s" % (name, str(e)))
 
-    return changed, affinity_group
+    return changed, affinity_group, getattr(result, 'request_id', None)
 
 def get_azure_creds(module):
     # Check modul args for credentials, then check environment vars
@@ -270,56 +271,23 @@ def main():
     subscription_id, management_cert_path = get_azure_creds(module)
 
     wait_timeout_redirects = int(module.params.get('wait_timeout_redirects'))
-    if LooseVersion(windows_azure.__version__) <= "0.8.0":
-        # wrapper for handling redirects which the sdk <= 0.8.0 is not following
-        azure = Wrapper(ServiceManagementService(subscription_id, management_cert_path), wait_timeout_redirects)
-    else:
-        azure = ServiceManagementService(subscription_id, management_cert_path)
+    # retry redirects, throttling, conflicting operations and network errors
+    azure = connect_service_management(subscription_id, management_cert_path, wait_timeout_redirects)
 
     if module.params.get('state') == 'absent':
-        (changed, affinity_group) = delete_affinity_group(module, azure)
+        (changed, affinity_group, request_id) = delete_affinity_group(module, azure)
 
     elif module.params.get('state') == 'present':
         # Changed is always set to true when provisioning new instances
         if not module.params.get('location'):
             module.fail_json(msg='locationis required for new affinity group')
-        (changed, affinity_group) = create_affinity_group(module, azure)
-
-    module.exit_json(changed=changed, affinity_group=json.loads(json.dumps(affinity_group, default=lambda o: o.__dict__)))
-
-
-class Wrapper(object):
-    def __init__(self, obj, wait_timeout):
-        self.other = obj
-        self.wait_timeout = wait_timeout
-
-    def __getattr__(self, name):
-        if hasattr(self.other, name):
-            func = getattr(self.other, name)
-            return lambda *args, **kwargs: self._wrap(func, args, kwargs)
-        raise AttributeError(name)
-
-    def _wrap(self, func, args, kwargs):
-        if type(func) == MethodType:
-            result = self._handle_temporary_redirects(lambda: func(*args, **kwargs))
-        else:
-            result = self._handle_temporary_redirects(lambda: func(self.other, *args, **kwargs))
-        return result
-
-    def _handle_temporary_redirects(self, f):
-        wait_timeout = time.time() + self.wait_timeout
-        while wait_timeout > time.time():
-            try:
-                return f()
-            except WindowsAzureError as e:
-                if not str(e).lower().find("temporary redirect") == -1:
-                    time.sleep(5)
-                    pass
-                else:
-                    raise e
+        (changed, affinity_group, request_id) = create_affinity_group(module, azure)
+
+    module.exit_json(changed=changed, request_id=request_id, affinity_group=json.loads(json.dumps(affinity_group, default=lambda o: o.__dict__)))
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
 
 main()
@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_blob
+short_description: uploads or deletes a blob
+description:
+     - Uploads a file as a block blob or a page blob, or deletes a blob. For block blobs the file is split into blocks that are uploaded concurrently, each retried on its own, and then committed together. When the blob already exists, only the blocks that changed are uploaded. For page blobs (such as VHDs for virtual machine disks) only the parts of the file that are not zeros are uploaded. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  name:
+    description:
+      - name of the blob
+    required: true
+    default: null
+  container:
+    description:
+      - name of the container
+    required: true
+    default: null
+  src:
+    description:
+      - path of the file to upload. Required when state is present.
+    required: false
+    default: null
+  overwrite:
+    description:
+      - upload every block of the file. By default the blocks of an existing blob that still match the file (by position and MD5, which are encoded in the block ids) are reused rather than uploaded again, and nothing is committed if the blob already holds the file.
+    required: false
+    default: false
+  blob_type:
+    description:
+      - type of blob to upload. A page blob must be a multiple of 512 bytes long; runs of zeros of 64KB or more are skipped (and holes in sparse files are not even read), so a fixed size VHD uploads only the data in it. An existing page blob is left alone unless overwrite is set or an earlier upload of it was interrupted.
+    required: false
+    default: 'block'
+    choices: [ "block", "page" ]
+  content_type:
+    description:
+      - content type to store with the blob
+    required: false
+    default: null
+  block_size:
+    description:
+      - size of each block, in bytes (at most 4194304)
+    required: false
+    default: 4194304
+  max_connections:
+    description:
+      - number of blocks (or page ranges) uploaded at once
+    required: false
+    default: 4
+  lease_id:
+    description:
+      - guid of the lease on the blob, if it has an active lease
+    required: false
+    default: null
+  account_name:
+    description:
+      - name of the storage account
+    required: true
+    default: null
+  account_key:
+    description:
+      - key used to access the storage account (either primary or secondary)
+    required: true
+    default: null
+  state:
+    description:
+      - create or delete the blob
+    required: false
+    default: 'present'
+    choices: [ "present", "absent" ]
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Note: None of these examples set account name or account key
+
+# Publish a build artifact over 8 connections
+- local_action:
+    module: azure_blob
+    name: releases/app-1.2.tar.gz
+    container: artifacts
+    src: build/app-1.2.tar.gz
+    content_type: application/gzip
+    max_connections: 8
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Upload a fixed size VHD for a data disk, skipping its empty space
+- local_action:
+    module: azure_blob
+    name: data-disk-1.vhd
+    container: vhds
+    src: images/data-disk-1.vhd
+    blob_type: page
+    max_connections: 8
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+  register: vhd
+
+- local_action:
+    module: azure_data_disk
+    service: my-service
+    deployment: my-deployment
+    role_name: my-role
+    label: data-disk-1
+    size_gb: 127
+    storage_account: my-storage-account
+    source_media_link: "{{ vhd.url }}"
+    lun: 0
+
+# Delete a blob
+- local_action:
+    module: azure_blob
+    name: releases/app-1.1.tar.gz
+    container: artifacts
+    state: absent
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+'''
+
+import os
+import sys
+import time
+
+try:
+    import azure as windows_azure
+
+    from azure import WindowsAzureError, WindowsAzureMissingResourceError
+    from azure.storage import (CloudStorageAccount)
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+def get_blob_properties(module, azure):
+    """
+    Returns the blob's properties, or None if it does not exist
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    lease_id = module.params.get('lease_id')
+
+    try:
+        return blob_properties(azure, container, name, lease_id=lease_id)
+    except WindowsAzureMissingResourceError:
+        return None
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to get blob properties: %s" % str(e))
+
+def upload_blob(module, azure):
+    """
+    Uploads a file as a block blob
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        True if the blob was changed, and a dict of the upload's statistics
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    src = os.path.expanduser(module.params.get('src'))
+    overwrite = module.boolean(module.params.get('overwrite'))
+    content_type = module.params.get('content_type')
+    block_size = int(module.params.get('block_size'))
+    max_connections = int(module.params.get('max_connections'))
+    lease_id = module.params.get('lease_id')
+
+    if not os.path.isfile(src):
+        module.fail_json(msg="src %s is not a file" % src)
+    if block_size < 1 or block_size > MAX_BLOCK_SIZE:
+        module.fail_json(msg="block_size must be between 1 and %d" % MAX_BLOCK_SIZE)
+
+    # Reuse the blocks of an existing block blob that still match the file
+    properties = get_blob_properties(module, azure)
+    committed = None
+    current_md5 = None
+    if properties and properties.get('x-ms-blob-type') == 'BlockBlob' and not overwrite:
+        current_md5 = properties.get('content-md5')
+        try:
+            committed = committed_block_ids(azure, container, name, lease_id)
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to get the block list: %s" % str(e))
+
+    start = time.time()
+    try:
+        (uploaded, reused, content_md5, changed) = upload_blocks(azure, container, name, src, block_size, max_connections, lease_id, content_type, committed, current_md5)
+    except (WindowsAzureError, IOError) as e:
+        module.fail_json(msg="failed to upload blob: %s" % str(e))
+    elapsed = time.time() - start
+
+    return (changed, dict(content_md5=content_md5, size=uploaded + reused, uploaded=uploaded, reused=reused,
+                          elapsed=round(elapsed, 2), bytes_per_second=int(uploaded / elapsed) if elapsed else uploaded))
+
+def upload_page_blob(module, azure):
+    """
+    Uploads a file as a page blob, skipping its zero pages
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        True if the blob was uploaded, and a dict of the upload's statistics
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    src = os.path.expanduser(module.params.get('src'))
+    overwrite = module.boolean(module.params.get('overwrite'))
+    content_type = module.params.get('content_type')
+    max_connections = int(module.params.get('max_connections'))
+    lease_id = module.params.get('lease_id')
+
+    if not os.path.isfile(src):
+        module.fail_json(msg="src %s is not a file" % src)
+
+    # an upload that was interrupted is done again, whatever overwrite says
+    properties = get_blob_properties(module, azure)
+    if properties and not overwrite and upload_complete(properties):
+        return (False, dict(size=int(properties['content-length'])))
+
+    start = time.time()
+    try:
+        (uploaded, skipped) = upload_pages(azure, container, name, src, max_connections, lease_id, content_type)
+    except (WindowsAzureError, IOError) as e:
+        module.fail_json(msg="failed to upload blob: %s" % str(e))
+    elapsed = time.time() - start
+
+    return (True, dict(size=uploaded + skipped, uploaded=uploaded, skipped=skipped,
+                       elapsed=round(elapsed, 2), bytes_per_second=int(uploaded / elapsed) if elapsed else uploaded))
+
+def delete_blob(module, azure):
+    """
+    Deletes a blob
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        True if the blob was deleted
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    lease_id = module.params.get('lease_id')
+
+    try:
+        azure.delete_blob(container_name=container, blob_name=name, x_ms_lease_id=lease_id)
+    except WindowsAzureMissingResourceError:
+        return (False, {})
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to delete blob: %s" % str(e))
+
+    return (True, {})
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(required=True),
+            container=dict(required=True),
+            src=dict(),
+            overwrite=dict(type='bool', default=False),
+            blob_type=dict(default='block', choices=['block', 'page']),
+            content_type=dict(),
+            block_size=dict(type='int', default=MAX_BLOCK_SIZE),
+            max_connections=dict(type='int', default=4),
+            lease_id=dict(),
+            account_name=dict(required=True),
+            account_key=dict(required=True),
+            state=dict(default='present', choices=['present', 'absent'])
+        )
+    )
+
+    account_name = module.params.get('account_name')
+    account_key = module.params.get('account_key')
+
+    # retry redirects, throttling and network errors; parallel uploads
+    # bypass the broker and get their own connection pool
+    max_connections = module.params.get('max_connections')
+    azure = connect_blob_service(account_name, account_key, use_broker=max_connections <= 1, pool_size=max_connections)
+
+    if module.params.get('state') == 'absent':
+        (changed, result) = delete_blob(module, azure)
+
+    elif module.params.get('state') == 'present':
+        if not module.params.get('src'):
+            module.fail_json(msg='src parameter is required to upload a blob')
+        if module.params.get('blob_type') == 'page':
+            (changed, result) = upload_page_blob(module, azure)
+        else:
+            (changed, result) = upload_blob(module, azure)
+        result['url'] = blob_url(account_name, module.params.get('container'), module.params.get('name'))
+
+    module.exit_json(changed=changed, **result)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_transfer import *
+
+main()
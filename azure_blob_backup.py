@@ -0,0 +1,340 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_blob_backup
+short_description: incremental backups of page blobs (VHDs)
+description:
+     - Backs up a page blob, such as the VHD of a virtual machine or data disk, to a local directory, or restores an image from such a backup. Each backup snapshots the blob and saves only the pages that changed since the previous backup's snapshot in a delta file, with an index of where they go. An image is restored by applying the most recent full backup and the deltas after it. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  name:
+    description:
+      - name of the page blob
+    required: true
+    default: null
+  container:
+    description:
+      - name of the container
+    required: true
+    default: null
+  dest:
+    description:
+      - directory holding the backups of this blob (index.json and a delta file per backup)
+    required: true
+    default: null
+  full:
+    description:
+      - take a full backup even if there is an earlier one to build on
+    required: false
+    default: false
+  keep_snapshots:
+    description:
+      - number of the blob snapshots taken by this module to keep. The latest one is needed to work out what changed at the next backup.
+    required: false
+    default: 1
+  chunk_size:
+    description:
+      - size of the ranges pages are downloaded (and compared) in, in bytes
+    required: false
+    default: 4194304
+  max_connections:
+    description:
+      - number of ranges downloaded at once
+    required: false
+    default: 4
+  restore_to:
+    description:
+      - path to write the restored image to (when state is restored)
+    required: false
+    default: null
+  backup:
+    description:
+      - id of the backup to restore (when state is restored). Defaults to the latest.
+    required: false
+    default: null
+  account_name:
+    description:
+      - name of the storage account
+    required: true
+    default: null
+  account_key:
+    description:
+      - key used to access the storage account (either primary or secondary)
+    required: true
+    default: null
+  state:
+    description:
+      - take a backup (present) or restore an image from the backups (restored)
+    required: false
+    default: 'present'
+    choices: [ "present", "restored" ]
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Note: None of these examples set account name or account key
+
+# Nightly incremental backup of a data disk
+- local_action:
+    module: azure_blob_backup
+    name: data-disk-1.vhd
+    container: vhds
+    dest: /backups/data-disk-1
+    max_connections: 8
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Rebuild the image as of backup 12
+- local_action:
+    module: azure_blob_backup
+    name: data-disk-1.vhd
+    container: vhds
+    dest: /backups/data-disk-1
+    restore_to: /restore/data-disk-1.vhd
+    backup: 12
+    state: restored
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+'''
+
+import hashlib
+import os
+import sys
+import threading
+import time
+
+try:
+    import azure as windows_azure
+
+    from azure import WindowsAzureError, WindowsAzureMissingResourceError
+    from azure.storage import (CloudStorageAccount)
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+def changed_ranges(module, azure, snapshot, previous, populated):
+    """
+    Works out which pages may have changed since the previous backup
+
+    Returns:
+        (ranges to download, ranges that were cleared, True if the
+         downloaded ranges still have to be compared with the previous
+         backup's chunk hashes)
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    chunk_size = int(module.params.get('chunk_size'))
+
+    # Newer SDKs can ask the service for the difference between snapshots
+    try:
+        diff = azure.get_page_ranges_diff(container_name=container, blob_name=name, previous_snapshot=previous['snapshot'], snapshot=snapshot)
+    except AttributeError:
+        diff = None
+    if diff is not None:
+        return (aligned_ranges([(r.start, r.end) for r in diff if not r.is_cleared], chunk_size),
+                [(r.start, r.end) for r in diff if r.is_cleared], False)
+
+    # Otherwise every populated page has to be read, but only the chunks
+    # whose MD5 changed are stored
+    cleared = subtract_ranges([tuple(r) for r in previous['populated']], populated)
+    return (aligned_ranges(populated, chunk_size), cleared, True)
+
+def take_backup(module, azure):
+    """
+    Snapshots the blob and saves what changed since the last backup
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        the new backup's index entry
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    dest = os.path.expanduser(module.params.get('dest'))
+    full = module.boolean(module.params.get('full'))
+    keep_snapshots = int(module.params.get('keep_snapshots'))
+    chunk_size = int(module.params.get('chunk_size'))
+    max_connections = int(module.params.get('max_connections'))
+
+    index_path = os.path.join(dest, 'index.json')
+    index = read_json_file(index_path)
+    if index and (index.get('container'), index.get('name')) != (container, name):
+        module.fail_json(msg="%s holds backups of %s/%s" % (dest, index.get('container'), index.get('name')))
+    backups = index.get('backups', [])
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+
+    try:
+        snapshot = azure.snapshot_blob(container_name=container, blob_name=name)['x-ms-snapshot']
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to snapshot blob: %s" % str(e))
+
+    backup_id = backups[-1]['id'] + 1 if backups else 1
+    delta_path = os.path.join(dest, '%06d.delta' % backup_id)
+    recorded = False
+    try:
+        try:
+            properties = blob_properties(azure, container, name, snapshot)
+            if properties.get('x-ms-blob-type') != 'PageBlob':
+                raise IOError('%s/%s is not a page blob' % (container, name))
+            size = int(properties['content-length'])
+            populated = page_ranges(azure, container, name, snapshot)
+
+            previous = backups[-1] if backups else None
+            if previous and not full and previous['size'] == size:
+                (ranges, cleared, compare) = changed_ranges(module, azure, snapshot, previous, populated)
+            else:
+                (ranges, cleared, compare) = (aligned_ranges(populated, chunk_size), [], False)
+                previous = None
+            old_hashes = index.get('hashes', {}) if compare else {}
+            hashes = {}
+
+            # Changed chunks are appended to the delta file in whatever order
+            # they arrive; the index records where each one went
+            stored = []
+            lock = threading.Lock()
+            delta = open(delta_path + '.part', 'wb')
+            try:
+                def fetch(byte_range):
+                    start, end = byte_range
+                    data = retry_range(lambda: get_blob_range(azure, container, name, start, end, snapshot))
+                    key = '%d-%d' % byte_range
+                    md5 = hashlib.md5(data).hexdigest()
+                    with lock:
+                        hashes[key] = md5
+                        if old_hashes.get(key) != md5:
+                            stored.append([start, end, delta.tell()])
+                            delta.write(data)
+                    return len(data)
+
+                downloaded = sum(run_concurrently(fetch, ranges, max_connections))
+            finally:
+                delta.close()
+            os.rename(delta_path + '.part', delta_path)
+        except (WindowsAzureError, IOError) as e:
+            module.fail_json(msg="failed to back up blob: %s" % str(e))
+
+        backup = dict(id=backup_id, snapshot=snapshot, taken=time.time(), size=size, full=previous is None,
+                      file=os.path.basename(delta_path), populated=populated, ranges=sorted(stored), cleared=cleared,
+                      downloaded=downloaded)
+        backups.append(backup)
+
+        # Keep only the newest snapshots; the latest is the base of the next diff
+        for old in [b for b in backups if not b.get('snapshot_deleted')][:-keep_snapshots]:
+            try:
+                azure.delete_blob(container_name=container, blob_name=name, snapshot=old['snapshot'])
+            except WindowsAzureMissingResourceError:
+                pass
+            except WindowsAzureError as e:
+                module.fail_json(msg="failed to delete snapshot %s: %s" % (old['snapshot'], str(e)))
+            old['snapshot_deleted'] = True
+
+        # Chunk hashes only stay valid while every backup compares them
+        write_json_file(index_path, dict(container=container, name=name, backups=backups,
+                                         hashes=hashes if compare or previous is None else {}))
+        recorded = True
+    finally:
+        # a snapshot the index does not refer to would only cost storage
+        if not recorded:
+            try:
+                azure.delete_blob(container_name=container, blob_name=name, snapshot=snapshot)
+            except WindowsAzureError:
+                pass
+    return backup
+
+def restore_backup(module):
+    """
+    Rebuilds an image from a full backup and the deltas after it
+
+    module : AnsibleModule object
+
+    Returns:
+        the id of the backup restored and the ids of the backups applied
+    """
+    dest = os.path.expanduser(module.params.get('dest'))
+    restore_to = os.path.expanduser(module.params.get('restore_to'))
+    backup_id = module.params.get('backup')
+
+    backups = read_json_file(os.path.join(dest, 'index.json')).get('backups', [])
+    if backup_id is not None:
+        backups = [b for b in backups if b['id'] <= int(backup_id)]
+    if not backups or (backup_id is not None and backups[-1]['id'] != int(backup_id)):
+        module.fail_json(msg="there is no backup %s in %s" % (backup_id or '', dest))
+    full = max(i for i, b in enumerate(backups) if b['full'])
+    chain = backups[full:]
+
+    part_path = restore_to + '.part'
+    zeros = '\0' * DEFAULT_CHUNK_SIZE
+    try:
+        with open(part_path, 'wb') as image:
+            # Unwritten parts of the image are holes, which read as zeros
+            image.truncate(chain[-1]['size'])
+            for backup in chain:
+                for start, end in backup['cleared']:
+                    image.seek(start)
+                    for offset in xrange(start, end + 1, len(zeros)):
+                        image.write(zeros[:min(len(zeros), end + 1 - offset)])
+                with open(os.path.join(dest, backup['file']), 'rb') as delta:
+                    for start, end, offset in backup['ranges']:
+                        delta.seek(offset)
+                        image.seek(start)
+                        image.write(delta.read(end - start + 1))
+        os.rename(part_path, restore_to)
+    except IOError as e:
+        module.fail_json(msg="failed to restore backup: %s" % str(e))
+
+    return (chain[-1]['id'], [b['id'] for b in chain])
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(required=True),
+            container=dict(required=True),
+            dest=dict(required=True),
+            full=dict(type='bool', default=False),
+            keep_snapshots=dict(type='int', default=1),
+            chunk_size=dict(type='int', default=DEFAULT_CHUNK_SIZE),
+            max_connections=dict(type='int', default=4),
+            restore_to=dict(),
+            backup=dict(type='int'),
+            account_name=dict(required=True),
+            account_key=dict(required=True),
+            state=dict(default='present', choices=['present', 'restored'])
+        )
+    )
+
+    if module.params.get('state') == 'restored':
+        if not module.params.get('restore_to'):
+            module.fail_json(msg='restore_to parameter is required to restore a backup')
+        (backup_id, applied) = restore_backup(module)
+        module.exit_json(changed=True, backup=backup_id, applied=applied)
+
+    if module.params.get('keep_snapshots') < 1:
+        module.fail_json(msg='keep_snapshots must be at least 1')
+
+    account_name = module.params.get('account_name')
+    account_key = module.params.get('account_key')
+
+    # retry redirects, throttling and network errors; parallel downloads
+    # bypass the broker and get their own connection pool
+    max_connections = module.params.get('max_connections')
+    azure = connect_blob_service(account_name, account_key, use_broker=max_connections <= 1, pool_size=max_connections)
+
+    backup = take_backup(module, azure)
+    stored = sum(end - start + 1 for start, end, offset in backup['ranges'])
+    module.exit_json(changed=True, backup=backup['id'], snapshot=backup['snapshot'], full=backup['full'],
+                     size=backup['size'], downloaded=backup['downloaded'], stored=stored)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_transfer import *
+
+main()
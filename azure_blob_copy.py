@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_blob_copy
+short_description: copies blobs within or between storage accounts
+description:
+     - Copies blobs server side with copy_blob, so the data never passes through the machine running the module. Many copies can be started at once and are then tracked together in one polling loop, which polls less often while the copies have a long way to go. Copies still pending when the timeout expires are aborted. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  name:
+    description:
+      - name of the destination blob. One of name or copies is required.
+    required: false
+    default: null
+  src:
+    description:
+      - the blob to copy to name, either container/blob in the same storage account or the URL of a blob (a blob in another account must be public or the URL must carry a shared access signature)
+    required: false
+    default: null
+  copies:
+    description:
+      - list of copies to make in one task, each a dict with a name, a src and optionally a container (which defaults to container). A result is returned for each of them.
+    required: false
+    default: null
+  container:
+    description:
+      - name of the destination container
+    required: true
+    default: null
+  overwrite:
+    description:
+      - copy over a destination blob that already exists. Otherwise an existing destination is left alone, and one that is being copied from the same src is reported as such. A destination that was copied from the same src is copied again only if src was modified after that copy completed.
+    required: false
+    default: false
+  wait:
+    description:
+      - wait for the copies to finish
+    required: false
+    default: true
+  timeout:
+    description:
+      - seconds to wait for the copies to finish before aborting the ones still pending
+    required: false
+    default: 3600
+  poll_interval:
+    description:
+      - shortest and longest time between polls of the copies' status, in seconds. The interval starts at the shortest, and grows towards the longest when the copies' progress says they will not finish sooner.
+    required: false
+    default: [1, 60]
+  workers:
+    description:
+      - number of requests made at once when starting and polling the copies
+    required: false
+    default: 8
+  account_name:
+    description:
+      - name of the storage account
+    required: true
+    default: null
+  account_key:
+    description:
+      - key used to access the storage account (either primary or secondary)
+    required: true
+    default: null
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Note: None of these examples set account name or account key
+
+# Copy a VHD to another container in the same account
+- local_action:
+    module: azure_blob_copy
+    name: data-disk-1.vhd
+    container: vhds-backup
+    src: vhds/data-disk-1.vhd
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Copy several images from another account, giving up after 2 hours
+- local_action:
+    module: azure_blob_copy
+    container: images
+    copies:
+      - name: base.vhd
+        src: "https://other-account.blob.core.windows.net/images/base.vhd?{{ sas_token }}"
+      - name: web.vhd
+        src: "https://other-account.blob.core.windows.net/images/web.vhd?{{ sas_token }}"
+    timeout: 7200
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+'''
+
+import sys
+import time
+import urlparse
+
+try:
+    import azure as windows_azure
+
+    from azure import WindowsAzureError, WindowsAzureMissingResourceError
+    from azure.storage import (CloudStorageAccount)
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+def source_url(account_name, src):
+    """
+    Returns the URL of src, which is either a URL or container/blob in
+    the account
+    """
+    if '://' in src:
+        return src
+    container, _, name = src.lstrip('/').partition('/')
+    return blob_url(account_name, container, name)
+
+def same_source(url, copy_source):
+    """
+    Compares two copy sources by blob (and snapshot), ignoring any
+    shared access signature
+    """
+    def key(u):
+        parts = urlparse.urlsplit(u or '')
+        return (parts.netloc.lower(), parts.path, urlparse.parse_qs(parts.query).get('snapshot'))
+    return key(url) == key(copy_source)
+
+def copy_progress(properties):
+    """
+    Returns (bytes copied, total bytes) from the x-ms-copy-progress header
+    """
+    try:
+        copied, total = properties.get('x-ms-copy-progress').split('/')
+        return (int(copied), int(total))
+    except (AttributeError, ValueError):
+        return (0, 0)
+
+def copy_result(copy, properties):
+    copy['status'] = properties.get('x-ms-copy-status')
+    copy['copy_id'] = properties.get('x-ms-copy-id', copy.get('copy_id'))
+    (copy['bytes_copied'], copy['size']) = copy_progress(properties)
+    if properties.get('x-ms-copy-status-description'):
+        copy['msg'] = properties.get('x-ms-copy-status-description')
+    return copy
+
+def start_copy(module, azure, copy):
+    """
+    Starts copying copy['source'] to the destination blob, unless the
+    destination already holds (or is receiving) it
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        the copy dict, updated with its status
+    """
+    overwrite = module.boolean(module.params.get('overwrite'))
+
+    try:
+        properties = azure.get_blob_properties(container_name=copy['container'], blob_name=copy['name'])
+    except WindowsAzureMissingResourceError:
+        properties = None
+
+    # a failed or aborted copy from the same source is simply started again,
+    # and a finished one if the source has been modified since it completed
+    conditions = {}
+    if properties is not None:
+        if same_source(copy['source'], properties.get('x-ms-copy-source')):
+            if properties.get('x-ms-copy-status') == 'pending':
+                return copy_result(copy, properties)
+            if properties.get('x-ms-copy-status') == 'success' and properties.get('x-ms-copy-completion-time'):
+                conditions['x_ms_source_if_modified_since'] = properties['x-ms-copy-completion-time']
+        elif not overwrite:
+            copy.update(status='exists', size=int(properties['content-length']))
+            return copy
+
+    try:
+        response = azure.copy_blob(container_name=copy['container'], blob_name=copy['name'], x_ms_copy_source=copy['source'], **conditions)
+    except WindowsAzureError as e:
+        # 412: the source is unchanged, so the earlier copy is current
+        if conditions and getattr(e, 'status_code', None) == 412:
+            return copy_result(copy, properties)
+        raise
+    copy.update(changed=True, started=time.time(), status=response.get('x-ms-copy-status'), copy_id=response.get('x-ms-copy-id'))
+    return copy
+
+def wait_for_copies(module, azure, copies):
+    """
+    Polls the pending copies until they all finish or the timeout expires,
+    aborting the ones still pending then
+
+    The time to the next poll is the soonest any pending copy is expected
+    to finish at its rate so far, kept between the poll_interval bounds.
+
+    Returns:
+        True if the timeout expired
+    """
+    timeout = int(module.params.get('timeout'))
+    (min_interval, max_interval) = [float(i) for i in module.params.get('poll_interval')]
+    workers = int(module.params.get('workers'))
+
+    deadline = time.time() + timeout
+    interval = min_interval
+    pending = [c for c in copies if c['status'] == 'pending']
+    while pending:
+        time.sleep(max(0, min(interval, deadline - time.time())))
+
+        def poll(copy):
+            try:
+                return copy_result(copy, azure.get_blob_properties(container_name=copy['container'], blob_name=copy['name']))
+            except WindowsAzureError as e:
+                # transient errors were retried already; give up on this copy
+                copy.update(status='failed', msg=str(e))
+                return copy
+
+        now = time.time()
+        pending = [c for c in run_concurrently(poll, pending, workers) if c['status'] == 'pending']
+        if not pending:
+            break
+        if now >= deadline:
+            for copy in pending:
+                try:
+                    azure.abort_copy_blob(container_name=copy['container'], blob_name=copy['name'], x_ms_copy_id=copy['copy_id'])
+                    copy['status'] = 'aborted'
+                except WindowsAzureError as e:
+                    copy['msg'] = "failed to abort copy: %s" % str(e)
+            return True
+
+        remaining = []
+        for copy in pending:
+            elapsed = now - copy.get('started', now)
+            if copy['bytes_copied'] and elapsed > 0:
+                remaining.append((copy['size'] - copy['bytes_copied']) * elapsed / copy['bytes_copied'])
+        interval = min(max_interval, max(min_interval, min(remaining) if remaining else interval * 2))
+
+    return False
+
+def copy_blobs(module, azure):
+    """
+    Starts the copies concurrently, then waits for them if asked to
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        a result dict per copy, and True if the timeout expired
+    """
+    container = module.params.get('container')
+    account_name = module.params.get('account_name')
+    wait = module.boolean(module.params.get('wait'))
+    workers = int(module.params.get('workers'))
+
+    if module.params.get('copies'):
+        items = module.params.get('copies')
+    else:
+        items = [dict(name=module.params.get('name'), src=module.params.get('src'))]
+
+    copies = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get('name') or not item.get('src'):
+            module.fail_json(msg="each copy needs a name and a src: %s" % item)
+        copies.append(dict(name=item['name'], container=item.get('container', container),
+                           source=source_url(account_name, item['src']), changed=False))
+
+    def start(copy):
+        try:
+            return start_copy(module, azure, copy)
+        except WindowsAzureError as e:
+            copy.update(status='failed', msg=str(e))
+            return copy
+
+    copies = run_concurrently(start, copies, workers)
+    timed_out = wait and wait_for_copies(module, azure, copies)
+    return (copies, timed_out)
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(),
+            src=dict(),
+            copies=dict(type='list'),
+            container=dict(required=True),
+            overwrite=dict(type='bool', default=False),
+            wait=dict(type='bool', default=True),
+            timeout=dict(type='int', default=3600),
+            poll_interval=dict(type='list', default=[1, 60]),
+            workers=dict(type='int', default=8),
+            account_name=dict(required=True),
+            account_key=dict(required=True)
+        )
+    )
+
+    if bool(module.params.get('copies')) == bool(module.params.get('name') or module.params.get('src')):
+        module.fail_json(msg="either name and src or copies is required")
+    if len(module.params.get('poll_interval')) != 2:
+        module.fail_json(msg="poll_interval must be a list of the shortest and longest interval")
+
+    account_name = module.params.get('account_name')
+    account_key = module.params.get('account_key')
+
+    # retry redirects, throttling and network errors over a connection pool
+    # shared by all the workers
+    azure = connect_blob_service(account_name, account_key, use_broker=False, pool_size=module.params.get('workers'))
+
+    (copies, timed_out) = copy_blobs(module, azure)
+    changed = any(c['changed'] for c in copies)
+
+    failed = [c for c in copies if c['status'] in ('failed', 'aborted') or (timed_out and c['status'] == 'pending')]
+    if failed:
+        msg = "failed to copy %d of %d blobs: %s" % (len(failed), len(copies), ', '.join('%s (%s)' % (c['name'], c.get('msg', c['status'])) for c in failed))
+        if timed_out:
+            msg = "timed out waiting for copies; " + msg
+        module.fail_json(msg=msg, changed=changed, copies=copies)
+
+    module.exit_json(changed=changed, copies=copies)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_transfer import *
+
+main()
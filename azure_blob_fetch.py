@@ -10,8 +10,18 @@ version_added: "1.9"
 options:
   name:
     description:
-      - name of the blob
-    required: true
+      - name of the blob. One of name, blobs or prefix is required.
+    required: false
+    default: null
+  blobs:
+    description:
+      - list of blobs to download in one task, each a dict with a name and optionally a dest and a lease_id. Blobs without a dest are downloaded to their name under the dest directory. The blobs are downloaded concurrently over one connection pool and a result is returned for each of them.
+    required: false
+    default: null
+  prefix:
+    description:
+      - download every blob whose name starts with prefix (use an empty string for the whole container) to its name under the dest directory, like blobs. The names and properties come from a single paged listing, so no blob needs a separate properties request.
+    required: false
     default: null
   container:
     description:
@@ -20,19 +30,60 @@ options:
     default: null
   lease_id:
     description:
-      - guid of an existing lease (to renew a lease or release without breaking)
+      - guid of a lease held on the blob, sent with every read of it. With blobs it is the default for items without their own lease_id; with prefix it is sent for every listed blob, so each of them must hold that lease.
     required: false
     default: null
   dest:
     description:
-      - the full path name to where the object will be downloaded to
-    required: true
+      - the full path name to where the object will be downloaded to, or the directory to download to when using blobs or prefix. Required unless extract_to is set.
+    required: false
+    default: null
+  extract_to:
+    description:
+      - instead of saving the blob, unpack it (a tar archive, optionally gzip or bzip2 compressed) into this directory. The blob is streamed through the decompressor as it downloads, reading ahead up to max_connections ranges of chunk_size bytes, so the archive itself never touches the disk. The archive is checked against the blob's Content-MD5 before the extracted files are moved into place. With mode if_changed the ETag of the last archive extracted is recorded next to the directory (.<extract_to>.azure.json). Only used with name.
+    required: false
     default: null
   overwrite:
     description:
-      - download the blob, even if the destination file exists
+      - download the blob, even if the destination file exists. Ignored when mode is set.
     required: false
     default: false
+  mode:
+    description:
+      - when to download the blob. C(if_missing) only downloads it when dest does not exist, C(always) downloads it every time and C(if_changed) first reads the blob's ETag and Content-MD5 and only downloads it when dest does not already hold that content. Defaults to C(always) when overwrite is set, otherwise C(if_missing). The blob version dest holds is recorded in a hidden file next to it (.<dest>.azure.json), so an unchanged blob costs a single properties request.
+    required: false
+    default: null
+    choices: [ "if_missing", "always", "if_changed" ]
+  max_connections:
+    description:
+      - number of connections to download the blob over. The blob is split into chunk_size byte ranges, which are fetched concurrently when this is above 1 and written straight into place.
+    required: false
+    default: 1
+  sparse:
+    description:
+      - for page blobs (such as VHDs), only download the pages that hold data, leaving the rest of dest as holes in a sparse file. Page blobs fetched this way are only hashed when they have a Content-MD5 to check, and are always reported as changed when downloaded; use mode if_changed to skip unchanged ones.
+    required: false
+    default: true
+  workers:
+    description:
+      - number of blobs downloaded at once when using blobs or prefix. Each of them uses up to max_connections connections.
+    required: false
+    default: 4
+  chunk_size:
+    description:
+      - size of each byte range, in bytes. Ranges are downloaded into dest.part and recorded in dest.part.json, so an interrupted download resumes where it left off on the next run as long as the blob has not changed. The data is hashed as it arrives and checked against the blob's Content-MD5, when it has one.
+    required: false
+    default: 4194304
+  cache_dir:
+    description:
+      - directory of a cache of downloaded blobs, shared by all forks. Overrides the AZURE_BLOB_CACHE_DIR environment variable. Blobs are cached by URL, ETag and Content-MD5; a blob still in the cache is copied to dest (as a copy-on-write clone or a hard link where the filesystem allows it, so do not modify dest in place) instead of being downloaded again. Forks fetching the same blob wait for a single download. Mostly useful with local_action, where every host's fetch runs on the controller.
+    required: false
+    default: null
+  cache_size:
+    description:
+      - size the cache is kept under, in bytes. The least recently used blobs are evicted first.
+    required: false
+    default: 10737418240
   account_name:
     description:
       - name of the storage account
@@ -44,6 +95,8 @@ options:
     required: true
     default: null
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -57,18 +110,156 @@ EXAMPLES = '''
     dest: /tmp/my-blob.bin
     account_name: my-storage-account
     account_key: my-storage-account-key
+
+# Fetch a large VHD over 8 connections in 8MB ranges
+- local_action:
+    module: azure_blob_fetch
+    name: my-disk.vhd
+    container: vhds
+    dest: /data/my-disk.vhd
+    max_connections: 8
+    chunk_size: 8388608
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Keep a local copy up to date, only downloading when the blob changes
+- local_action:
+    module: azure_blob_fetch
+    name: app.tar.gz
+    container: releases
+    dest: /srv/app.tar.gz
+    mode: if_changed
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Download and unpack a release archive in one pass
+- local_action:
+    module: azure_blob_fetch
+    name: app-1.2.tar.gz
+    container: releases
+    extract_to: /srv/app
+    mode: if_changed
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Roll an artifact out to every host, downloading it from storage only once
+- local_action:
+    module: azure_blob_fetch
+    name: app-1.2.bin
+    container: releases
+    dest: "/srv/staging/{{ inventory_hostname }}/app.bin"
+    cache_dir: /var/cache/azure-blobs
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Fetch several blobs in one task
+- local_action:
+    module: azure_blob_fetch
+    container: configs
+    blobs:
+      - name: web/nginx.conf
+        dest: /etc/nginx/nginx.conf
+      - name: web/app.ini
+    dest: /etc/app
+    mode: if_changed
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Fetch every blob under a prefix, 16 at a time
+- local_action:
+    module: azure_blob_fetch
+    container: configs
+    prefix: bundles/
+    dest: /srv/configs
+    workers: 16
+    account_name: my-storage-account
+    account_key: my-storage-account-key
 '''
 
+import os
 import sys
 import json
+import tarfile
 
 try:
-    from azure.common import AzureException
+    from azure import WindowsAzureError
     from azure.storage import (CloudStorageAccount)
 except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
+def fetch_blob(module, azure, name, dest, snapshot=None, lease_id=None, properties=None):
+    """
+    Download a blob, unless the mode says the local copy will do
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+    properties: the blob's properties, if already known from a listing
+
+    Returns:
+        a result dict for the blob
+    """
+    container = module.params.get('container')
+    overwrite = module.boolean(module.params.get('overwrite'))
+    mode = module.params.get('mode') or ('always' if overwrite else 'if_missing')
+    max_connections = int(module.params.get('max_connections'))
+    chunk_size = int(module.params.get('chunk_size'))
+
+    result = dict(name=name, dest=dest, changed=False, downloaded=0)
+    if mode == 'if_missing' and os.path.exists(dest):
+        return result
+
+    if properties is None:
+        properties = blob_properties(azure, container, name, snapshot, lease_id)
+    if mode == 'if_changed' and local_copy_current(dest, properties, module.md5):
+        return result
+
+    directory = os.path.dirname(dest)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    # Page blobs (such as VHDs) are fetched sparsely, only their populated ranges
+    sparse = module.boolean(module.params.get('sparse')) and properties.get('x-ms-blob-type') == 'PageBlob'
+
+    def download(path):
+        populated = page_ranges(azure, container, name, snapshot, lease_id) if sparse else None
+        return download_blob(azure, container, name, path, properties, chunk_size, max_connections, snapshot, lease_id, populated)
+
+    # Get the MD5 of any local file (from its sidecar if it is unmodified).
+    # Sparse downloads only hash the new file to check its Content-MD5, so
+    # there would be nothing to compare it with.
+    original_md5 = None if sparse else local_md5(dest, module.md5)
+    cache = blob_cache(module)
+    if cache:
+        # Serve the blob from the controller cache, downloading it into the
+        # cache first if no fork has yet
+        transferred = [0]
+
+        def cache_download(path):
+            (downloaded, reused, md5) = download(path)
+            transferred[0] = downloaded
+            return md5
+
+        url = blob_url(module.params.get('account_name'), container, name, snapshot)
+        (new_md5, hit) = cache.fetch(cache.key(url, properties), cache_download, dest)
+        downloaded = transferred[0]
+        result.update(cached=hit)
+    else:
+        (downloaded, reused, new_md5) = download(dest)
+    write_blob_sidecar(dest, properties, new_md5)
+
+    result.update(changed=new_md5 is None or new_md5 != original_md5, downloaded=downloaded, md5=new_md5)
+    return result
+
+def blob_cache(module):
+    """
+    Returns the controller blob cache to fetch through, or None
+    """
+    cache_dir = module.params.get('cache_dir') or BLOB_CACHE_DIR
+    if not cache_dir:
+        return None
+    return BlobCache(cache_dir, int(module.params.get('cache_size')))
+
 def get_blob(module, azure):
     """
     Download a blob
@@ -80,53 +271,160 @@ def get_blob(module, azure):
         True if an object was downloaded (and is different from any overwritten object)
     """
     name = module.params.get('name')
-    container = module.params.get('container')
     snapshot = module.params.get('snapshot')
     lease_id = module.params.get('lease_id')
     dest = module.params.get('dest')
+
+    try:
+        result = fetch_blob(module, azure, name, dest, snapshot, lease_id)
+    except (WindowsAzureError, IOError, OSError) as e:
+        module.fail_json(msg="failed to download blob: %s" % str(e))
+
+    return (result['changed'])
+
+def extract_blob(module, azure):
+    """
+    Download a tar archive blob and unpack it in one pass
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        True if the archive was extracted, and the number of members extracted
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    snapshot = module.params.get('snapshot')
+    lease_id = module.params.get('lease_id')
+    extract_to = module.params.get('extract_to')
     overwrite = module.boolean(module.params.get('overwrite'))
+    mode = module.params.get('mode') or ('always' if overwrite else 'if_missing')
+    max_connections = int(module.params.get('max_connections'))
+    chunk_size = int(module.params.get('chunk_size'))
+    record_path = blob_sidecar_path(extract_to.rstrip(os.sep))
+
+    if mode == 'if_missing' and os.path.exists(extract_to):
+        return (False, 0)
+
+    try:
+        properties = blob_properties(azure, container, name, snapshot, lease_id)
+        if mode == 'if_changed' and os.path.isdir(extract_to):
+            record = read_json_file(record_path)
+            if record.get('etag') == properties.get('etag'):
+                return (False, 0)
 
-    # Get the MD5 of any local file
-    original_md5 = module.md5(dest)
+        reader = BlobReader(azure, container, name, properties, chunk_size, max_connections, snapshot, lease_id)
+        extracted = extract_tar_stream(reader, extract_to, reader.verify)
+        write_json_file(record_path, dict(etag=properties.get('etag'), content_md5=properties.get('content-md5'), local_md5=reader.md5.hexdigest()))
+    except (WindowsAzureError, IOError, OSError, tarfile.TarError) as e:
+        module.fail_json(msg="failed to extract blob: %s" % str(e))
+
+    return (True, extracted)
+
+def get_blobs(module, azure):
+    """
+    Download many blobs concurrently
 
-    result = None
-    if original_md5 and not overwrite:
-        changed = False
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        a result dict per blob
+    """
+    container = module.params.get('container')
+    blobs = module.params.get('blobs')
+    prefix = module.params.get('prefix')
+    lease_id = module.params.get('lease_id')
+    dest = module.params.get('dest')
+    workers = int(module.params.get('workers'))
+
+    # (name, dest, lease_id, properties) for each blob; a listing already
+    # gives the properties, and blobs without a dest go to their name under dest
+    if blobs:
+        items = []
+        for blob in blobs:
+            if not isinstance(blob, dict) or 'name' not in blob:
+                module.fail_json(msg="each item of blobs needs a name: %s" % blob)
+            items.append((blob['name'], blob.get('dest'), blob.get('lease_id', lease_id), None))
     else:
         try:
-            azure.get_blob_to_path(container_name=container, blob_name=name, file_path=dest, snapshot=snapshot, x_ms_lease_id=lease_id)
-            changed = module.md5(dest) != original_md5
-        except AzureException as e:
-            module.fail_json(msg="failed to lease blob: %s" % str(e))
+            items = [(blob.name, None, lease_id, properties) for blob, properties in list_blob_properties(azure, container, prefix)]
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to list blobs: %s" % str(e))
+
+    def fetch(item):
+        name, path, blob_lease_id, properties = item
+        try:
+            path = path or blob_dest(dest, name)
+            return fetch_blob(module, azure, name, path, lease_id=blob_lease_id, properties=properties)
+        except (WindowsAzureError, IOError, OSError) as e:
+            return dict(name=name, dest=path, changed=False, downloaded=0, failed=True, msg=str(e))
 
-    return (changed)
+    return run_concurrently(fetch, items, workers)
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(required=True),
+            name=dict(),
+            blobs=dict(type='list'),
+            prefix=dict(),
             container=dict(required=True),
             snapshot=dict(),
-            dest=dict(required=True),
+            dest=dict(),
+            extract_to=dict(),
             overwrite=dict(type='bool', default=False),
+            mode=dict(choices=['if_missing', 'always', 'if_changed']),
             lease_id=dict(),
+            max_connections=dict(type='int', default=1),
+            workers=dict(type='int', default=4),
+            chunk_size=dict(type='int', default=DEFAULT_CHUNK_SIZE),
+            sparse=dict(type='bool', default=True),
+            cache_dir=dict(),
+            cache_size=dict(type='int', default=BLOB_CACHE_SIZE),
             account_name=dict(required=True),
             account_key=dict(required=True),
             state=dict(default='acquired', choices=['acquired', 'released'])
         )
     )
 
+    sources = [p for p in ('name', 'blobs', 'prefix') if module.params.get(p) is not None]
+    if len(sources) != 1:
+        module.fail_json(msg="exactly one of name, blobs or prefix is required")
+    if module.params.get('extract_to') is None and module.params.get('dest') is None:
+        module.fail_json(msg="dest is required unless extract_to is set")
+    if module.params.get('extract_to') is not None and module.params.get('name') is None:
+        module.fail_json(msg="extract_to can only be used with name")
+
     account_name = module.params.get('account_name')
     account_key = module.params.get('account_key')
 
-    azure = CloudStorageAccount(account_name, account_key).create_blob_service()
+    # retry redirects, throttling and network errors; parallel downloads
+    # bypass the broker and get their own connection pool
+    connections = module.params.get('max_connections')
+    if module.params.get('name') is None:
+        connections *= module.params.get('workers')
+    azure = connect_blob_service(account_name, account_key, use_broker=connections <= 1, pool_size=connections)
+
+    if module.params.get('extract_to') is not None:
+        (changed, extracted) = extract_blob(module, azure)
+        module.exit_json(changed=changed, extracted=extracted)
+
+    if module.params.get('name') is not None:
+        (changed) = get_blob(module, azure)
+        module.exit_json(changed=changed)
 
-    (changed) = get_blob(module, azure)
+    results = get_blobs(module, azure)
+    changed = any(r['changed'] for r in results)
+    failed = [r['name'] for r in results if r.get('failed')]
+    if failed:
+        module.fail_json(msg="failed to download %d of %d blobs: %s" % (len(failed), len(results), ', '.join(failed)), changed=changed, results=results)
 
-    module.exit_json(changed=changed)
+    module.exit_json(changed=changed, results=results)
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_transfer import *
 
 main()
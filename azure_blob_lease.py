@@ -5,13 +5,23 @@ DOCUMENTATION = '''
 module: azure_blob_lease
 short_description: acquires or releases a lease on a blob
 description:
-     - Acquires, renews, releases, or breaks leases on individual blobs. This module has a dependency on python-azure >= 0.7.1
+     - Acquires, renews, releases, or breaks leases on a blob, a list of blobs or every blob under a prefix. The lease state of all the blobs comes from a single listing of the container (a few named blobs, or named blobs with no common prefix, are looked up one by one instead), and only the blobs whose lease needs to change get a lease call, made concurrently. This module has a dependency on python-azure >= 0.7.1
 version_added: "1.9"
 options:
   name:
     description:
-      - name of the blob
-    required: true
+      - name of the blob. One of name, blobs or prefix is required.
+    required: false
+    default: null
+  blobs:
+    description:
+      - list of blobs to lease, each a name or a dict with a name and optionally a lease_id (which overrides lease_id)
+    required: false
+    default: null
+  prefix:
+    description:
+      - lease every blob whose name starts with prefix
+    required: false
     default: null
   container:
     description:
@@ -20,12 +30,17 @@ options:
     default: null
   lease_id:
     description:
-      - guid of an existing lease (to renew a lease or release without breaking)
+      - guid of an existing lease (to renew a lease or release without breaking). A blob with no active lease is leased with this guid.
+    required: false
+    default: null
+  proposed_lease:
+    description:
+      - guid to acquire new leases with, so that a set of blobs can share one lease id. A blob already leased with it has its lease renewed (a listing does not show whose lease a blob has).
     required: false
     default: null
   duration_s:
     description:
-      - length of time to obtain the lease for (-1 is never expire)
+      - length of time to obtain the lease for (-1 is never expire). Leases kept by a lease keeper must be 15 to 60 seconds long.
     required: false
     default: null
   break:
@@ -33,11 +48,26 @@ options:
       - breaks a lease (if state is released)
     required: false
     default: false
-  break_duration:
+  break_period:
     description:
       - period after a lease is broken to wait before a new lease can be obtained
     required: false
     default: null
+  workers:
+    description:
+      - number of lease calls made at once
+    required: false
+    default: 8
+  keeper_token:
+    description:
+      - token file of a lease keeper. With state kept, a keeper still running behind the token is only sent a heartbeat (with no azure calls at all); otherwise the leases are acquired and a keeper is started with this token (by default a new file under ~/.ansible/azure_lease_keeper, or AZURE_LEASE_KEEPER_DIR). With state released, the keeper is stopped and releases its leases, and no blobs need to be given.
+    required: false
+    default: null
+  heartbeat_timeout:
+    description:
+      - seconds a lease keeper keeps renewing after its last heartbeat (0 for no limit). Running the module with state kept and the keeper's token, or touching the token file, is a heartbeat. Once it expires the keeper releases its leases and exits, so the leases of a play that died are not held for longer.
+    required: false
+    default: 1800
   account_name:
     description:
       - name of the storage account
@@ -50,11 +80,13 @@ options:
     default: null
   state:
     description:
-      - sets the lease to acquired (or renewed) or released (or broken)
+      - sets the lease to acquired (or renewed) or released (or broken). kept acquires the leases and starts a detached lease keeper that renews them every third of their duration until it is stopped (with state released and keeper_token) or its heartbeat expires. If any lease cannot be acquired, no keeper is started and the leases that were acquired simply expire.
     required: true
     default: 'acquired'
-    aliases: []
+    choices: [ "acquired", "released", "kept" ]
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -80,8 +112,53 @@ EXAMPLES = '''
     break: yes
     break_period: 0
     state: released
+
+# Fence every VHD of a cluster under one lease id before maintenance
+- local_action:
+    module: azure_blob_lease
+    prefix: cluster-1/
+    container: vhds
+    proposed_lease: "{{ maintenance_lease_id }}"
+    duration_s: -1
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+  register: fence
+
+# ...and release them afterwards
+- local_action:
+    module: azure_blob_lease
+    prefix: cluster-1/
+    container: vhds
+    lease_id: "{{ maintenance_lease_id }}"
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+    state: released
+
+# Hold 30 second leases on a set of blobs for a long play, renewed in the
+# background rather than by renew tasks
+- local_action:
+    module: azure_blob_lease
+    blobs: [ db-1.vhd, db-2.vhd ]
+    container: vhds
+    duration_s: 30
+    state: kept
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+  register: keeper
+
+# ... long running tasks, optionally repeating the task above with
+# keeper_token: "{{ keeper.keeper_token }}" as a heartbeat ...
+
+- local_action:
+    module: azure_blob_lease
+    container: vhds
+    keeper_token: "{{ keeper.keeper_token }}"
+    state: released
+    account_name: my-storage-account
+    account_key: my-storage-account-key
 '''
 
+import os
 import sys
 import json
 
@@ -94,107 +171,243 @@ except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-def aquire_blob_lease(module, azure):
+# Named blobs are looked up one by one, rather than listed by the prefix
+# they have in common, when there are no more than this many of them
+BLOB_LOOKUP_LIMIT = 4
+
+def lease_action(module, lease_state, lease_id):
     """
-    Aquire a lease on a container
+    Returns the lease call a blob in lease_state needs to reach the
+    requested state, None if it is there already, or an error message
+    if it cannot get there
+
+    lease_id: the blob's lease id (from blobs) or lease_id
+    """
+    proposed_lease = module.params.get('proposed_lease')
+
+    if module.params.get('state') in ('acquired', 'kept'):
+        if lease_state == 'breaking':
+            return (None, 'the lease is being broken')
+        if lease_state == 'leased':
+            if lease_id:
+                return ('renew', None)
+            if proposed_lease:
+                return ('acquire', None)     # renews the lease if it is ours
+            return (None, 'the blob is already leased')
+        return ('acquire', None)
+
+    if lease_state not in ('leased', 'breaking'):
+        return (None, None)
+    if module.boolean(module.params.get('break_lease')):
+        return ('break', None) if lease_state == 'leased' else (None, None)
+    if not lease_id:
+        return (None, 'lease_id is required to release the lease')
+    return ('release', None)
+
+def blob_lease_states(module, azure):
+    """
+    Gets the lease state of the blobs, in one pass over the container unless
+    there are only a few named blobs (or they share no prefix)
 
     module : AnsibleModule object
     azure: authenticated azure BlobService object
 
     Returns:
-        True if a new blob lease is acquired, false otherwise
+        a (name, lease id) list of the blobs, and a dict of their lease
+        states by name (missing blobs are left out)
     """
-    name = module.params.get('name')
     container = module.params.get('container')
-    duration = int(module.params.get('duration_s'))
+    name = module.params.get('name')
+    blobs = module.params.get('blobs')
+    prefix = module.params.get('prefix')
     lease_id = module.params.get('lease_id')
-
-    try:
-        blob_properties = azure.get_blob_properties(container_name=container, blob_name=name, x_ms_lease_id=lease_id)
-    except WindowsAzureError as e:
-        module.fail_json(msg="failed to get blob properties: %s" % str(e))
-
-    changed = False
-
-    changed = not lease_id
+    workers = int(module.params.get('workers'))
+
+    if name is not None:
+        items = [(name, lease_id)]
+    elif blobs is not None:
+        items = []
+        for blob in blobs:
+            if isinstance(blob, dict):
+                if 'name' not in blob:
+                    module.fail_json(msg="each item of blobs needs a name: %s" % blob)
+                items.append((blob['name'], blob.get('lease_id', lease_id)))
+            else:
+                items.append((blob, lease_id))
+    else:
+        items = None
+
+    # named blobs are listed by the prefix they have in common
+    if items is not None:
+        prefix = os.path.commonprefix([n for n, l in items])
+    wanted = set(n for n, l in items) if items is not None else None
+
+    # a listing without a prefix reads the whole container
+    if wanted is not None and (not prefix or len(wanted) <= BLOB_LOOKUP_LIMIT):
+        def lookup(name):
+            try:
+                return (name, azure.get_blob_properties(container_name=container, blob_name=name).get('x-ms-lease-state'))
+            except WindowsAzureMissingResourceError:
+                return (name, None)
+
+        try:
+            states = dict((n, state) for n, state in run_concurrently(lookup, sorted(wanted), workers) if state is not None)
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to get blob properties: %s" % str(e))
+        return (items, states)
+
+    states = {}
     try:
-        lease = azure.lease_blob(container_name=container, blob_name=name, x_ms_lease_action='acquire' if not lease_id else 'renew', x_ms_lease_duration=duration, x_ms_lease_id=lease_id)
+        for blob, properties in list_blob_properties(azure, container, prefix or None):
+            if wanted is None or blob.name in wanted:
+                states[blob.name] = properties['x-ms-lease-state']
     except WindowsAzureError as e:
-        module.fail_json(msg="failed to lease blob: %s" % str(e))
+        module.fail_json(msg="failed to list blobs: %s" % str(e))
 
-    return (changed, lease)
+    if items is None:
+        items = [(n, lease_id) for n in sorted(states)]
+    return (items, states)
 
-def release_blob_lease(module, azure):
+def change_leases(module, azure):
     """
-    Releases a lease on a blob
+    Acquires, renews, releases or breaks the leases that need it
 
     module : AnsibleModule object
     azure: authenticated azure BlobService object
 
     Returns:
-        True if a lease was released
+        a dict of lease results by blob name, and the lease_blob response
+        for each blob that was called
     """
-
-    name = module.params.get('name')
     container = module.params.get('container')
-    lease_id = module.params.get('lease_id')
+    duration = module.params.get('duration_s')
     break_period = module.params.get('break_period')
-    break_lease = module.boolean(module.params.get('break'))
-
-    try:
-        blob_properties = azure.get_blob_properties(container_name=container, blob_name=name)
-    except WindowsAzureError as e:
-        module.fail_json(msg="failed to get blob properties: %s" % str(e))
-
-    changed = False
-    if blob_properties['x-ms-lease-state'] == 'available':
-        return (changed, None)
-
-    changed = True
-
-    result = None
-    try:
-        result = azure.lease_blob(container_name=container, blob_name=name, x_ms_lease_action='release' if not break_lease else 'break', x_ms_lease_id=lease_id, x_ms_lease_break_period=break_period)
-    except WindowsAzureMissingResourceError as e:
-        print e
-    except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the storage container: %s" % str(e))
-
-    return (changed, result)
+    proposed_lease = module.params.get('proposed_lease')
+    workers = int(module.params.get('workers'))
+
+    (items, states) = blob_lease_states(module, azure)
+
+    leases = {}
+    calls = []
+    for name, lease_id in items:
+        if name not in states:
+            leases[name] = dict(changed=False, failed=True, msg='the blob does not exist')
+            continue
+        (action, error) = lease_action(module, states[name], lease_id)
+        leases[name] = dict(changed=False, lease_state=states[name], lease_id=lease_id)
+        if error:
+            leases[name].update(failed=True, msg=error)
+        elif action:
+            calls.append((name, lease_id, action))
+
+    def call(item):
+        name, lease_id, action = item
+        try:
+            response = azure.lease_blob(container_name=container, blob_name=name, x_ms_lease_action=action,
+                                        x_ms_lease_id=lease_id if action != 'acquire' else None,
+                                        x_ms_lease_duration=int(duration) if action == 'acquire' else None,
+                                        x_ms_lease_break_period=break_period if action == 'break' else None,
+                                        x_ms_proposed_lease_id=(lease_id or proposed_lease) if action == 'acquire' else None)
+        except WindowsAzureError as e:
+            return (name, None, dict(failed=True, msg="failed to %s lease: %s" % (action, str(e))))
+
+        # renewing, or acquiring a lease the blob already has, changes nothing
+        lease = dict(action=action, changed=action in ('release', 'break') or (action == 'acquire' and states[name] != 'leased'))
+        if action in ('acquire', 'renew'):
+            lease.update(lease_state='leased', lease_id=response.get('x-ms-lease-id', lease_id))
+        elif action == 'release':
+            lease.update(lease_state='available', lease_id=None)
+        else:
+            lease.update(lease_state='broken' if response.get('x-ms-lease-time') in ('0', 0) else 'breaking')
+        return (name, response, lease)
+
+    responses = {}
+    for name, response, lease in run_concurrently(call, calls, workers):
+        leases[name].update(lease)
+        responses[name] = response
+
+    return (leases, responses)
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(required=True),
+            name=dict(),
+            blobs=dict(type='list'),
+            prefix=dict(),
             container=dict(required=True),
             lease_id=dict(),
             duration_s=dict(type='int'),
             break_lease=dict(type='bool', default=False, aliases=[ 'break' ]),
             break_period=dict(),
             proposed_lease=dict(),
+            workers=dict(type='int', default=8),
+            keeper_token=dict(),
+            heartbeat_timeout=dict(type='int', default=LEASE_KEEPER_HEARTBEAT),
             account_name=dict(required=True),
             account_key=dict(required=True),
-            state=dict(default='acquired', choices=['acquired', 'released'])
+            state=dict(default='acquired', choices=['acquired', 'released', 'kept'])
         )
     )
 
+    state = module.params.get('state')
+    keeper_token = module.params.get('keeper_token')
+    if keeper_token:
+        keeper_token = os.path.abspath(os.path.expanduser(keeper_token))
+
+    if state == 'released' and keeper_token:
+        (token, stopped) = stop_lease_keeper(keeper_token)
+        if not stopped:
+            module.fail_json(msg="the lease keeper (pid %d) did not exit" % token['pid'])
+        leases = dict((n, dict(changed=True, lease_state='available', lease_id=None)) for n in (token or {}).get('leases', {}))
+        module.exit_json(changed=token is not None, leases=leases)
+
+    if state == 'kept' and keeper_token:
+        token = heartbeat_lease_keeper(keeper_token)
+        if token:
+            leases = dict((n, dict(changed=False, lease_state='leased', lease_id=l)) for n, l in token['leases'].items())
+            module.exit_json(changed=False, leases=leases, keeper_token=keeper_token, keeper_pid=token['pid'])
+
+    sources = [p for p in ('name', 'blobs', 'prefix') if module.params.get(p) is not None]
+    if len(sources) != 1:
+        module.fail_json(msg="exactly one of name, blobs or prefix is required")
+    if state in ('acquired', 'kept') and not module.params.get('duration_s'):
+        module.fail_json(msg='duration_s parameter is required for lease aquisition')
+    if state == 'kept' and not 15 <= module.params.get('duration_s') <= 60:
+        module.fail_json(msg='duration_s must be between 15 and 60 for a lease keeper')
+
     account_name = module.params.get('account_name')
     account_key = module.params.get('account_key')
 
-    azure = CloudStorageAccount(account_name, account_key).create_blob_service()
+    # retry redirects, throttling and network errors; concurrent lease calls
+    # bypass the broker and get their own connection pool
+    workers = module.params.get('workers')
+    azure = connect_blob_service(account_name, account_key, use_broker=workers <= 1, pool_size=workers)
+
+    (leases, responses) = change_leases(module, azure)
+    changed = any(l['changed'] for l in leases.values())
+    result = dict(changed=changed, leases=leases)
+
+    name = module.params.get('name')
+    if name is not None:
+        result['lease'] = json.loads(json.dumps(responses.get(name), default=lambda o: o.__dict__))
 
-    if module.params.get('state') == 'released':
-        (changed, lease) = release_blob_lease(module, azure)
+    failed = sorted(n for n, l in leases.items() if l.get('failed'))
+    if failed:
+        module.fail_json(msg="failed to change the lease on %d of %d blobs: %s" % (len(failed), len(leases), ', '.join('%s (%s)' % (n, leases[n]['msg']) for n in failed)), **result)
 
-    elif module.params.get('state') == 'acquired':
-        if not module.params.get('duration_s'):
-            module.fail_json(msg='duration_s parameter is required for lease aquisition')
-        (changed, lease) = aquire_blob_lease(module, azure)
+    if state == 'kept':
+        held = dict((n, l['lease_id']) for n, l in leases.items())
+        (result['keeper_token'], result['keeper_pid']) = start_lease_keeper(account_name, account_key, module.params.get('container'), held,
+                                                                            module.params.get('duration_s'), module.params.get('heartbeat_timeout'), keeper_token)
+        result['changed'] = True
 
-    module.exit_json(changed=changed, lease=json.loads(json.dumps(lease, default=lambda o: o.__dict__)))
+    module.exit_json(**result)
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_lease import *
+from ansible.module_utils.azure_transfer import *
 
 main()
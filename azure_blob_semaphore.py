@@ -0,0 +1,364 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_blob_semaphore
+short_description: a counting semaphore held with blob leases
+description:
+     - Lets at most a given number of holders, from any number of plays and controllers, hold a semaphore at once, such as to limit how many deployments are created in a subscription at the same time. The semaphore is a set of slot blobs in a container, and holding it means holding a lease on one of its slots. Waiters queue for a free slot in the order they started waiting, polling with backoff, and the time spent waiting is reported. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  name:
+    description:
+      - name of the semaphore. Its blobs are named <name>/slot-<n> and <name>/queue/<ticket>.
+    required: true
+    default: null
+  container:
+    description:
+      - name of an existing container to hold the semaphore's blobs
+    required: true
+    default: null
+  slots:
+    description:
+      - the most holders there can be at once. Every holder must use the same number.
+    required: false
+    default: 1
+  duration_s:
+    description:
+      - length of the lease on the slot, 15 to 60 seconds, or -1 for a lease that never expires. Finite leases are renewed by a lease keeper (see azure_blob_lease) until the semaphore is released, or the keeper's heartbeat expires.
+    required: false
+    default: 60
+  heartbeat_timeout:
+    description:
+      - seconds the lease keeper keeps renewing the lease without a heartbeat (0 for no limit). Touching the keeper_token file is a heartbeat.
+    required: false
+    default: 1800
+  timeout:
+    description:
+      - seconds to wait for a free slot before giving up
+    required: false
+    default: 3600
+  poll_interval:
+    description:
+      - shortest and longest time between looks at the semaphore while waiting, in seconds. The interval grows from the shortest to the longest (with some jitter) while the waiter is not at the front of the queue.
+    required: false
+    default: [2, 30]
+  slot:
+    description:
+      - the slot to release (the slot returned when the semaphore was acquired), when not using a keeper_token
+    required: false
+    default: null
+  lease_id:
+    description:
+      - the lease to release, with slot
+    required: false
+    default: null
+  keeper_token:
+    description:
+      - token of the lease keeper renewing the slot's lease (returned when the semaphore was acquired). Stopping the keeper releases the slot.
+    required: false
+    default: null
+  account_name:
+    description:
+      - name of the storage account
+    required: true
+    default: null
+  account_key:
+    description:
+      - key used to access the storage account (either primary or secondary)
+    required: true
+    default: null
+  state:
+    description:
+      - acquire (waiting for a free slot) or release the semaphore
+    required: false
+    default: 'acquired'
+    choices: [ "acquired", "released" ]
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Note: None of these examples set account name or account key
+
+# Create at most 4 deployments at a time, across every play using the semaphore
+- local_action:
+    module: azure_blob_semaphore
+    name: deployments
+    container: locks
+    slots: 4
+    timeout: 1800
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+  register: semaphore
+
+- local_action:
+    module: azure_service
+    ...
+
+- local_action:
+    module: azure_blob_semaphore
+    name: deployments
+    container: locks
+    keeper_token: "{{ semaphore.keeper_token }}"
+    state: released
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+'''
+
+import email.utils
+import os
+import random
+import sys
+import time
+import uuid
+
+try:
+    import azure as windows_azure
+
+    from azure import WindowsAzureError, WindowsAzureConflictError, WindowsAzureMissingResourceError
+    from azure.storage import (CloudStorageAccount)
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+# Waiters re-write their ticket this often, and tickets that have not been
+# re-written for TICKET_STALE seconds belong to waiters that died.  Both
+# ages, and the order of the queue, are in the storage service's time (from
+# Last-Modified), so hosts with skewed clocks agree on them.
+TICKET_REFRESH = 60
+TICKET_STALE = 300
+
+# Lease states in which a slot can be leased straight away (a breaking
+# lease still holds the slot until its break period ends)
+FREE_LEASE_STATES = ('available', 'expired', 'broken')
+
+def slot_name(name, index):
+    return '%s/slot-%03d' % (name, index)
+
+def http_date_seconds(value):
+    parsed = email.utils.parsedate_tz(value or '')
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+def semaphore_state(module, azure):
+    """
+    Lists the semaphore's slots and queue in one pass
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    A ticket is queued at the server time it was first written, which it
+    keeps in its metadata once re-written (until then, its Last-Modified).
+
+    Returns:
+        the lease state of each slot by name, and the queue's tickets as
+        (time queued, name, time last written), oldest first
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+
+    slots = {}
+    tickets = []
+    for blob, properties in list_blob_properties(azure, container, name + '/', include='metadata'):
+        if blob.name.startswith(name + '/queue/'):
+            written = http_date_seconds(blob.properties.last_modified)
+            try:
+                queued = float(blob.metadata.get('queued'))
+            except (TypeError, ValueError):
+                queued = written
+            tickets.append((queued, blob.name, written))
+        else:
+            slots[blob.name] = properties['x-ms-lease-state']
+    return (slots, sorted(tickets))
+
+def put_empty_blob(azure, container, name, metadata=None):
+    azure.put_blob(container_name=container, blob_name=name, blob='', x_ms_blob_type='BlockBlob', x_ms_meta_name_values=metadata)
+
+def acquire_semaphore(module, azure):
+    """
+    Queues for a free slot and leases it
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        the slot, its lease id and a dict of waiting statistics
+    """
+    name = module.params.get('name')
+    container = module.params.get('container')
+    slots = int(module.params.get('slots'))
+    duration = int(module.params.get('duration_s'))
+    timeout = int(module.params.get('timeout'))
+    (min_interval, max_interval) = [float(i) for i in module.params.get('poll_interval')]
+
+    start = time.time()
+    ticket = '%s/queue/%s' % (name, uuid.uuid4().hex)
+    put_empty_blob(azure, container, ticket)
+    written = start
+    queued = None
+
+    interval = min_interval
+    polls = 0
+    attempts = 0
+    first_position = None
+    try:
+        while True:
+            polls += 1
+            (states, tickets) = semaphore_state(module, azure)
+
+            # Slots are created on first use; creating one a holder has
+            # already leased fails, which is as good
+            for index in range(slots):
+                if slot_name(name, index) not in states:
+                    try:
+                        put_empty_blob(azure, container, slot_name(name, index))
+                        states[slot_name(name, index)] = 'available'
+                    except WindowsAzureError:
+                        pass
+
+            # The server's time now is that of our own last write plus the
+            # time since; only local intervals are trusted, not local times
+            own = [t for t in tickets if t[1] == ticket]
+            if own and own[0][2] is not None:
+                queued = queued or own[0][0]
+                now = own[0][2] + time.time() - written
+                for q, stale, last_written in tickets:
+                    if stale != ticket and last_written is not None and now - last_written > TICKET_STALE:
+                        try:
+                            azure.delete_blob(container_name=container, blob_name=stale)
+                        except WindowsAzureError:
+                            pass
+                queue = [t for q, t, last_written in tickets if t == ticket or last_written is None or now - last_written <= TICKET_STALE]
+            else:
+                # taken for stale and deleted; it is written again below
+                queue = [t for q, t, last_written in tickets]
+                written = 0
+            position = queue.index(ticket) if ticket in queue else len(queue)
+            if first_position is None:
+                first_position = position
+
+            # Only the waiters at the front of the queue, one per free slot,
+            # try for a slot, each for a different one
+            free = [slot_name(name, i) for i in range(slots) if states.get(slot_name(name, i)) in FREE_LEASE_STATES]
+            if position < len(free):
+                slot = free[position]
+                attempts += 1
+                # a proposed lease id makes a retried acquire harmless
+                try:
+                    lease = azure.lease_blob(container_name=container, blob_name=slot, x_ms_lease_action='acquire', x_ms_lease_duration=duration,
+                                             x_ms_proposed_lease_id=str(uuid.uuid4()))
+                    waited = time.time() - start
+                    return (slot, lease['x-ms-lease-id'], dict(wait_seconds=round(waited, 2), polls=polls, attempts=attempts,
+                                                              queue_position=first_position, holders=slots - len(free) + 1))
+                except WindowsAzureError:
+                    pass    # another holder got it first
+
+            if time.time() - start >= timeout:
+                module.fail_json(msg="timed out after %d seconds waiting for a slot of %s" % (timeout, name),
+                                 wait_seconds=round(time.time() - start, 2), polls=polls, attempts=attempts,
+                                 queue_position=first_position, position=position, holders=slots - len(free))
+
+            if time.time() - written > TICKET_REFRESH:
+                put_empty_blob(azure, container, ticket, queued and {'queued': '%d' % queued})
+                written = time.time()
+
+            # the front of the queue polls fast; everyone else backs off
+            interval = min_interval if position == 0 else min(max_interval, interval * 1.5)
+            time.sleep(min(interval * random.uniform(0.8, 1.2), max(0, start + timeout - time.time())))
+    finally:
+        try:
+            azure.delete_blob(container_name=container, blob_name=ticket)
+        except WindowsAzureError:
+            pass
+
+def release_semaphore(module, azure):
+    """
+    Releases the lease on a slot
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        True if the lease was released
+    """
+    container = module.params.get('container')
+    slot = module.params.get('slot')
+    lease_id = module.params.get('lease_id')
+
+    try:
+        azure.lease_blob(container_name=container, blob_name=slot, x_ms_lease_action='release', x_ms_lease_id=lease_id)
+    except (WindowsAzureMissingResourceError, WindowsAzureConflictError):
+        return False    # the lease has been broken, or expired and been taken
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to release the slot: %s" % str(e))
+    return True
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(required=True),
+            container=dict(required=True),
+            slots=dict(type='int', default=1),
+            duration_s=dict(type='int', default=60),
+            heartbeat_timeout=dict(type='int', default=LEASE_KEEPER_HEARTBEAT),
+            timeout=dict(type='int', default=3600),
+            poll_interval=dict(type='list', default=[2, 30]),
+            slot=dict(),
+            lease_id=dict(),
+            keeper_token=dict(),
+            account_name=dict(required=True),
+            account_key=dict(required=True),
+            state=dict(default='acquired', choices=['acquired', 'released'])
+        )
+    )
+
+    account_name = module.params.get('account_name')
+    account_key = module.params.get('account_key')
+    keeper_token = module.params.get('keeper_token')
+
+    if module.params.get('state') == 'released':
+        if keeper_token:
+            (token, stopped) = stop_lease_keeper(os.path.expanduser(keeper_token))
+            if not stopped:
+                module.fail_json(msg="the lease keeper (pid %d) did not exit" % token['pid'])
+            module.exit_json(changed=token is not None)
+        if not module.params.get('slot') or not module.params.get('lease_id'):
+            module.fail_json(msg='either keeper_token or slot and lease_id are required to release the semaphore')
+        azure = connect_blob_service(account_name, account_key)
+        module.exit_json(changed=release_semaphore(module, azure))
+
+    duration = module.params.get('duration_s')
+    if duration != -1 and not 15 <= duration <= 60:
+        module.fail_json(msg='duration_s must be between 15 and 60, or -1')
+    if module.params.get('slots') < 1:
+        module.fail_json(msg='slots must be at least 1')
+    if len(module.params.get('poll_interval')) != 2:
+        module.fail_json(msg="poll_interval must be a list of the shortest and longest interval")
+
+    # retry redirects, throttling and network errors
+    azure = connect_blob_service(account_name, account_key)
+
+    try:
+        (slot, lease_id, stats) = acquire_semaphore(module, azure)
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to acquire the semaphore: %s" % str(e))
+
+    result = dict(changed=True, slot=slot, lease_id=lease_id, **stats)
+    if duration != -1:
+        (result['keeper_token'], result['keeper_pid']) = start_lease_keeper(account_name, account_key, module.params.get('container'),
+                                                                            {slot: lease_id}, duration, module.params.get('heartbeat_timeout'),
+                                                                            keeper_token and os.path.expanduser(keeper_token))
+
+    module.exit_json(**result)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_lease import *
+from ansible.module_utils.azure_transfer import *
+
+main()
@@ -0,0 +1,304 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_blob_sync
+short_description: mirrors a container to a local directory
+description:
+     - Makes a local directory hold the blobs of a container, or of the blobs under a prefix in it. The container is listed a page at a time and each blob's ETag, size and Content-MD5 are compared with a manifest kept in the directory (.azure_blob_sync.json), so only new and changed blobs are downloaded, in parallel and while the listing continues, and unchanged files are never read. Finished downloads are added to the manifest as they complete, so an interrupted sync does not hash them again. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  container:
+    description:
+      - name of the container
+    required: true
+    default: null
+  prefix:
+    description:
+      - only sync blobs whose names start with prefix
+    required: false
+    default: null
+  dest:
+    description:
+      - the directory to sync to. Each blob is written to its name under it.
+    required: true
+    default: null
+  delete:
+    description:
+      - delete files under dest that are not blobs in the container (or under the prefix)
+    required: false
+    default: false
+  workers:
+    description:
+      - number of blobs downloaded at once
+    required: false
+    default: 8
+  max_connections:
+    description:
+      - number of connections to download each blob over, in chunk_size byte ranges
+    required: false
+    default: 1
+  chunk_size:
+    description:
+      - size of each byte range, in bytes
+    required: false
+    default: 4194304
+  account_name:
+    description:
+      - name of the storage account
+    required: true
+    default: null
+  account_key:
+    description:
+      - key used to access the storage account (either primary or secondary)
+    required: true
+    default: null
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Mirror a container to a local directory, removing files whose blobs are gone
+- local_action:
+    module: azure_blob_sync
+    container: static-content
+    dest: /srv/www
+    delete: yes
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+
+# Sync just the blobs under a prefix
+- local_action:
+    module: azure_blob_sync
+    container: configs
+    prefix: web/
+    dest: /etc/web
+    workers: 16
+    account_name: my-storage-account
+    account_key: my-storage-account-key
+'''
+
+import os
+import sys
+import json
+import threading
+import time
+
+try:
+    from azure import WindowsAzureError
+    from azure.storage import (CloudStorageAccount)
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+MANIFEST_NAME = '.azure_blob_sync.json'
+
+# Finished downloads are added to the manifest at most this often (in
+# seconds), so an interrupted sync does not have to hash them again
+MANIFEST_FLUSH_INTERVAL = 1.0
+
+def read_manifest(module, path):
+    """
+    Returns the manifest entries, by blob name, if the manifest was written
+    for the same container and prefix
+    """
+    manifest = read_json_file(path)
+    if manifest.get('container') != module.params.get('container') or manifest.get('prefix') != module.params.get('prefix'):
+        return {}
+    return manifest.get('blobs', {})
+
+def write_manifest(module, path, entries):
+    write_json_file(path, dict(container=module.params.get('container'),
+                               prefix=module.params.get('prefix'),
+                               blobs=entries))
+
+def add_to_manifest(module, path, entries):
+    """
+    Adds entries to the manifest, keeping the entries already in it
+    """
+    def update(manifest):
+        if manifest.get('container') != module.params.get('container') or manifest.get('prefix') != module.params.get('prefix'):
+            manifest.clear()
+            manifest.update(container=module.params.get('container'), prefix=module.params.get('prefix'))
+        manifest.setdefault('blobs', {}).update(entries)
+    update_json_file(path, update)
+
+def manifest_entry(path, properties, local_md5):
+    return dict(etag=properties.get('etag'),
+                size=int(properties['content-length']),
+                content_md5=properties.get('content-md5'),
+                local_md5=local_md5,
+                identity=file_identity(path))
+
+def current_entry(module, path, entry, properties):
+    """
+    Returns the manifest entry for path if it already holds the blob with
+    properties, or None if the blob needs downloading
+
+    entry: the blob's entry in the last manifest, or None
+
+    Files recorded in the manifest and not modified since are compared by
+    ETag (or size and Content-MD5) without being read.  Files the manifest
+    does not know are hashed once and compared with Content-MD5.
+    """
+    if not os.path.exists(path):
+        return None
+    size = int(properties['content-length'])
+    content_md5 = properties.get('content-md5')
+
+    if entry and entry.get('identity') == file_identity(path):
+        if entry['etag'] != properties.get('etag') and not (content_md5 and entry['size'] == size and entry['content_md5'] == content_md5):
+            return None
+        return dict(entry, etag=properties.get('etag'), content_md5=content_md5)
+
+    if not content_md5 or os.path.getsize(path) != size:
+        return None
+    local_md5 = module.md5(path)
+    if hex_to_content_md5(local_md5) != content_md5:
+        return None
+    return manifest_entry(path, properties, local_md5)
+
+def sync_blobs(module, azure):
+    """
+    Downloads new and changed blobs and removes orphaned files
+
+    module : AnsibleModule object
+    azure: authenticated azure BlobService object
+
+    Returns:
+        names of the blobs downloaded, paths deleted, the number of
+        unchanged blobs, bytes downloaded and failed blobs (name, message)
+    """
+    container = module.params.get('container')
+    prefix = module.params.get('prefix')
+    dest = os.path.abspath(module.params.get('dest'))
+    delete = module.boolean(module.params.get('delete'))
+    workers = int(module.params.get('workers'))
+    max_connections = int(module.params.get('max_connections'))
+    chunk_size = int(module.params.get('chunk_size'))
+
+    if not os.path.isdir(dest):
+        os.makedirs(dest)
+    manifest_path = os.path.join(dest, MANIFEST_NAME)
+    old_entries = read_manifest(module, manifest_path)
+    entries = {}
+    listed = set()
+    failed = []
+    downloaded = []
+    bytes_downloaded = [0]
+    finished = {}
+    last_flush = [time.time()]
+    lock = threading.Lock()
+
+    def changed_blobs():
+        # Compare each page of the listing as it arrives; changed blobs are
+        # handed to the workers straight away
+        for blob, properties in list_blob_properties(azure, container, prefix):
+            if blob.name.endswith('/'):
+                continue    # directory placeholder
+            try:
+                path = blob_dest(dest, blob.name)
+            except IOError as e:
+                failed.append((blob.name, str(e)))
+                continue
+            if path == manifest_path:
+                continue
+            listed.add(path)
+            entry = current_entry(module, path, old_entries.get(blob.name), properties)
+            if entry:
+                with lock:
+                    entries[blob.name] = entry
+            else:
+                yield (blob.name, path, properties)
+
+    def flush(force=False):
+        with lock:
+            if not finished or not force and time.time() - last_flush[0] < MANIFEST_FLUSH_INTERVAL:
+                return
+            last_flush[0] = time.time()
+            flushed = dict(finished)
+            finished.clear()
+        add_to_manifest(module, manifest_path, flushed)
+
+    def fetch(item):
+        name, path, properties = item
+        try:
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            (size, reused, local_md5) = download_blob(azure, container, name, path, properties, chunk_size, max_connections)
+        except (WindowsAzureError, IOError, OSError) as e:
+            with lock:
+                failed.append((name, str(e)))
+            return
+        entry = manifest_entry(path, properties, local_md5)
+        with lock:
+            entries[name] = finished[name] = entry
+            downloaded.append(name)
+            bytes_downloaded[0] += size
+        flush()
+
+    try:
+        run_concurrently(fetch, changed_blobs(), workers)
+    except WindowsAzureError as e:
+        flush(force=True)
+        module.fail_json(msg="failed to list blobs: %s" % str(e))
+    unchanged = len(entries) - len(downloaded)
+
+    deleted = []
+    if delete:
+        # Keep partial downloads of listed blobs so they can be resumed
+        keep = listed | set(p + '.part' for p in listed) | set(p + '.part.json' for p in listed)
+        keep.update([manifest_path, manifest_path + '.lock'])
+        for directory, dirnames, filenames in os.walk(dest):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if path not in keep:
+                    os.remove(path)
+                    deleted.append(path)
+
+    write_manifest(module, manifest_path, entries)
+    return (downloaded, deleted, unchanged, bytes_downloaded[0], failed)
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            container=dict(required=True),
+            prefix=dict(),
+            dest=dict(required=True),
+            delete=dict(type='bool', default=False),
+            workers=dict(type='int', default=8),
+            max_connections=dict(type='int', default=1),
+            chunk_size=dict(type='int', default=DEFAULT_CHUNK_SIZE),
+            account_name=dict(required=True),
+            account_key=dict(required=True)
+        )
+    )
+
+    account_name = module.params.get('account_name')
+    account_key = module.params.get('account_key')
+
+    # retry redirects, throttling and network errors over a connection pool
+    # shared by all the workers
+    connections = module.params.get('workers') * module.params.get('max_connections')
+    azure = connect_blob_service(account_name, account_key, use_broker=False, pool_size=connections)
+
+    (downloaded, deleted, unchanged, bytes_downloaded, failed) = sync_blobs(module, azure)
+    changed = bool(downloaded or deleted)
+
+    if failed:
+        module.fail_json(msg="failed to sync %d blobs: %s" % (len(failed), ', '.join('%s (%s)' % f for f in failed)),
+                         changed=changed, downloaded=downloaded, deleted=deleted)
+
+    module.exit_json(changed=changed, downloaded=downloaded, deleted=deleted, unchanged=unchanged, bytes_downloaded=bytes_downloaded)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_transfer import *
+
+main()
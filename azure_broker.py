@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_broker
+short_description: starts or stops the local azure connection broker
+description:
+     - Starts or stops a broker process on the controller that keeps authenticated, pooled connections to the Service Management and Blob services. While it is running, the other azure modules send their calls through it over a Unix socket instead of connecting to azure themselves; when it is not running they connect directly. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  socket_path:
+    description:
+      - path of the Unix socket the broker listens on. Overrides the AZURE_BROKER_SOCKET environment variable (which the other modules use to find the broker).
+    required: false
+    default: ~/.ansible/azure_broker.sock
+  idle_timeout:
+    description:
+      - how long the broker keeps running without receiving a call, in seconds
+    required: false
+    default: 1800
+  cache_ttl:
+    description:
+      - how long the broker answers repeated read calls (get_*, list_*, check_*) from memory, in seconds. A call that changes something on the same subscription or storage account clears its cache; other reads, such as operation status polls, do not.
+    required: false
+    default: 10
+  state:
+    description:
+      - start or stop the broker
+    required: false
+    default: 'started'
+    choices: [ "started", "stopped" ]
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Start the broker once at the beginning of a play
+- local_action:
+    module: azure_broker
+  run_once: true
+
+# ... azure tasks ...
+
+# Stop it at the end
+- local_action:
+    module: azure_broker
+    state: stopped
+  run_once: true
+'''
+
+import os
+import sys
+import time
+
+try:
+    import azure as windows_azure
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+def start_broker(module):
+    """
+    Starts the broker unless one is already listening
+
+    module : AnsibleModule object
+
+    Returns:
+        True if a broker was started, and its pid
+    """
+    socket_path = os.path.expanduser(module.params.get('socket_path'))
+    idle_timeout = int(module.params.get('idle_timeout'))
+    cache_ttl = int(module.params.get('cache_ttl'))
+
+    sock = connect_broker(socket_path)
+    if sock:
+        sock.close()
+        return (False, None)
+
+    pid = daemonize(serve_broker, socket_path, idle_timeout, cache_ttl)
+
+    # Wait for the broker to start listening
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        sock = connect_broker(socket_path)
+        if sock:
+            sock.close()
+            return (True, pid)
+        time.sleep(0.1)
+
+    module.fail_json(msg="the broker (pid %d) did not start listening on %s" % (pid, socket_path))
+
+def stop_broker(module):
+    """
+    Stops a running broker
+
+    module : AnsibleModule object
+
+    Returns:
+        True if a broker was stopped
+    """
+    socket_path = os.path.expanduser(module.params.get('socket_path'))
+
+    if not os.path.exists(socket_path):
+        return (False, None)
+
+    # The broker exits once its socket is gone
+    try:
+        os.remove(socket_path)
+    except OSError as e:
+        module.fail_json(msg="failed to stop the broker: %s" % str(e))
+
+    return (True, None)
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            socket_path=dict(default=BROKER_SOCKET_PATH),
+            idle_timeout=dict(default=BROKER_IDLE_TIMEOUT),
+            cache_ttl=dict(default=BROKER_CACHE_TTL),
+            state=dict(default='started', choices=['started', 'stopped'])
+        )
+    )
+
+    if module.params.get('state') == 'stopped':
+        (changed, pid) = stop_broker(module)
+
+    elif module.params.get('state') == 'started':
+        (changed, pid) = start_broker(module)
+
+    module.exit_json(changed=changed, pid=pid, socket_path=module.params.get('socket_path'))
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_broker import *
+from ansible.module_utils.azure_common import *
+
+main()
@@ -87,7 +87,7 @@ options:
     aliases: []
   wait_timeout_redirects:
     description:
-      - how long before wait gives up for redirects, in seconds
+      - how long to keep retrying a call that is redirected, throttled, blocked by another operation in progress or fails with a network error, in seconds
     default: 300
     aliases: []
   state:
@@ -97,6 +97,8 @@ options:
     default: 'present'
     aliases: []
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -140,25 +142,8 @@ except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-from distutils.version import LooseVersion
-from types import MethodType
 import json
 
-def _wait_for_completion(azure, promise, wait_timeout, msg):
-    if not promise: return
-    wait_timeout = time.time() + wait_timeout
-    while wait_timeout > time.time():
-        operation_result = azure.get_operation_status(promise.request_id)
-        time.sleep(5)
-        if operation_result.status == "Succeeded":
-            return
-        elif operation_result.status == "InProgress":
-            continue
-        else:
-            raise WindowsAzureError('Failed to wait for async operation ' + msg + ': [' + operation_result.error.code + '] ' + operation_result.error.message)
-
-    raise WindowsAzureError('Timed out waiting for async operation ' + msg + ' "' + str(promise.request_id) + '" to complete.')
-
 def add_data_disk(module, azure):
     """
     Adds a new or existing data disk to a virtual machine
@@ -183,9 +168,16 @@ def add_data_disk(module, azure):
     source_media_link = module.params.get('source_media_link')
     wait = module.boolean(module.params.get('wait'))
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'add_data_disk', '%s/%s/%s/%s' % (service, deployment, role, lun))
 
     media_link = u'http://%s.blob.core.windows.net/vhds/%s.vhd' % (storage_account, name)
 
+    # Attach to an add an earlier run left in flight
+    try:
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "add_data_disk")
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to wait for the pending data disk: %s" % str(e))
+
     # Check if a data disk is already attached to the deployment
     data_disk = None
     try:
@@ -195,15 +187,18 @@ def add_data_disk(module, azure):
     except WindowsAzureError as e:
         module.fail_json(msg="failed to find the data disk, error was: %s" % str(e))
 
-    if data_disk:
+    if result:
+        changed = True
+    elif data_disk:
         changed = False
     else:
         changed = True
         # Create the data disk if necessary
         try:
             result = azure.add_data_disk(service_name=service, deployment_name=deployment, role_name=role, lun=lun, host_caching=host_caching, media_link=media_link, disk_label=label, disk_name=disk_name, logical_disk_size_in_gb=size_gb, source_media_link=source_media_link)
+            journal_operation(journal_key, result)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "add_data_disk")
+                wait_for_completion(azure, result, wait_timeout, "add_data_disk", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to add a data disk: %s" % str(e))
 
@@ -211,7 +206,7 @@ def add_data_disk(module, azure):
         data_disk = None
         if (wait):
             data_disk = azure.get_data_disk(service_name=service, deployment_name=deployment, role_name=role, lun=lun)
-        return (changed, data_disk)
+        return (changed, data_disk, getattr(result, 'request_id', None))
     except WindowsAzureError as e:
         module.fail_json(msg="failed to lookup the data disk information for %s, error was: %s" % (name, str(e)))
 
@@ -235,9 +230,18 @@ def remove_data_disk(module, azure):
     delete_vhd = module.boolean(module.params.get('delete_vhd'))
     wait = module.params.get('wait')
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'delete_data_disk', '%s/%s/%s/%s' % (service, deployment, role, lun))
 
     changed = False
 
+    # Attach to a delete an earlier run left in flight
+    try:
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "delete_data_disk")
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to wait for the pending data disk deletion: %s" % str(e))
+    if result:
+        return True, None, result.request_id
+
     data_disk = None
     try:
         data_disk = azure.get_data_disk(service_name=service, deployment_name=deployment, role_name=role, lun=lun)
@@ -251,12 +255,13 @@ def remove_data_disk(module, azure):
         changed = True
         try:
             result = azure.delete_data_disk(service_name=service, deployment_name=deployment, role_name=role, lun=lun, delete_vhd=delete_vhd)
+            journal_operation(journal_key, result)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "delete_data_disk")
+                wait_for_completion(azure, result, wait_timeout, "delete_data_disk", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to delete the data disk %s, error was: %s" % (name, str(e)))
 
-    return changed, data_disk
+    return changed, data_disk, getattr(result, 'request_id', None)
 
 def get_azure_creds(module):
     # Check modul args for credentials, then check environment vars
@@ -302,14 +307,11 @@ def main():
     subscription_id, management_cert_path = get_azure_creds(module)
 
     wait_timeout_redirects = int(module.params.get('wait_timeout_redirects'))
-    if LooseVersion(windows_azure.__version__) <= "0.8.0":
-        # wrapper for handling redirects which the sdk <= 0.8.0 is not following
-        azure = Wrapper(ServiceManagementService(subscription_id, management_cert_path), wait_timeout_redirects)
-    else:
-        azure = ServiceManagementService(subscription_id, management_cert_path)
+    # retry redirects, throttling, conflicting operations and network errors
+    azure = connect_service_management(subscription_id, management_cert_path, wait_timeout_redirects)
 
     if module.params.get('state') == 'absent':
-        (changed, data_disk) = remove_data_disk(module, azure)
+        (changed, data_disk, request_id) = remove_data_disk(module, azure)
 
     elif module.params.get('state') == 'present':
         # Changed is always set to true when provisioning new instances
@@ -319,43 +321,13 @@ def main():
             module.fail_json(msg='deployment parameter is required for data disk')
         if not module.params.get('disk_name') and not module.params.get('name'):
             module.fail_json(msg='disk_name or name is required for data disk')
-        (changed, data_disk) = add_data_disk(module, azure)
-
-    module.exit_json(changed=changed, data_disk=json.loads(json.dumps(data_disk, default=lambda o: o.__dict__)))
-
-
-class Wrapper(object):
-    def __init__(self, obj, wait_timeout):
-        self.other = obj
-        self.wait_timeout = wait_timeout
-
-    def __getattr__(self, name):
-        if hasattr(self.other, name):
-            func = getattr(self.other, name)
-            return lambda *args, **kwargs: self._wrap(func, args, kwargs)
-        raise AttributeError(name)
-
-    def _wrap(self, func, args, kwargs):
-        if type(func) == MethodType:
-            result = self._handle_temporary_redirects(lambda: func(*args, **kwargs))
-        else:
-            result = self._handle_temporary_redirects(lambda: func(self.other, *args, **kwargs))
-        return result
-
-    def _handle_temporary_redirects(self, f):
-        wait_timeout = time.time() + self.wait_timeout
-        while wait_timeout > time.time():
-            try:
-                return f()
-            except WindowsAzureError as e:
-                if not str(e).lower().find("temporary redirect") == -1:
-                    time.sleep(5)
-                    pass
-                else:
-                    raise e
+        (changed, data_disk, request_id) = add_data_disk(module, azure)
+
+    module.exit_json(changed=changed, request_id=request_id, data_disk=json.loads(json.dumps(data_disk, default=lambda o: o.__dict__)))
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
 
 main()
@@ -0,0 +1,171 @@
+#!/usr/bin/python
+
+DOCUMENTATION = '''
+---
+module: azure_operation_wait
+short_description: wait for many async azure operations at once
+description:
+     - Waits for async Service Management operations started by other modules run with wait=no. All request ids are polled together in one loop, so the wait is paid once for the whole batch. This module has a dependency on python-azure >= 0.7.1
+version_added: "1.9"
+options:
+  request_ids:
+    description:
+      - list of request ids returned by other azure modules (the request_id result)
+    required: true
+    default: null
+  operation:
+    description:
+      - name of the call that started the operations (e.g. create_storage_account), used to pick how often to poll
+    required: false
+    default: null
+  max_polls_per_second:
+    description:
+      - maximum number of operation status requests this task makes per second. The limit is not shared between tasks or hosts, so several of them waiting at once can poll the subscription faster than this.
+    required: false
+    default: 4
+  subscription_id:
+    description:
+      - azure subscription id. Overrides the AZURE_SUBSCRIPTION_ID environement variable.
+    required: false
+    default: null
+  management_cert_path:
+    description:
+      - path to an azure management certificate associated with the subscription id. Overrides the AZURE_CERT_PATH environement variable.
+    required: false
+    default: null
+  wait_timeout:
+    description:
+      - how long before wait gives up, in seconds
+    default: 600
+    aliases: []
+  wait_timeout_redirects:
+    description:
+      - how long to keep retrying a call that is redirected, throttled, blocked by another operation in progress or fails with a network error, in seconds
+    default: 300
+    aliases: []
+
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
+requirements: [ "azure" ]
+author: Darren Warner
+'''
+
+EXAMPLES = '''
+# Note: None of these examples set subscription_id or management_cert_path
+# It is assumed that their matching environment variables are set.
+
+# Start creating several storage accounts without waiting
+- local_action:
+    module: azure_storage_account
+    name: "{{ item }}"
+    location: 'East US'
+    wait: no
+  with_items: storage_accounts
+  register: created
+
+# Wait for all of them together
+- local_action:
+    module: azure_operation_wait
+    request_ids: "{{ created.results | map(attribute='request_id') | select | list }}"
+    operation: create_storage_account
+    wait_timeout: 900
+'''
+
+import os
+import sys
+import time
+
+try:
+    import azure as windows_azure
+
+    from azure import WindowsAzureError, WindowsAzureMissingResourceError
+    from azure.servicemanagement import ServiceManagementService
+except ImportError as a:
+    print "failed=True msg='azure required for this module': %s" % (a)
+    sys.exit(1)
+
+import json
+
+def wait_for_request_ids(module, azure):
+    """
+    Waits for a batch of async operations
+
+    module : AnsibleModule object
+    azure: authenticated azure ServiceManagementService object
+
+    Returns:
+        a result dict per request id, and whether all of them succeeded
+    """
+    request_ids = module.params.get('request_ids')
+    operation = module.params.get('operation')
+    max_polls_per_second = float(module.params.get('max_polls_per_second'))
+    wait_timeout = int(module.params.get('wait_timeout'))
+
+    # The same id can come back from several tasks; only poll it once
+    unique_ids = []
+    for request_id in request_ids:
+        if request_id and request_id not in unique_ids:
+            unique_ids.append(request_id)
+
+    try:
+        operations = wait_for_operations(azure, [(request_id, operation) for request_id in unique_ids], wait_timeout, max_polls_per_second)
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to get the operation status: %s" % str(e))
+
+    # Finished operations no longer need resuming by the modules that started them
+    clear_journaled_request_ids([o['request_id'] for o in operations if o['status'] != 'TimedOut'])
+
+    succeeded = all(o['status'] == 'Succeeded' for o in operations)
+    return (operations, succeeded)
+
+def get_azure_creds(module):
+    # Check modul args for credentials, then check environment vars
+    subscription_id = module.params.get('subscription_id')
+    if not subscription_id:
+        subscription_id = os.environ.get('AZURE_SUBSCRIPTION_ID', None)
+    if not subscription_id:
+        module.fail_json(msg="No subscription_id provided. Please set 'AZURE_SUBSCRIPTION_ID' or use the 'subscription_id' parameter")
+
+    management_cert_path = module.params.get('management_cert_path')
+    if not management_cert_path:
+        management_cert_path = os.environ.get('AZURE_CERT_PATH', None)
+    if not management_cert_path:
+        module.fail_json(msg="No management_cert_path provided. Please set 'AZURE_CERT_PATH' or use the 'management_cert_path' parameter")
+
+    return subscription_id, management_cert_path
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            request_ids=dict(type='list', required=True),
+            operation=dict(),
+            max_polls_per_second=dict(default=4),
+            subscription_id=dict(no_log=True),
+            management_cert_path=dict(),
+            wait_timeout=dict(default=600),
+            wait_timeout_redirects=dict(default=300)
+        )
+    )
+    # create azure ServiceManagementService object
+    subscription_id, management_cert_path = get_azure_creds(module)
+
+    wait_timeout_redirects = int(module.params.get('wait_timeout_redirects'))
+    # retry redirects, throttling, conflicting operations and network errors
+    azure = connect_service_management(subscription_id, management_cert_path, wait_timeout_redirects)
+
+    start = time.time()
+    (operations, succeeded) = wait_for_request_ids(module, azure)
+    elapsed = round(time.time() - start, 2)
+
+    if not succeeded:
+        failed = [o['request_id'] for o in operations if o['status'] != 'Succeeded']
+        module.fail_json(msg="%d of %d operations did not succeed: %s" % (len(failed), len(operations), ', '.join(failed)), operations=operations, elapsed=elapsed)
+
+    module.exit_json(changed=False, operations=operations, elapsed=elapsed)
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+
+main()
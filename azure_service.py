@@ -47,7 +47,7 @@ options:
     aliases: []
   wait_timeout_redirects:
     description:
-      - how long before wait gives up for redirects, in seconds
+      - how long to keep retrying a call that is redirected, throttled, blocked by another operation in progress or fails with a network error, in seconds
     default: 300
     aliases: []
   state:
@@ -57,6 +57,8 @@ options:
     default: 'present'
     aliases: []
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -110,25 +112,8 @@ except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-from distutils.version import LooseVersion
-from types import MethodType
 import json
 
-def _wait_for_completion(azure, promise, wait_timeout, msg):
-    if not promise: return
-    wait_timeout = time.time() + wait_timeout
-    while wait_timeout > time.time():
-        operation_result = azure.get_operation_status(promise.request_id)
-        time.sleep(5)
-        if operation_result.status == "Succeeded":
-            return
-        elif operation_result.status == "InProgress":
-            continue
-        else:
-            raise WindowsAzureError('Failed to wait for async operation ' + msg + ': [' + operation_result.error.code + '] ' + operation_result.error.message)
-
-    raise WindowsAzureError('Timed out waiting for async operation ' + msg + ' "' + str(promise.request_id) + '" to complete.')
-
 def create_service(module, azure):
     """
     Create new service
@@ -144,26 +129,40 @@ def create_service(module, azure):
     affinity_group = module.params.get('affinity_group')
     wait = module.boolean(module.params.get('wait'))
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'create_hosted_service', name)
+
+    # Attach to a create an earlier run left in flight
+    try:
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "create_hosted_service")
+    except WindowsAzureError as e:
+        module.fail_json(msg="failed to wait for the pending service creation: %s" % str(e))
 
-    # Check if a deployment with the same name already exists
-    cloud_service_name_available = azure.check_hosted_service_name_availability(name)
-    if not cloud_service_name_available.result:
+    # Check if a service with the same name already exists
+    service = None
+    if not result:
+        known, service = snapshot_lookup(module, azure, 'hosted_services', name)
+        exists = service is not None if known else not azure.check_hosted_service_name_availability(name).result
+
+    if result:
+        changed = True
+    elif exists:
         changed = False
     else:
         changed = True
         # Create cloud service if necessary
         try:
             result = azure.create_hosted_service(service_name=name, label=name, location=location, affinity_group=affinity_group)
+            journal_operation(journal_key, result)
+            invalidate_snapshot(module, 'hosted_services', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "create_hosted_service")
+                wait_for_completion(azure, result, wait_timeout, "create_hosted_service", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to create the new service name: %s" % str(e))
 
     try:
-        service = None
-        if (wait):
+        if (wait) and not service:
             service = azure.get_hosted_service_properties(service_name=name)
-        return (changed, service)
+        return (changed, service, getattr(result, 'request_id', None))
     except WindowsAzureError as e:
         module.fail_json(msg="failed to lookup the deployment information for %s, error was: %s" % (name, str(e)))
 
@@ -183,28 +182,40 @@ def delete_service(module, azure):
     name = module.params.get('name')
     wait = module.params.get('wait')
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'delete_hosted_service', name)
 
     changed = False
 
-    service = None
+    # Attach to a delete an earlier run left in flight
     try:
-        service = service = azure.get_hosted_service_properties(service_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such service
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "delete_hosted_service")
     except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the service, error was: %s" % str(e))
+        module.fail_json(msg="failed to wait for the pending service deletion: %s" % str(e))
+    if result:
+        return True, None, result.request_id
+
+    known, service = snapshot_lookup(module, azure, 'hosted_services', name)
+    if not known:
+        try:
+            service = azure.get_hosted_service_properties(service_name=name)
+        except WindowsAzureMissingResourceError as e:
+            pass  # no such service
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to find the service, error was: %s" % str(e))
 
     # Delete service
     if service:
         changed = True
         try:
             result = azure.delete_hosted_service(service_name=name)
+            journal_operation(journal_key, result)
+            invalidate_snapshot(module, 'hosted_services', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "delete_hosted_service")
+                wait_for_completion(azure, result, wait_timeout, "delete_hosted_service", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to delete the service %s, error was: %s" % (name, str(e)))
 
-    return changed, service
+    return changed, service, getattr(result, 'request_id', None)
 
 def get_azure_creds(module):
     # Check modul args for credentials, then check environment vars
@@ -241,14 +252,11 @@ def main():
     subscription_id, management_cert_path = get_azure_creds(module)
 
     wait_timeout_redirects = int(module.params.get('wait_timeout_redirects'))
-    if LooseVersion(windows_azure.__version__) <= "0.8.0":
-        # wrapper for handling redirects which the sdk <= 0.8.0 is not following
-        azure = Wrapper(ServiceManagementService(subscription_id, management_cert_path), wait_timeout_redirects)
-    else:
-        azure = ServiceManagementService(subscription_id, management_cert_path)
+    # retry redirects, throttling, conflicting operations and network errors
+    azure = connect_service_management(subscription_id, management_cert_path, wait_timeout_redirects)
 
     if module.params.get('state') == 'absent':
-        (changed, service) = delete_service(module, azure)
+        (changed, service, request_id) = delete_service(module, azure)
 
     elif module.params.get('state') == 'present':
         # Changed is always set to true when provisioning new instances
@@ -256,43 +264,13 @@ def main():
             module.fail_json(msg='name parameter is required for new service')
         if not module.params.get('location') and not module.params.get('affinity_group'):
             module.fail_json(msg='location or affinity_group parameter is required for new service')
-        (changed, service) = create_service(module, azure)
-
-    module.exit_json(changed=changed, service=json.loads(json.dumps(service, default=lambda o: o.__dict__)))
-
-
-class Wrapper(object):
-    def __init__(self, obj, wait_timeout):
-        self.other = obj
-        self.wait_timeout = wait_timeout
-
-    def __getattr__(self, name):
-        if hasattr(self.other, name):
-            func = getattr(self.other, name)
-            return lambda *args, **kwargs: self._wrap(func, args, kwargs)
-        raise AttributeError(name)
-
-    def _wrap(self, func, args, kwargs):
-        if type(func) == MethodType:
-            result = self._handle_temporary_redirects(lambda: func(*args, **kwargs))
-        else:
-            result = self._handle_temporary_redirects(lambda: func(self.other, *args, **kwargs))
-        return result
-
-    def _handle_temporary_redirects(self, f):
-        wait_timeout = time.time() + self.wait_timeout
-        while wait_timeout > time.time():
-            try:
-                return f()
-            except WindowsAzureError as e:
-                if not str(e).lower().find("temporary redirect") == -1:
-                    time.sleep(5)
-                    pass
-                else:
-                    raise e
+        (changed, service, request_id) = create_service(module, azure)
+
+    module.exit_json(changed=changed, request_id=request_id, service=json.loads(json.dumps(service, default=lambda o: o.__dict__)))
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
 
 main()
@@ -62,7 +62,7 @@ options:
     aliases: []
   wait_timeout_redirects:
     description:
-      - how long before wait gives up for redirects, in seconds
+      - how long to keep retrying a call that is redirected, throttled, blocked by another operation in progress or fails with a network error, in seconds
     default: 300
     aliases: []
   state:
@@ -72,6 +72,8 @@ options:
     default: 'present'
     aliases: []
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -130,25 +132,8 @@ except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-from distutils.version import LooseVersion
-from types import MethodType
 import json
 
-def _wait_for_completion(azure, promise, wait_timeout, msg):
-    if not promise: return
-    wait_timeout = time.time() + wait_timeout
-    while wait_timeout > time.time():
-        operation_result = azure.get_operation_status(promise.request_id)
-        time.sleep(5)
-        if operation_result.status == "Succeeded":
-            return
-        elif operation_result.status == "InProgress":
-            continue
-        else:
-            raise WindowsAzureError('Failed to wait for async operation ' + msg + ': [' + operation_result.error.code + '] ' + operation_result.error.message)
-
-    raise WindowsAzureError('Timed out waiting for async operation ' + msg + ' "' + str(promise.request_id) + '" to complete.')
-
 def create_storage_account(module, azure):
     """
     Create new stroage account
@@ -167,30 +152,45 @@ def create_storage_account(module, azure):
     account_type = module.params.get('account_type')
     wait = module.boolean(module.params.get('wait'))
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'create_storage_account', name)
 
-    # Check if a storage account with the same name already exists
+    # Attach to a create an earlier run left in flight
     try:
-        storage_account = azure.check_storage_account_name_availability(name)
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "create_storage_account")
     except WindowsAzureError as e:
-        return module.fail_json(msg="failed to create the new storage account: %s" % str(e))
+        module.fail_json(msg="failed to wait for the pending storage account creation: %s" % str(e))
 
-    if not storage_account.result:
+    # Check if a storage account with the same name already exists
+    storage_account = None
+    if not result:
+        known, storage_account = snapshot_lookup(module, azure, 'storage_accounts', name)
+        exists = storage_account is not None
+        if not known:
+            try:
+                exists = not azure.check_storage_account_name_availability(name).result
+            except WindowsAzureError as e:
+                return module.fail_json(msg="failed to create the new storage account: %s" % str(e))
+
+    if result:
+        changed = True
+    elif exists:
         changed = False
     else:
         changed = True
         # Create storage account if necessary
         try:
             result = azure.create_storage_account(service_name=name, description=description if description else '', label=label if label else name, location=location, affinity_group=affinity_group, account_type=account_type)
+            journal_operation(journal_key, result)
+            invalidate_snapshot(module, 'storage_accounts', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "create_storage_account")
+                wait_for_completion(azure, result, wait_timeout, "create_storage_account", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to create the new storage account: %s" % str(e))
 
     try:
-        storage_account = None
-        if (wait):
+        if (wait) and not storage_account:
             storage_account = azure.get_storage_account_properties(service_name=name)
-        return (changed, storage_account)
+        return (changed, storage_account, getattr(result, 'request_id', None))
     except WindowsAzureError as e:
         module.fail_json(msg="failed to lookup storage account information for %s, error was: %s" % (name, str(e)))
 
@@ -210,28 +210,40 @@ def delete_storage_account(module, azure):
     name = module.params.get('name')
     wait = module.params.get('wait')
     wait_timeout = int(module.params.get('wait_timeout'))
+    journal_key = operation_journal_key(module, 'delete_storage_account', name)
 
     changed = False
 
-    storage_account = None
+    # Attach to a delete an earlier run left in flight
     try:
-        storage_account = azure.get_storage_account_properties(service_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such service
+        result = resume_journaled_operation(azure, journal_key, wait, wait_timeout, "delete_storage_account")
     except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the service, error was: %s" % str(e))
+        module.fail_json(msg="failed to wait for the pending storage account deletion: %s" % str(e))
+    if result:
+        return True, None, result.request_id
+
+    known, storage_account = snapshot_lookup(module, azure, 'storage_accounts', name)
+    if not known:
+        try:
+            storage_account = azure.get_storage_account_properties(service_name=name)
+        except WindowsAzureMissingResourceError as e:
+            pass  # no such service
+        except WindowsAzureError as e:
+            module.fail_json(msg="failed to find the service, error was: %s" % str(e))
 
     # Delete service
     if storage_account:
         changed = True
         try:
             result = azure.delete_storage_account(service_name=name)
+            journal_operation(journal_key, result)
+            invalidate_snapshot(module, 'storage_accounts', name)
             if (wait):
-                _wait_for_completion(azure, result, wait_timeout, "delete_storage_account")
+                wait_for_completion(azure, result, wait_timeout, "delete_storage_account", journal_key=journal_key)
         except WindowsAzureError as e:
             module.fail_json(msg="failed to delete the service %s, error was: %s" % (name, str(e)))
 
-    return changed, storage_account
+    return changed, storage_account, getattr(result, 'request_id', None)
 
 def get_azure_creds(module):
     # Check modul args for credentials, then check environment vars
@@ -270,14 +282,11 @@ def main():
     subscription_id, management_cert_path = get_azure_creds(module)
 
     wait_timeout_redirects = int(module.params.get('wait_timeout_redirects'))
-    if LooseVersion(windows_azure.__version__) <= "0.8.0":
-        # wrapper for handling redirects which the sdk <= 0.8.0 is not following
-        azure = Wrapper(ServiceManagementService(subscription_id, management_cert_path), wait_timeout_redirects)
-    else:
-        azure = ServiceManagementService(subscription_id, management_cert_path)
+    # retry redirects, throttling, conflicting operations and network errors
+    azure = connect_service_management(subscription_id, management_cert_path, wait_timeout_redirects)
 
     if module.params.get('state') == 'absent':
-        (changed, storage_account) = delete_storage_account(module, azure)
+        (changed, storage_account, request_id) = delete_storage_account(module, azure)
 
     elif module.params.get('state') == 'present':
         # Changed is always set to true when provisioning new instances
@@ -285,43 +294,13 @@ def main():
             module.fail_json(msg='name parameter is required for new storage account')
         if not module.params.get('location') and not module.params.get('affinity_group'):
             module.fail_json(msg='location or affinity_group parameter is required for new storage account')
-        (changed, storage_account) = create_storage_account(module, azure)
-
-    module.exit_json(changed=changed, storage_account=json.loads(json.dumps(storage_account, default=lambda o: o.__dict__)))
-
+        (changed, storage_account, request_id) = create_storage_account(module, azure)
 
-class Wrapper(object):
-    def __init__(self, obj, wait_timeout):
-        self.other = obj
-        self.wait_timeout = wait_timeout
-
-    def __getattr__(self, name):
-        if hasattr(self.other, name):
-            func = getattr(self.other, name)
-            return lambda *args, **kwargs: self._wrap(func, args, kwargs)
-        raise AttributeError(name)
-
-    def _wrap(self, func, args, kwargs):
-        if type(func) == MethodType:
-            result = self._handle_temporary_redirects(lambda: func(*args, **kwargs))
-        else:
-            result = self._handle_temporary_redirects(lambda: func(self.other, *args, **kwargs))
-        return result
-
-    def _handle_temporary_redirects(self, f):
-        wait_timeout = time.time() + self.wait_timeout
-        while wait_timeout > time.time():
-            try:
-                return f()
-            except WindowsAzureError as e:
-                if not str(e).lower().find("temporary redirect") == -1:
-                    time.sleep(5)
-                    pass
-                else:
-                    raise e
+    module.exit_json(changed=changed, request_id=request_id, storage_account=json.loads(json.dumps(storage_account, default=lambda o: o.__dict__)))
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
 
 main()
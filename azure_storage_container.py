@@ -3,21 +3,52 @@
 DOCUMENTATION = '''
 ---
 module: azure_storage_container
-short_description: create or delete a storage container in azure
+short_description: create or delete storage containers in azure
 description:
-     - Creates or deletes storage containers. This module has a dependency on python-azure >= 0.7.1
+     - Creates, updates or deletes storage containers. Given a list of containers, the account's containers are listed once (by the prefix the names have in common), with their metadata, and compared with the list locally. The ACLs of containers whose public_access or access_policies are given are read concurrently. Only the calls needed to reach the requested state are made, concurrently, so a run that changes nothing makes no writes. This module has a dependency on python-azure >= 0.7.1
 version_added: "1.9"
 options:
   name:
     description:
-      - name of the container
-    required: true
+      - name of the container. One of name or containers is required.
+    required: false
+    default: null
+  containers:
+    description:
+      - list of containers, each a name or a dict with a name and optionally public_access, metadata and state (which default to the module's own). A result is returned for each of them.
+    required: false
     default: null
   public_access:
     description:
-      - the type of access allowed
+      - the type of access allowed. An existing container's access is changed to match; private removes public access.
     required: false
     default: null
+    choices: [ "container", "blob", "private" ]
+  access_policies:
+    description:
+      - dict of stored access policies by id, each a dict of start, expiry (UTC ISO 8601 times) and permission (such as rl). The container's policies are made exactly these; an empty dict removes them all.
+    required: false
+    default: null
+  metadata:
+    description:
+      - dict of metadata the container should have. An existing container's metadata is replaced only if it differs.
+    required: false
+    default: null
+  prefix:
+    description:
+      - prefix to list the account's containers by. Defaults to the prefix the containers' names have in common.
+    required: false
+    default: null
+  exclusive:
+    description:
+      - delete the containers under prefix (which must be given) that are not in containers
+    required: false
+    default: false
+  workers:
+    description:
+      - number of containers created or deleted at once
+    required: false
+    default: 8
   account_name:
     description:
       - name of the storage account
@@ -35,6 +66,8 @@ options:
     default: 'present'
     aliases: []
 
+notes:
+  - Needs Ansible 2.3 or later, which ships the shared module_utils (azure_common and the helpers it uses) with the module. Ansible 1.9 cannot run it.
 requirements: [ "azure" ]
 author: Darren Warner
 '''
@@ -56,105 +89,315 @@ EXAMPLES = '''
     account_name: my-storage-account
     account_key: my-storage-account-key
     state: absent
+
+# Make a tenant's containers exactly these, in one task
+- local_action:
+    module: azure_storage_container
+    containers:
+      - tenant-42-uploads
+      - name: tenant-42-public
+        public_access: blob
+      - name: tenant-42-logs
+        metadata:
+          retention: 30d
+        access_policies:
+          log-readers:
+            permission: rl
+            expiry: 2027-01-01T00:00:00Z
+    prefix: tenant-42-
+    exclusive: yes
+    account_name: my-storage-account
+    account_key: my-storage-account-key
 '''
 
+import os
+import re
 import sys
 import json
+import threading
 
 try:
     import azure as windows_azure
 
     from azure import WindowsAzureError, WindowsAzureMissingResourceError
-    from azure.storage import (CloudStorageAccount)
+    from azure.storage import (CloudStorageAccount, AccessPolicy, SignedIdentifier, SignedIdentifiers)
 except ImportError as a:
     print "failed=True msg='azure required for this module': %s" % (a)
     sys.exit(1)
 
-def create_storage_container(module, azure):
-    """
-    Create a storage container
+# Older SDKs parse the body of Get Container ACL and drop its
+# x-ms-blob-public-access header, so each thread's last response headers
+# are kept by a request filter
+_last_response = threading.local()
 
-    module : AnsibleModule object
-    azure: authenticated azure BlobService object
+def remember_response(request, next):
+    response = next(request)
+    _last_response.headers = dict((k.lower(), v) for k, v in response.headers)
+    return response
 
-    Returns:
-        True if a new container was created, false otherwise
+def list_storage_containers(module, azure, prefix):
     """
-    name = module.params.get('name')
-    public_access = module.params.get('public_access')
+    Lists the account's containers under prefix, one page at a time
 
-    storage_container = None
+    Returns:
+        the containers (with their metadata) by name
+    """
+    containers = {}
+    marker = None
     try:
-        storage_container = azure.get_container_properties(container_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such container
+        while True:
+            page = azure.list_containers(prefix=prefix or None, marker=marker, include='metadata')
+            for container in page:
+                containers[container.name] = container
+            marker = page.next_marker
+            if not marker:
+                break
     except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the storage container: %s" % str(e))
+        module.fail_json(msg="failed to list the storage containers: %s" % str(e))
+    return containers
+
+def container_properties(container=None, metadata=None):
+    """
+    Returns the properties of a listed container (or of one just created
+    with metadata) in the form get_container_properties gives them
+    """
+    properties = {}
+    if container is not None:
+        etag = container.properties.etag
+        properties.update({'etag': etag if etag.startswith('"') else '"%s"' % etag,
+                           'last-modified': container.properties.last_modified})
+        metadata = container.metadata
+    for key, value in (metadata or {}).items():
+        properties['x-ms-meta-' + key] = value
+    return properties
 
-    if not storage_container:
-        changed = True
-        azure.create_container(container_name=name, x_ms_blob_public_access=public_access)
-        storage_container = azure.get_container_properties(container_name=name)
-    else:        
-        changed = False
+def desired_containers(module):
+    """
+    Returns the requested containers, each a dict of name, state,
+    public_access, access_policies and metadata
+    """
+    defaults = dict(state=module.params.get('state'),
+                    public_access=module.params.get('public_access'),
+                    access_policies=module.params.get('access_policies'),
+                    metadata=module.params.get('metadata'))
+
+    if module.params.get('name') is not None:
+        return [dict(defaults, name=module.params.get('name'))]
 
-    return (changed, storage_container)
+    desired = []
+    for item in module.params.get('containers'):
+        if not isinstance(item, dict):
+            item = dict(name=item)
+        if not item.get('name'):
+            module.fail_json(msg="each item of containers needs a name: %s" % item)
+        if item.get('state', defaults['state']) not in ('present', 'absent'):
+            module.fail_json(msg="state of container %s must be present or absent" % item['name'])
+        if item.get('public_access') not in (None, 'container', 'blob', 'private'):
+            module.fail_json(msg="public_access of container %s must be container, blob or private" % item['name'])
+        desired.append(dict(defaults, **item))
+    return desired
 
-def delete_storage_container(module, azure):
+def normalize_time(value):
     """
-    Deletes a storage container
+    Puts an access policy time in the form the service returns it in, so
+    the two can be compared
+    """
+    if not value:
+        return None
+    value = str(value).strip()
+    if 'T' not in value:
+        value += 'T00:00:00'
+    value = re.sub(r'(Z|[+-]00:?00)$', '', value)
+    value = re.sub(r'\.0*$', '', value)
+    return value + 'Z'
+
+def normalize_policies(policies):
+    """
+    Returns access policies ({id: {start, expiry, permission}}) with their
+    times and permissions in a canonical form
+    """
+    normalized = {}
+    for policy_id, policy in (policies or {}).items():
+        policy = policy or {}
+        permission = policy.get('permission') or ''
+        normalized[str(policy_id)] = dict(start=normalize_time(policy.get('start')),
+                                          expiry=normalize_time(policy.get('expiry')),
+                                          permission=''.join(p for p in 'racwdl' if p in permission) or None)
+    return normalized
+
+def normalize_metadata(metadata):
+    # metadata names are case-insensitive
+    return dict((str(k).lower(), str(v)) for k, v in (metadata or {}).items())
+
+def get_container_acl(azure, name):
+    """
+    Returns the public access level ('container', 'blob' or 'private') and
+    access policies of a container
+    """
+    acl = azure.get_container_acl(container_name=name)
+    if hasattr(acl, 'public_access'):
+        public_access = acl.public_access
+    else:
+        public_access = getattr(_last_response, 'headers', {}).get('x-ms-blob-public-access')
+    policies = dict((i.id, dict(start=i.access_policy.start, expiry=i.access_policy.expiry, permission=i.access_policy.permission))
+                    for i in acl)
+    return (public_access or 'private', normalize_policies(policies))
+
+def set_container_acl(azure, name, public_access, policies):
+    identifiers = SignedIdentifiers()
+    for policy_id, policy in sorted(policies.items()):
+        identifier = SignedIdentifier()
+        identifier.id = policy_id
+        identifier.access_policy = AccessPolicy(start=policy['start'] or '', expiry=policy['expiry'] or '', permission=policy['permission'] or '')
+        identifiers.signed_identifiers.append(identifier)
+    azure.set_container_acl(container_name=name, signed_identifiers=identifiers,
+                            x_ms_blob_public_access=public_access if public_access != 'private' else None)
+
+def converge_storage_container(azure, container, listed):
+    """
+    Makes one container match the requested state, issuing only the
+    writes whose fields differ
+
+    container: the requested container (from desired_containers)
+    listed: the container as listed, or None if it does not exist
+
+    Returns:
+        the container's result dict
+    """
+    name = container['name']
+    if container['state'] == 'absent':
+        if listed is None:
+            return dict(changed=False, state='absent', storage_container=None)
+        deleted = azure.delete_container(container_name=name, fail_not_exist=False)
+        return dict(changed=deleted, state='absent', updated=['deleted'] if deleted else [], storage_container=container_properties(listed))
+
+    public_access = container.get('public_access')
+    policies = container.get('access_policies')
+    metadata = container.get('metadata')
+    updated = []
+
+    if listed is None:
+        created = azure.create_container(container_name=name, x_ms_meta_name_values=metadata or None,
+                                         x_ms_blob_public_access=public_access if public_access != 'private' else None,
+                                         fail_on_exist=False)
+        if created:
+            updated.append('created')
+        current_metadata = normalize_metadata(metadata) if created else None
+        properties = container_properties(metadata=metadata)
+    else:
+        current_metadata = normalize_metadata(listed.metadata)
+        properties = container_properties(listed)
+
+    # the metadata of a container someone else created meanwhile is unknown
+    if metadata is not None and current_metadata is not None and normalize_metadata(metadata) != current_metadata:
+        azure.set_container_metadata(container_name=name, x_ms_meta_name_values=metadata)
+        updated.append('metadata')
+        properties = dict((k, v) for k, v in properties.items() if not k.startswith('x-ms-meta-'))
+        properties.update(container_properties(metadata=metadata))
+
+    # Set Container ACL replaces both the public access level and the access
+    # policies, so an unmanaged one is carried over from the current ACL
+    result = dict(state='present')
+    if public_access is not None or policies is not None:
+        if 'created' in updated:
+            current = (public_access or 'private', {})
+        else:
+            current = get_container_acl(azure, name)
+        wanted = (public_access or current[0], normalize_policies(policies) if policies is not None else current[1])
+        if wanted != current:
+            set_container_acl(azure, name, wanted[0], wanted[1])
+            updated.append('acl')
+        result.update(public_access=wanted[0], access_policies=wanted[1])
+
+    result.update(changed=bool(updated), updated=updated, storage_container=properties)
+    return result
+
+def reconcile_storage_containers(module, azure):
+    """
+    Creates, updates and deletes containers to match the requested ones
 
     module : AnsibleModule object
     azure: authenticated azure BlobService object
 
     Returns:
-        True if a container was deleted
+        a result dict per container, by name
     """
+    exclusive = module.boolean(module.params.get('exclusive'))
+    workers = int(module.params.get('workers'))
 
-    name = module.params.get('name')
-
-    changed = False
+    desired = desired_containers(module)
+    prefix = module.params.get('prefix')
+    if prefix is None:
+        prefix = os.path.commonprefix([c['name'] for c in desired])
+    outside = [c['name'] for c in desired if not c['name'].startswith(prefix)]
+    if outside:
+        module.fail_json(msg="containers %s are not under prefix %s" % (', '.join(outside), prefix))
 
-    storage_container = None
-    try:
-        storage_container = azure.get_container_properties(container_name=name)
-    except WindowsAzureMissingResourceError as e:
-        pass  # no such service
-    except WindowsAzureError as e:
-        module.fail_json(msg="failed to find the storage container: %s" % str(e))
+    # The listing gives every container's metadata and properties; only
+    # containers whose ACL is managed need their ACL read as well
+    existing = list_storage_containers(module, azure, prefix)
+    items = [(c, existing.get(c['name'])) for c in desired]
+    if exclusive:
+        wanted = set(c['name'] for c in desired)
+        items.extend((dict(name=name, state='absent'), existing[name]) for name in sorted(existing) if name not in wanted)
 
-    if storage_container:
-        changed = True
-        result = azure.delete_container(container_name=name, fail_not_exist=True)
+    def converge(item):
+        container, listed = item
+        try:
+            return (container['name'], converge_storage_container(azure, container, listed))
+        except WindowsAzureError as e:
+            return (container['name'], dict(changed=False, failed=True, msg="failed to update the storage container: %s" % str(e)))
 
-    return changed, storage_container
+    return dict(run_concurrently(converge, items, workers))
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(required=True),
-            public_access=dict(choices=['container', 'blob']),
+            name=dict(),
+            containers=dict(type='list'),
+            public_access=dict(choices=['container', 'blob', 'private']),
+            access_policies=dict(type='dict'),
+            metadata=dict(type='dict'),
+            prefix=dict(),
+            exclusive=dict(type='bool', default=False),
+            workers=dict(type='int', default=8),
             account_name=dict(required=True),
             account_key=dict(required=True),
             state=dict(default='present', choices=['present', 'absent'])
         )
     )
-    
+
+    if (module.params.get('name') is None) == (module.params.get('containers') is None):
+        module.fail_json(msg="exactly one of name or containers is required")
+    if module.boolean(module.params.get('exclusive')) and module.params.get('prefix') is None:
+        module.fail_json(msg="prefix is required with exclusive, to say which containers may be deleted")
+
     account_name = module.params.get('account_name')
     account_key = module.params.get('account_key')
 
-    azure = CloudStorageAccount(account_name, account_key).create_blob_service()
+    # retry redirects, throttling and network errors over a connection pool
+    # shared by the workers.  Each worker's BlobService gets a filter that
+    # keeps the response headers older SDKs drop (which bypasses the broker).
+    azure = connect_blob_service(account_name, account_key, pool_size=module.params.get('workers'), filter=remember_response)
 
-    if module.params.get('state') == 'absent':
-        (changed, storage_container) = delete_storage_container(module, azure)
+    results = reconcile_storage_containers(module, azure)
+    changed = any(r['changed'] for r in results.values())
+    result = dict(changed=changed, containers=results)
+
+    name = module.params.get('name')
+    if name is not None:
+        result['storage_container'] = json.loads(json.dumps(results[name].get('storage_container'), default=lambda o: o.__dict__))
 
-    elif module.params.get('state') == 'present':
-        (changed, storage_container) = create_storage_container(module, azure)
+    failed = sorted(n for n, r in results.items() if r.get('failed'))
+    if failed:
+        module.fail_json(msg="failed to reconcile %d of %d storage containers: %s" % (len(failed), len(results), ', '.join('%s (%s)' % (n, results[n]['msg']) for n in failed)), **result)
 
-    module.exit_json(changed=changed, storage_container=json.loads(json.dumps(storage_container, default=lambda o: o.__dict__)))
+    module.exit_json(**result)
 
 
 # import module snippets
 from ansible.module_utils.basic import *
+from ansible.module_utils.azure_common import *
+from ansible.module_utils.azure_transfer import *
 
 main()
@@ -0,0 +1,240 @@
+# Optional controller-side broker for azure calls.
+#
+# Every module run normally builds its own ServiceManagementService or
+# BlobService, paying for a new interpreter, SDK import and TLS handshake
+# each time.  The broker is a long-lived local process that keeps a
+# pooled keep-alive HTTP session (where the SDK supports it) per subscription
+# and storage account, authenticated clients on it, and a short-lived cache
+# of read calls.  Modules talk to it over a Unix socket and fall back
+# to calling azure directly when no broker is running.
+
+import cPickle as pickle
+import os
+import socket
+import SocketServer
+import struct
+import threading
+import time
+
+BROKER_SOCKET_PATH = os.environ.get('AZURE_BROKER_SOCKET',
+                                    os.path.expanduser('~/.ansible/azure_broker.sock'))
+BROKER_IDLE_TIMEOUT = 1800
+BROKER_CACHE_TTL = 10
+
+# Read calls whose results may be served from the broker's cache.  Calls
+# that change something (anything that is not a read) drop the cache of
+# their subscription or storage account.
+_CACHEABLE_PREFIXES = ('get_', 'list_', 'check_')
+_UNCACHEABLE_CALLS = ('get_operation_status', 'get_blob', 'get_blob_to_path', 'get_blob_to_file',
+                      'get_blob_to_bytes', 'get_blob_to_text', 'get_blob_properties', 'get_blob_metadata',
+                      'get_block_list', 'get_page_ranges')
+
+
+def _send_message(sock, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('broker connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv_message(sock):
+    size = struct.unpack('!I', _recv_exactly(sock, 4))[0]
+    return pickle.loads(_recv_exactly(sock, size))
+
+
+def connect_broker(socket_path=None):
+    """
+    Returns a socket connected to a running broker, or None
+    """
+    socket_path = socket_path or BROKER_SOCKET_PATH
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+class BrokerProxy(object):
+    """
+    Stands in for a ServiceManagementService or BlobService, forwarding
+    each call to the broker
+
+    Each thread gets its own connection to the broker (sock is the calling
+    thread's; others connect to socket_path), so concurrent callers are not
+    queued behind one another.
+
+    kind: 'service_management' or 'blob'
+    credentials: (subscription_id, management_cert_path) or (account_name, account_key)
+    """
+    def __init__(self, sock, kind, credentials, socket_path=None):
+        self.kind = kind
+        self.credentials = credentials
+        self.socket_path = socket_path
+        self.local = threading.local()
+        self.local.sock = sock
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, args, kwargs)
+
+    def _socket(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock is None:
+            sock = connect_broker(self.socket_path)
+            if sock is None:
+                raise socket.error('the azure broker is no longer running')
+            self.local.sock = sock
+        return sock
+
+    def _call(self, name, args, kwargs):
+        sock = self._socket()
+        _send_message(sock, (self.kind, self.credentials, name, args, kwargs))
+        ok, result = _recv_message(sock)
+        if not ok:
+            raise result
+        return result
+
+
+class _BrokerClients(object):
+    """
+    The broker's sessions, clients and read caches: one session and cache
+    per credential set, and one client on that session per thread (the
+    SDK's clients keep the last response on themselves, so they cannot be
+    shared between threads)
+    """
+    def __init__(self, cache_ttl):
+        self.cache_ttl = cache_ttl
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.caches = {}
+
+    def client(self, kind, credentials):
+        key = (kind,) + tuple(credentials)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = (_create_session(kind, credentials), threading.local())
+                self.caches[key] = {}
+            session, local = self.clients[key]
+        if getattr(local, 'client', None) is None:
+            local.client = _create_client(kind, credentials, session)
+        return key, local.client
+
+    def call(self, kind, credentials, name, args, kwargs):
+        key, client = self.client(kind, credentials)
+        read = name.startswith(_CACHEABLE_PREFIXES)
+        cacheable = read and name not in _UNCACHEABLE_CALLS
+        if cacheable:
+            cache_key = (name, pickle.dumps((args, sorted(kwargs.items()))))
+            with self.lock:
+                cached = self.caches[key].get(cache_key)
+            if cached and time.time() - cached[0] < self.cache_ttl:
+                return cached[1]
+        elif not read:
+            with self.lock:
+                self.caches[key].clear()
+
+        # errors go back to the module with their status and headers, for
+        # its retries to classify
+        from ansible.module_utils.azure_common import call_with_error_response
+        result = call_with_error_response(lambda: getattr(client, name)(*args, **kwargs))
+        if cacheable:
+            with self.lock:
+                self.caches[key][cache_key] = (time.time(), result)
+        return result
+
+
+def _create_session(kind, credentials):
+    try:
+        import requests
+    except ImportError:
+        return None
+    session = requests.Session()
+    if kind == 'service_management':
+        session.cert = credentials[1]
+    return session
+
+
+def _create_client(kind, credentials, session):
+    # imported here, as azure_common imports this module
+    from ansible.module_utils.azure_common import capture_error_responses
+
+    if kind == 'service_management':
+        from azure.servicemanagement import ServiceManagementService
+        subscription_id, management_cert_path = credentials
+        if session is not None:
+            try:
+                return ServiceManagementService(subscription_id, management_cert_path, request_session=session).with_filter(capture_error_responses)
+            except TypeError:
+                pass    # SDK too old to take a session
+        return ServiceManagementService(subscription_id, management_cert_path).with_filter(capture_error_responses)
+
+    from azure.storage import CloudStorageAccount
+    account_name, account_key = credentials
+    blob_service = CloudStorageAccount(account_name, account_key).create_blob_service().with_filter(capture_error_responses)
+    if session is not None and hasattr(blob_service, '_httpclient'):
+        blob_service._httpclient.request_session = session
+    return blob_service
+
+
+class _BrokerHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                kind, credentials, name, args, kwargs = _recv_message(self.request)
+            except EOFError:
+                return
+            self.server.last_request = time.time()
+            try:
+                reply = (True, self.server.clients.call(kind, credentials, name, args, kwargs))
+            except Exception as e:
+                reply = (False, e)
+            try:
+                _send_message(self.request, reply)
+            except pickle.PicklingError as e:
+                _send_message(self.request, (False, RuntimeError('broker could not return %s: %s' % (name, e))))
+
+
+class _BrokerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_broker(socket_path=None, idle_timeout=BROKER_IDLE_TIMEOUT, cache_ttl=BROKER_CACHE_TTL):
+    """
+    Runs the broker until it has been idle for idle_timeout seconds
+    """
+    socket_path = socket_path or BROKER_SOCKET_PATH
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    elif not os.path.isdir(os.path.dirname(socket_path)):
+        os.makedirs(os.path.dirname(socket_path))
+
+    old_umask = os.umask(0o077)     # the socket hands out authenticated clients
+    try:
+        server = _BrokerServer(socket_path, _BrokerHandler)
+    finally:
+        os.umask(old_umask)
+    server.clients = _BrokerClients(cache_ttl)
+    server.last_request = time.time()
+    server.timeout = 5
+
+    try:
+        while time.time() - server.last_request < idle_timeout and os.path.exists(socket_path):
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
@@ -0,0 +1,764 @@
+# Helpers shared by the azure modules in this repo.
+#
+# Modules pull these in next to the standard snippet import:
+#
+#   from ansible.module_utils.basic import *
+#   from ansible.module_utils.azure_common import *
+
+import errno
+import fcntl
+import httplib
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from ansible.module_utils.azure_broker import BROKER_SOCKET_PATH, BrokerProxy, connect_broker
+
+try:
+    from azure import WindowsAzureError, WindowsAzureConflictError, WindowsAzureMissingResourceError
+except ImportError:
+    from azure.common import AzureException as WindowsAzureError
+    from azure.common import AzureConflictHttpError as WindowsAzureConflictError
+    from azure.common import AzureMissingResourceHttpError as WindowsAzureMissingResourceError
+
+# Poll schedules for async Service Management operations, keyed by the name
+# of the call that returned the request id.  Each entry is
+# (first_delay, max_delay, backoff_factor) in seconds.  Cheap operations are
+# polled quickly; deployments take minutes, so there is no point hammering
+# get_operation_status for them.
+OPERATION_POLL_SCHEDULES = {
+    'default': (1.0, 10.0, 1.5),
+    'add_service_certificate': (0.5, 2.0, 1.5),
+    'create_hosted_service': (0.5, 3.0, 1.5),
+    'delete_hosted_service': (1.0, 5.0, 1.5),
+    'create_affinity_group': (0.5, 3.0, 1.5),
+    'delete_affinity_group': (0.5, 3.0, 1.5),
+    'create_reserved_ip_address': (1.0, 5.0, 1.5),
+    'delete_reserved_ip_address': (1.0, 5.0, 1.5),
+    'create_storage_account': (2.0, 10.0, 1.5),
+    'delete_storage_account': (2.0, 10.0, 1.5),
+    'add_data_disk': (2.0, 10.0, 1.5),
+    'delete_data_disk': (2.0, 10.0, 1.5),
+    'delete_deployment': (3.0, 15.0, 1.5),
+    'create_virtual_machine_deployment': (5.0, 20.0, 1.5),
+}
+
+# Fraction of each delay that is randomised so that many forks polling the
+# same subscription do not fall into lockstep.
+POLL_JITTER = 0.2
+
+
+def poll_intervals(operation, schedule=None):
+    """
+    Yields the delays to sleep between successive polls of an operation
+
+    operation: name of the call that started the operation
+    schedule: optional (first_delay, max_delay, backoff_factor) override
+    """
+    if not schedule:
+        schedule = OPERATION_POLL_SCHEDULES.get(operation, OPERATION_POLL_SCHEDULES['default'])
+    delay, max_delay, factor = schedule
+    while True:
+        yield delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        delay = min(delay * factor, max_delay)
+
+
+def wait_for_completion(azure, promise, wait_timeout, msg, schedule=None, journal_key=None):
+    """
+    Waits for an async Service Management operation to finish
+
+    azure: authenticated azure ServiceManagementService object
+    promise: result of the call that started the operation (may be None)
+    wait_timeout: how long to wait, in seconds
+    msg: name of the call that started the operation, used to pick a poll schedule
+    journal_key: operation journal entry to clear once the operation has finished
+
+    Returns as soon as get_operation_status reports "Succeeded".  Raises
+    WindowsAzureError if the operation fails or wait_timeout expires.  On a
+    timeout the journal entry is kept so that the next run can resume.
+    """
+    if not promise: return
+    deadline = time.time() + wait_timeout
+    for delay in poll_intervals(msg, schedule):
+        operation_result = azure.get_operation_status(promise.request_id)
+        if operation_result.status == "Succeeded":
+            if journal_key:
+                clear_journaled_operation(journal_key)
+            return operation_result
+        elif operation_result.status != "InProgress":
+            if journal_key:
+                clear_journaled_operation(journal_key)
+            raise WindowsAzureError('Failed to wait for async operation ' + msg + ': [' + operation_result.error.code + '] ' + operation_result.error.message)
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+
+    raise WindowsAzureError('Timed out waiting for async operation ' + msg + ' "' + str(promise.request_id) + '" to complete.')
+
+
+def wait_for_operations(azure, operations, wait_timeout, max_polls_per_second=None):
+    """
+    Waits for many async Service Management operations in a single loop
+
+    azure: authenticated azure ServiceManagementService object
+    operations: list of (request_id, operation name) tuples; the name picks the poll schedule
+    wait_timeout: how long to wait for all of them, in seconds
+    max_polls_per_second: cap on get_operation_status calls made by this process
+
+    Each operation is polled on its own schedule, the one due soonest first.
+    Operations still running when wait_timeout expires are reported as
+    "TimedOut" rather than raising, so the caller sees every outcome.
+
+    Returns:
+        a list of result dicts, in the order the operations were given
+    """
+    start = time.time()
+    deadline = start + wait_timeout
+    min_gap = 1.0 / max_polls_per_second if max_polls_per_second else 0
+    last_poll = 0
+
+    results = []
+    pending = []
+    for request_id, operation in operations:
+        result = dict(request_id=request_id, operation=operation, status='InProgress',
+                      error_code=None, error_message=None, polls=0, elapsed=None)
+        results.append(result)
+        # the first poll of every operation is due immediately
+        pending.append([start, result, poll_intervals(operation or 'default')])
+
+    while pending:
+        pending.sort(key=lambda p: p[0])
+        entry = pending[0]
+        due, result, intervals = entry
+        now = time.time()
+        wake = max(due, last_poll + min_gap)
+        if wake >= deadline:
+            break
+        if wake > now:
+            time.sleep(wake - now)
+
+        last_poll = time.time()
+        operation_result = azure.get_operation_status(result['request_id'])
+        result['polls'] += 1
+        if operation_result.status == "InProgress":
+            entry[0] = time.time() + next(intervals)
+            continue
+
+        result['status'] = operation_result.status
+        result['elapsed'] = round(time.time() - start, 2)
+        if operation_result.status != "Succeeded" and operation_result.error:
+            result['error_code'] = operation_result.error.code
+            result['error_message'] = operation_result.error.message
+        pending.pop(0)
+
+    for due, result, intervals in pending:
+        result['status'] = 'TimedOut'
+        result['elapsed'] = round(time.time() - start, 2)
+
+    return results
+
+
+# In-flight operations are journaled so that a run which times out (or is
+# interrupted) can pick up the same request id next time instead of issuing
+# the call again.  Entries are keyed by subscription, operation and resource
+# name; Azure only keeps operation status for a while, so old ones are ignored.
+OPERATION_JOURNAL_PATH = os.environ.get('AZURE_OPERATION_JOURNAL',
+                                        os.path.expanduser('~/.ansible/azure_operation_journal.json'))
+OPERATION_JOURNAL_MAX_AGE = 48 * 60 * 60
+
+# Operations that undo each other.  Starting one forgets any journaled
+# entry for the other on the same resource, which no longer says anything
+# about its state.
+OPPOSITE_OPERATIONS = {
+    'create_hosted_service': 'delete_hosted_service',
+    'create_storage_account': 'delete_storage_account',
+    'create_reserved_ip_address': 'delete_reserved_ip_address',
+    'create_affinity_group': 'delete_affinity_group',
+    'add_data_disk': 'delete_data_disk',
+    'create_virtual_machine_deployment': 'delete_deployment',
+}
+OPPOSITE_OPERATIONS.update(dict((v, k) for k, v in OPPOSITE_OPERATIONS.items()))
+
+
+class OperationRef(object):
+    """Stands in for the result of an async call when only the request id is known"""
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+
+def operation_journal_key(module, operation, name):
+    """
+    Returns the journal key for an operation on a named resource
+    """
+    subscription_id = module.params.get('subscription_id') or os.environ.get('AZURE_SUBSCRIPTION_ID', '')
+    return '%s/%s/%s' % (subscription_id, operation, name)
+
+
+def read_json_file(path, default=None):
+    """
+    Returns the contents of a JSON state file, or default if it is missing or unreadable
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {} if default is None else default
+
+
+def update_json_file(path, update):
+    """
+    Applies update(contents) to a JSON state file while holding its lock
+
+    Forks run concurrently on the controller, so the file is locked for the
+    whole read-modify-write and replaced atomically.
+
+    Returns:
+        whatever update returned
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    lock = open(path + '.lock', 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        contents = read_json_file(path)
+        result = update(contents)
+        write_json_file(path, contents)
+        return result
+    finally:
+        lock.close()
+
+
+def write_json_file(path, contents):
+    """
+    Replaces a JSON state file atomically
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(contents, f)
+    os.rename(tmp_path, path)
+
+
+def _update_operation_journal(update):
+    def expire(entries):
+        result = update(entries)
+        now = time.time()
+        for key in [k for k, v in entries.items() if now - v['started'] > OPERATION_JOURNAL_MAX_AGE]:
+            del entries[key]
+        return result
+    return update_json_file(OPERATION_JOURNAL_PATH, expire)
+
+
+def journal_operation(key, promise):
+    """
+    Records the request id of an operation that has been started, and
+    forgets the opposite operation on the same resource
+    """
+    if not promise: return
+    subscription_id, operation, name = key.split('/', 2)
+    opposite = OPPOSITE_OPERATIONS.get(operation)
+
+    def update(entries):
+        entries[key] = dict(request_id=promise.request_id, started=time.time())
+        if opposite:
+            entries.pop('%s/%s/%s' % (subscription_id, opposite, name), None)
+    _update_operation_journal(update)
+
+
+def clear_journaled_operation(key):
+    """
+    Forgets a journaled operation once it has finished
+    """
+    def update(entries):
+        entries.pop(key, None)
+    _update_operation_journal(update)
+
+
+def clear_journaled_request_ids(request_ids):
+    """
+    Forgets any journaled operations with the given request ids
+    """
+    def update(entries):
+        for key in [k for k, v in entries.items() if v['request_id'] in request_ids]:
+            del entries[key]
+    _update_operation_journal(update)
+
+
+def journaled_request_id(key):
+    """
+    Returns the request id journaled under key, or None
+    """
+    entry = read_json_file(OPERATION_JOURNAL_PATH).get(key)
+    if not entry or time.time() - entry['started'] > OPERATION_JOURNAL_MAX_AGE:
+        return None
+    return entry['request_id']
+
+
+def resume_journaled_operation(azure, key, wait, wait_timeout, msg):
+    """
+    Attaches to an operation an earlier run left in flight
+
+    azure: authenticated azure ServiceManagementService object
+    key: journal key from operation_journal_key
+    wait: whether to wait for the operation to finish
+    wait_timeout: how long to wait, in seconds
+    msg: name of the call that started the operation
+
+    Returns:
+        an OperationRef if a journaled operation is still running (and wait
+        is not set) or this call waited for it to succeed; None if there is
+        nothing to resume, in which case the caller should check the
+        resource as usual.  An operation that had already finished says
+        nothing about the resource now (it may have been changed out of
+        band since), so its entry is just cleared.
+    """
+    request_id = journaled_request_id(key)
+    if not request_id:
+        return None
+
+    try:
+        operation_result = azure.get_operation_status(request_id)
+    except WindowsAzureError:
+        # Azure no longer knows about the operation
+        clear_journaled_operation(key)
+        return None
+
+    promise = OperationRef(request_id)
+    if operation_result.status == "InProgress":
+        if not wait:
+            return promise
+        try:
+            wait_for_completion(azure, promise, wait_timeout, msg, journal_key=key)
+        except WindowsAzureError:
+            if journaled_request_id(key):
+                raise   # timed out again; keep the entry for the next run
+            return None
+        return promise
+
+    clear_journaled_operation(key)
+    return None
+
+
+# Calls that fail for reasons that go away by themselves are retried with
+# jittered exponential backoff until the call's time budget runs out.
+RETRY_FIRST_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_TIME_BUDGET = 300
+
+_THROTTLED_MESSAGES = ('too many requests', 'service unavailable', 'server busy', 'serverbusy')
+_TRANSIENT_MESSAGES = ('internal server error', 'bad gateway', 'gateway timeout', 'operation timed out', 'operationtimedout')
+_IN_PROGRESS_MESSAGES = ('currently performing an operation', 'operation in progress', 'operation is in progress')
+
+# Calls that may be repeated after a network or server error, which can
+# happen after the service has acted on them.  Other calls (creating
+# deployments, putting blobs, acquiring a lease without proposing its id)
+# are only retried when the service turned them away: redirects,
+# throttling and in-progress conflicts.
+IDEMPOTENT_CALL_PREFIXES = ('get_', 'list_', 'check_', 'set_', 'put_block', 'put_page')
+
+# The SDKs turn an HTTP error into an exception that carries nothing but a
+# message, often just the status reason.  A request filter on every client
+# keeps the calling thread's last error response, which is then attached
+# to the exception raised for it as status_code, headers and body.
+_error_response = threading.local()
+
+
+def capture_error_responses(request, next):
+    """
+    Request filter (for the SDK's with_filter) that keeps the status,
+    headers and body of the error response a call fails with
+    """
+    try:
+        return next(request)
+    except Exception as e:
+        if getattr(e, 'status', None) is not None:
+            headers = dict((k.lower(), v) for k, v in getattr(e, 'respheader', None) or [])
+            _error_response.value = (e.status, headers, getattr(e, 'respbody', None))
+        raise
+
+
+def call_with_error_response(f):
+    """
+    Calls f(), giving any SDK error it raises the status_code, headers and
+    body of the error response captured for it (unless it has them)
+    """
+    _error_response.value = None
+    try:
+        return f()
+    except WindowsAzureError as e:
+        response = _error_response.value
+        if response:
+            for attr, value in zip(('status_code', 'headers', 'body'), response):
+                if getattr(e, attr, None) is None:
+                    setattr(e, attr, value)
+        raise
+    finally:
+        _error_response.value = None
+
+
+def idempotent_call(name, kwargs):
+    """
+    Says whether an SDK call may safely be repeated if it is not known
+    whether it took effect
+    """
+    if name.startswith(IDEMPOTENT_CALL_PREFIXES):
+        return True
+    if name == 'lease_blob':
+        return kwargs.get('x_ms_lease_action') != 'acquire' or bool(kwargs.get('x_ms_proposed_lease_id'))
+    return False
+
+
+def classify_azure_error(e):
+    """
+    Says whether an exception from an SDK call is worth retrying
+
+    Errors are classified by the status_code and body attached by
+    call_with_error_response where there are any, otherwise by message.
+
+    Returns:
+        'redirect', 'throttled', 'conflict' (another operation holds the
+        resource) or 'transient' (network or server hiccup); None if the
+        error should be raised straight away
+    """
+    if isinstance(e, (socket.error, httplib.HTTPException)):
+        return 'transient'
+    if not isinstance(e, WindowsAzureError):
+        return None
+
+    status = getattr(e, 'status_code', None)
+    body = getattr(e, 'body', None) or ''
+    if not isinstance(body, basestring):
+        body = str(body)
+    message = ('%s %s' % (e, body)).lower()
+    if status == 307 or 'temporary redirect' in message:
+        return 'redirect'
+    if status in (429, 503) or any(m in message for m in _THROTTLED_MESSAGES):
+        return 'throttled'
+    if (status == 409 or isinstance(e, WindowsAzureConflictError)) and any(m in message for m in _IN_PROGRESS_MESSAGES):
+        return 'conflict'
+    if status in (500, 502, 504) or any(m in message for m in _TRANSIENT_MESSAGES):
+        return 'transient'
+    return None
+
+
+def retry_after(e):
+    """
+    Returns the Retry-After delay the service sent with an error, if any
+    """
+    headers = getattr(e, 'headers', None) or {}
+    if not hasattr(headers, 'items'):
+        headers = dict(headers)
+    for name, value in headers.items():
+        if name.lower() == 'retry-after':
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def call_with_retries(f, time_budget=RETRY_TIME_BUDGET, idempotent=True):
+    """
+    Calls f(), retrying redirects, throttling, in-progress conflicts and
+    (if idempotent) transient network errors until time_budget seconds
+    have passed
+
+    The last error is raised once the budget is spent.
+    """
+    deadline = time.time() + time_budget
+    delay = RETRY_FIRST_DELAY
+    while True:
+        try:
+            return call_with_error_response(f)
+        except Exception as e:
+            kind = classify_azure_error(e)
+            if not kind or (kind == 'transient' and not idempotent):
+                raise
+            wait = retry_after(e)
+            if wait is None:
+                wait = delay * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            if time.time() + wait > deadline:
+                raise
+            time.sleep(wait)
+            delay = min(delay * 2, RETRY_MAX_DELAY)
+
+
+class RetryWrapper(object):
+    """
+    Wraps a ServiceManagementService or BlobService so that every call goes
+    through call_with_retries
+    """
+    def __init__(self, obj, time_budget=RETRY_TIME_BUDGET):
+        self.other = obj
+        self.time_budget = time_budget
+
+    def __getattr__(self, name):
+        attr = getattr(self.other, name)
+        if not callable(attr):
+            return attr
+        return lambda *args, **kwargs: call_with_retries(lambda: attr(*args, **kwargs), self.time_budget, idempotent_call(name, kwargs))
+
+
+def connect_service_management(subscription_id, management_cert_path, time_budget=RETRY_TIME_BUDGET):
+    """
+    Returns a retrying ServiceManagementService, routed through the broker
+    when one is running
+    """
+    sock = connect_broker()
+    if sock:
+        service = BrokerProxy(sock, 'service_management', (subscription_id, management_cert_path), BROKER_SOCKET_PATH)
+    else:
+        from azure.servicemanagement import ServiceManagementService
+        service = ServiceManagementService(subscription_id, management_cert_path).with_filter(capture_error_responses)
+    return RetryWrapper(service, time_budget)
+
+
+class PerThreadService(object):
+    """
+    Stands in for an SDK client, making one with factory() for each thread
+    that uses it
+
+    The SDK's HTTP client keeps the status and headers of the last response
+    on itself, so one client cannot serve several threads at once.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.factory()
+        return getattr(client, name)
+
+
+def pooled_session(pool_size):
+    """
+    Returns a requests session keeping up to pool_size keep-alive
+    connections per host, or None if requests is not installed
+    """
+    try:
+        import requests
+    except ImportError:
+        return None
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def connect_blob_service(account_name, account_key, time_budget=RETRY_TIME_BUDGET, use_broker=True, pool_size=1, filter=None):
+    """
+    Returns a retrying BlobService, routed through the broker when one is
+    running (and use_broker is set)
+
+    Connected directly, each thread calling it gets its own BlobService, all
+    sharing one session of pool_size keep-alive connections.  filter is
+    passed to their with_filter; the broker is not used when one is given.
+    """
+    sock = connect_broker() if use_broker and filter is None else None
+    if sock:
+        return RetryWrapper(BrokerProxy(sock, 'blob', (account_name, account_key), BROKER_SOCKET_PATH), time_budget)
+
+    from azure.storage import CloudStorageAccount
+    session = pooled_session(pool_size)
+
+    def create():
+        service = CloudStorageAccount(account_name, account_key).create_blob_service()
+        if filter is not None:
+            service = service.with_filter(filter)
+        service = service.with_filter(capture_error_responses)
+        httpclient = getattr(service, '_httpclient', None)
+        if session is not None and hasattr(httpclient, 'request_session'):
+            httpclient.request_session = session
+        return service
+    return RetryWrapper(PerThreadService(create), time_budget)
+
+
+def daemonize(target, *args):
+    """
+    Runs target(*args) in a detached process that outlives the module
+
+    Returns:
+        the pid of the detached process
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(w)
+        daemon_pid = int(os.read(r, 32) or 0)
+        os.close(r)
+        os.waitpid(pid, 0)
+        return daemon_pid
+
+    # first child: start a new session and fork again so the daemon can
+    # never reacquire a terminal, then report the daemon's pid
+    os.close(r)
+    os.setsid()
+    pid = os.fork()
+    if pid:
+        os.write(w, str(pid))
+        os._exit(0)
+
+    os.close(w)
+    os.chdir('/')
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        target(*args)
+    finally:
+        os._exit(0)
+
+
+# A snapshot of the subscription's inventory lets idempotency checks be
+# answered from a handful of list calls shared by every task, instead of a
+# GET per resource per host.  Resources a module changes are marked stale
+# so that later checks on them go back to azure until the next snapshot.
+SNAPSHOT_DIR = os.environ.get('AZURE_SNAPSHOT_DIR', os.path.expanduser('~/.ansible/azure_snapshot'))
+SNAPSHOT_TTL = int(os.environ.get('AZURE_SNAPSHOT_TTL', 120))
+
+# kind: (list call, attribute holding the resource name)
+SNAPSHOT_KINDS = {
+    'hosted_services': ('list_hosted_services', 'service_name'),
+    'storage_accounts': ('list_storage_accounts', 'service_name'),
+    'affinity_groups': ('list_affinity_groups', 'name'),
+    'reserved_ip_addresses': ('list_reserved_ip_addresses', 'name'),
+}
+
+
+def to_dict(obj):
+    """
+    Converts an SDK result into plain dicts and lists, as returned to Ansible
+    """
+    return json.loads(json.dumps(obj, default=lambda o: o.__dict__))
+
+
+def _snapshot_path(module):
+    subscription_id = module.params.get('subscription_id') or os.environ.get('AZURE_SUBSCRIPTION_ID', '')
+    return os.path.join(SNAPSHOT_DIR, '%s.json' % subscription_id)
+
+
+def _snapshot_fresh(snapshot):
+    return bool(snapshot) and time.time() - snapshot['taken'] < SNAPSHOT_TTL
+
+
+def _take_snapshot(azure):
+    resources = {}
+    for kind, (call, name_attr) in SNAPSHOT_KINDS.items():
+        try:
+            items = getattr(azure, call)()
+        except (AttributeError, WindowsAzureError):
+            continue    # checks of this kind will go to azure instead
+        resources[kind] = dict((getattr(item, name_attr), to_dict(item)) for item in items)
+    return resources
+
+
+def snapshot_lookup(module, azure, kind, name):
+    """
+    Looks a resource up in the subscription snapshot
+
+    module : AnsibleModule object
+    azure: authenticated azure ServiceManagementService object
+    kind: one of SNAPSHOT_KINDS
+    name: name of the resource
+
+    The snapshot is taken again once it is older than SNAPSHOT_TTL seconds
+    (AZURE_SNAPSHOT_TTL; 0 turns it off).
+
+    Returns:
+        (known, resource): known is False when the snapshot cannot answer
+        and the caller must ask azure; otherwise resource is the resource as
+        a dict, or None if it does not exist
+    """
+    if SNAPSHOT_TTL <= 0:
+        return (False, None)
+
+    path = _snapshot_path(module)
+    snapshot = read_json_file(path)
+    if not _snapshot_fresh(snapshot):
+        def refresh(contents):
+            # another fork may have refreshed it while we waited for the lock
+            if not _snapshot_fresh(contents):
+                contents.clear()
+                contents.update(taken=time.time(), resources=_take_snapshot(azure), stale={})
+            return dict(contents)
+        snapshot = update_json_file(path, refresh)
+
+    if kind not in snapshot['resources'] or name in snapshot['stale'].get(kind, []):
+        return (False, None)
+    return (True, snapshot['resources'][kind].get(name))
+
+
+def invalidate_snapshot(module, kind, name):
+    """
+    Marks a resource in the subscription snapshot as stale after changing it
+    """
+    if SNAPSHOT_TTL <= 0:
+        return
+
+    def update(contents):
+        if contents:
+            stale = contents.setdefault('stale', {}).setdefault(kind, [])
+            if name not in stale:
+                stale.append(name)
+    update_json_file(_snapshot_path(module), update)
+
+
+def run_concurrently(func, items, workers):
+    """
+    Calls func(item) for every item on up to workers threads
+
+    items may be a generator; it is read as workers come free, so calls
+    start while it is still producing items.
+
+    Returns:
+        the results, in the order of items.  If any call (or the generator)
+        raises, no new items are started and the first exception is
+        re-raised once the running calls have finished.
+    """
+    if hasattr(items, '__len__'):
+        workers = min(workers, len(items))
+    items = enumerate(items)
+    results = {}
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while not errors:
+            try:
+                with lock:
+                    index, item = next(items)
+            except StopIteration:
+                return
+            except Exception:
+                errors.append(sys.exc_info())
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, workers))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return [results[index] for index in xrange(len(results))]
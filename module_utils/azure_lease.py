@@ -0,0 +1,148 @@
+# Background renewal of blob leases, shared by the blob lease modules.
+#
+#   from ansible.module_utils.azure_common import *
+#   from ansible.module_utils.azure_lease import *
+#
+# A finite lease (15-60 seconds) has to be renewed for as long as it is
+# needed, and an infinite one outlives a play that dies.  A lease keeper is
+# a detached process that renews a set of leases well before they expire,
+# so that a play can hold finite leases without renewing them in its own
+# tasks.  It is controlled through a token file holding its pid and
+# leases: it releases the leases and exits when the token is removed, or
+# when the token has not been touched (the heartbeat) for heartbeat_timeout
+# seconds, so the leases of a play that died are released or expire soon.
+
+import errno
+import os
+import tempfile
+import time
+
+from ansible.module_utils.azure_common import connect_blob_service, daemonize, read_json_file, run_concurrently, write_json_file
+
+LEASE_KEEPER_DIR = os.environ.get('AZURE_LEASE_KEEPER_DIR', os.path.expanduser('~/.ansible/azure_lease_keeper'))
+LEASE_KEEPER_HEARTBEAT = 1800
+
+# Leases are renewed after this fraction of their duration, leaving time
+# for the renewal to be retried before they expire
+LEASE_RENEW_FRACTION = 1 / 3.0
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def keep_leases(account_name, account_key, container, leases, duration, token_path, heartbeat_timeout=LEASE_KEEPER_HEARTBEAT):
+    """
+    Renews leases ({blob name: lease id}) until token_path is removed or
+    its heartbeat expires, then releases them
+
+    A lease that fails to renew (after the retries) has been lost, and is
+    dropped.  The keeper also exits once it has no leases left.
+    """
+    interval = duration * LEASE_RENEW_FRACTION
+    # retrying for longer than the renewal interval would let leases expire
+    azure = connect_blob_service(account_name, account_key, time_budget=interval, use_broker=False)
+    leases = dict(leases)
+
+    def lease_call(action):
+        def call(item):
+            name, lease_id = item
+            try:
+                azure.lease_blob(container_name=container, blob_name=name, x_ms_lease_action=action, x_ms_lease_id=lease_id)
+                return (name, True)
+            except Exception:
+                return (name, False)
+        return call
+
+    renewed = time.time()
+    try:
+        while leases:
+            time.sleep(1)
+            try:
+                heartbeat = os.path.getmtime(token_path)
+            except OSError:
+                break
+            if heartbeat_timeout and time.time() - heartbeat > heartbeat_timeout:
+                break
+            if time.time() - renewed >= interval:
+                renewed = time.time()
+                for name, ok in run_concurrently(lease_call('renew'), leases.items(), len(leases)):
+                    if not ok:
+                        del leases[name]
+    finally:
+        if leases:
+            run_concurrently(lease_call('release'), leases.items(), len(leases))
+        if os.path.exists(token_path):
+            os.remove(token_path)
+
+
+def start_lease_keeper(account_name, account_key, container, leases, duration, heartbeat_timeout=LEASE_KEEPER_HEARTBEAT, token_path=None):
+    """
+    Starts a lease keeper for leases ({blob name: lease id})
+
+    Returns:
+        the keeper's token path and pid
+    """
+    if token_path is None:
+        if not os.path.isdir(LEASE_KEEPER_DIR):
+            os.makedirs(LEASE_KEEPER_DIR)
+        fd, token_path = tempfile.mkstemp(prefix=container + '-', suffix='.json', dir=LEASE_KEEPER_DIR)
+        os.close(fd)
+    token_path = os.path.abspath(token_path)
+
+    write_json_file(token_path, dict(container=container, leases=leases, duration=duration))
+    pid = daemonize(keep_leases, account_name, account_key, container, leases, duration, token_path, heartbeat_timeout)
+    write_json_file(token_path, dict(container=container, leases=leases, duration=duration, pid=pid))
+    return (token_path, pid)
+
+
+def lease_keeper_running(token_path):
+    """
+    Returns the token of the keeper behind token_path, or None if it is
+    not running
+    """
+    token = read_json_file(token_path)
+    if not token.get('pid') or not process_alive(token['pid']):
+        return None
+    return token
+
+
+def heartbeat_lease_keeper(token_path):
+    """
+    Tells a running keeper that its leases are still needed
+
+    Returns:
+        the keeper's token, or None if it is not running
+    """
+    token = lease_keeper_running(token_path)
+    if token:
+        os.utime(token_path, None)
+    return token
+
+
+def stop_lease_keeper(token_path, timeout=60):
+    """
+    Stops a keeper and waits for it to release its leases
+
+    Returns:
+        the keeper's token, or None if it was not running, and True if it
+        exited within timeout
+    """
+    token = lease_keeper_running(token_path)
+    try:
+        os.remove(token_path)
+    except OSError:
+        pass
+    if not token:
+        return (None, True)
+
+    deadline = time.time() + timeout
+    while process_alive(token['pid']):
+        if time.time() > deadline:
+            return (token, False)
+        time.sleep(0.2)
+    return (token, True)
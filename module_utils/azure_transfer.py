@@ -0,0 +1,938 @@
+# Helpers for moving blob data in parallel, shared by the blob modules.
+#
+#   from ansible.module_utils.azure_common import *
+#   from ansible.module_utils.azure_transfer import *
+
+import base64
+import binascii
+import collections
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+
+from ansible.module_utils.azure_common import (WindowsAzureMissingResourceError, read_json_file, run_concurrently,
+                                               update_json_file, write_json_file)
+
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The storage service takes blocks of at most 4MB
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+
+# How many times a single range is attempted before the transfer fails.
+# Throttling and network errors are already retried inside each call by
+# RetryWrapper; this covers everything else, such as short reads.
+RANGE_ATTEMPTS = 4
+
+# Page blobs are written in 512 byte pages, at most 4MB per put_page.
+# Files are checked for zeros in SCAN_SIZE windows, which is therefore the
+# smallest run of zeros a page blob upload skips.
+PAGE_SIZE = 512
+MAX_PAGE_WRITE = 4 * 1024 * 1024
+SCAN_SIZE = 64 * 1024
+
+# Metadata a page blob carries from its creation until its last page has
+# been written, so an interrupted upload is not taken for a finished one
+UPLOAD_INCOMPLETE_METADATA = 'upload_incomplete'
+
+# lseek whence values for finding the data in sparse files (Linux, Solaris)
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# Controller-side cache of downloaded blobs, used when a cache directory is
+# given to the module or set in the environment.
+BLOB_CACHE_DIR = os.environ.get('AZURE_BLOB_CACHE_DIR')
+BLOB_CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+# Linux ioctl that makes a copy-on-write clone of a file (btrfs, xfs)
+FICLONE = 0x40049409
+
+# How much downloaded data may be held in memory waiting for the ranges
+# before it to arrive so it can be hashed in order.  Ranges beyond this are
+# read back from the file instead.
+DIGEST_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+def byte_ranges(size, chunk_size):
+    """
+    Splits size bytes into inclusive (start, end) ranges of at most chunk_size bytes
+    """
+    return [(start, min(start + chunk_size, size) - 1) for start in xrange(0, size, chunk_size)]
+
+
+def retry_range(f, attempts=RANGE_ATTEMPTS):
+    """
+    Calls f(), retrying it with a short jittered backoff if it raises
+    """
+    for attempt in xrange(attempts):
+        try:
+            return f()
+        except Exception:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(min(2 ** attempt, 10) * random.uniform(0.5, 1.5))
+
+
+def blob_properties(azure, container, name, snapshot=None, lease_id=None):
+    """
+    Returns the properties (response headers) of a blob or one of its snapshots
+
+    get_blob_properties cannot address a snapshot, so a snapshot's come from
+    listing the blob's snapshots, with the keys list_blob_properties gives.
+    """
+    if not snapshot:
+        return azure.get_blob_properties(container_name=container, blob_name=name, x_ms_lease_id=lease_id)
+    for blob, properties in list_blob_properties(azure, container, name, include='snapshots'):
+        if blob.name == name and blob.snapshot == snapshot:
+            return properties
+    raise WindowsAzureMissingResourceError('snapshot %s of %s/%s not found' % (snapshot, container, name))
+
+
+def get_blob_range(azure, container, name, start, end, snapshot=None, lease_id=None):
+    """
+    Fetches the inclusive byte range start-end of a blob
+
+    Raises IOError if the service returns fewer bytes than asked for.
+    """
+    data = azure.get_blob(container_name=container, blob_name=name, snapshot=snapshot,
+                          x_ms_range='bytes=%d-%d' % (start, end), x_ms_lease_id=lease_id)
+    if len(data) != end - start + 1:
+        raise IOError('short read of %s/%s bytes %d-%d: got %d bytes' % (container, name, start, end, len(data)))
+    return data
+
+
+class RangeWriter(object):
+    """
+    Writes ranges into a file at their offsets from many threads
+    """
+    def __init__(self, path, size):
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.file.truncate(size)
+        self.lock = threading.Lock()
+
+    def write(self, offset, data):
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class OrderedDigest(object):
+    """
+    Computes the MD5 of a file from ranges that are written out of order
+
+    path: the file being written
+    ranges: every (start, end) range of the file, in order
+
+    Each range is hashed as soon as all the ranges before it have been.
+    Until then its data is kept in memory, up to buffer_size bytes; ranges
+    added without data (or past that limit) are read back from path when
+    their turn comes, so they must already be flushed to it.
+    """
+    def __init__(self, path, ranges, buffer_size=DIGEST_BUFFER_SIZE):
+        self.path = path
+        self.md5 = hashlib.md5()
+        self.ranges = ranges
+        self.buffer_size = buffer_size
+        self.position = 0
+        self.pending = {}
+        self.buffered = 0
+        self.lock = threading.Lock()
+
+    def add(self, byte_range, data=None):
+        with self.lock:
+            if data is not None and self.buffered + len(data) > self.buffer_size:
+                data = None
+            self.pending[byte_range[0]] = data
+            if data is not None:
+                self.buffered += len(data)
+            self._advance()
+
+    def _advance(self):
+        while self.position < len(self.ranges) and self.ranges[self.position][0] in self.pending:
+            start, end = self.ranges[self.position]
+            data = self.pending.pop(start)
+            if data is None:
+                with open(self.path, 'rb') as f:
+                    f.seek(start)
+                    data = f.read(end - start + 1)
+            else:
+                self.buffered -= len(data)
+            self.md5.update(data)
+            self.position += 1
+
+    def hexdigest(self):
+        if self.position != len(self.ranges):
+            raise IOError('%d of %d ranges of %s were not hashed' % (len(self.ranges) - self.position, len(self.ranges), self.path))
+        return self.md5.hexdigest()
+
+
+def download_ranges(azure, container, name, path, size, ranges, max_connections, snapshot=None, lease_id=None, on_range=None):
+    """
+    Downloads the given byte ranges of a blob into path concurrently
+
+    path is created (or resized) to size bytes; each range is fetched with
+    its own ranged GET, retried on its own, and written at its offset.
+    on_range(writer, byte_range, data) is called after each range is written.
+
+    Returns:
+        the number of bytes downloaded
+    """
+    writer = RangeWriter(path, size)
+    try:
+        def fetch(byte_range):
+            start, end = byte_range
+            data = retry_range(lambda: get_blob_range(azure, container, name, start, end, snapshot, lease_id))
+            writer.write(start, data)
+            if on_range:
+                on_range(writer, byte_range, data)
+            return len(data)
+        return sum(run_concurrently(fetch, ranges, max_connections))
+    finally:
+        writer.close()
+
+
+def download_blob(azure, container, name, dest, properties, chunk_size=DEFAULT_CHUNK_SIZE, max_connections=4, snapshot=None, lease_id=None, populated=None):
+    """
+    Downloads a whole blob to dest using parallel ranged GETs, resuming an
+    earlier interrupted download of the same blob where possible
+
+    properties: the blob's properties, from blob_properties
+    populated: for a page blob, the ranges that hold data (from
+               page_ranges).  Only those are downloaded and the rest of
+               dest is left as holes.
+
+    The data goes to dest.part, with the blob's ETag and the ranges already
+    written recorded in dest.part.json.  If a download fails, the next
+    attempt only fetches the missing ranges, provided the blob's ETag (and
+    the chunk size) have not changed.  dest.part is renamed over dest once
+    complete, so dest is never left half written.
+
+    The MD5 of the data is computed as it is written and checked against
+    the blob's Content-MD5, if it has one.  A mismatch discards the partial
+    download and raises IOError.  With populated, the MD5 is only computed
+    (from the finished file) if the blob has a Content-MD5 to check.
+
+    Returns:
+        (bytes downloaded, bytes reused from an earlier attempt, hex MD5 of
+         dest or None)
+    """
+    part_path = dest + '.part'
+    progress_path = part_path + '.json'
+    size = int(properties['content-length'])
+    etag = properties.get('etag')
+
+    progress = read_json_file(progress_path)
+    resumable = (etag and os.path.exists(part_path) and progress.get('etag') == etag
+                 and progress.get('size') == size and progress.get('chunk_size') == chunk_size)
+    if not resumable:
+        progress = dict(etag=etag, size=size, chunk_size=chunk_size, done=[])
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    done = set(progress['done'])
+    if populated is None:
+        ranges = byte_ranges(size, chunk_size)
+    else:
+        ranges = split_ranges(populated, chunk_size)
+    missing = [r for r in ranges if r[0] not in done]
+    reused = sum(end - start + 1 for start, end in ranges if start in done)
+
+    lock = threading.Lock()
+    # a sparse download's ranges do not cover the file, so it is hashed after
+    digest = OrderedDigest(part_path, ranges) if populated is None else None
+    # ranges kept from an earlier attempt are read back to be hashed
+    for byte_range in ranges:
+        if digest and byte_range[0] in done:
+            digest.add(byte_range)
+
+    def record(writer, byte_range, data):
+        # the range must be on disk before the record claims it is
+        writer.flush()
+        with lock:
+            done.add(byte_range[0])
+            progress['done'] = sorted(done)
+            write_json_file(progress_path, progress)
+        if digest:
+            digest.add(byte_range, data)
+
+    downloaded = download_ranges(azure, container, name, part_path, size, missing, max_connections, snapshot, lease_id, record)
+    content_md5 = properties.get('content-md5')
+    if digest:
+        new_md5 = digest.hexdigest()
+    elif content_md5:
+        new_md5 = file_md5(part_path)
+    else:
+        new_md5 = None
+
+    if content_md5 and hex_to_content_md5(new_md5) != content_md5:
+        os.remove(part_path)
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+        raise IOError('MD5 of the downloaded data does not match the Content-MD5 of %s/%s' % (container, name))
+
+    os.rename(part_path, dest)
+    if os.path.exists(progress_path):
+        os.remove(progress_path)
+    return (downloaded, reused, new_md5)
+
+
+def page_ranges(azure, container, name, snapshot=None, lease_id=None):
+    """
+    Returns the inclusive (start, end) ranges of a page blob that hold data
+    """
+    kwargs = dict(container_name=container, blob_name=name, x_ms_lease_id=lease_id)
+    if snapshot:
+        kwargs['snapshot'] = snapshot
+    return [(page_range.start, page_range.end) for page_range in azure.get_page_ranges(**kwargs)]
+
+
+def split_ranges(ranges, chunk_size):
+    """
+    Splits inclusive (start, end) ranges into ranges of at most chunk_size bytes
+    """
+    return [(start, min(start + chunk_size, range_end + 1) - 1)
+            for range_start, range_end in ranges
+            for start in xrange(range_start, range_end + 1, chunk_size)]
+
+
+def aligned_ranges(ranges, chunk_size):
+    """
+    Splits inclusive (start, end) ranges at every multiple of chunk_size, so
+    the same bytes always fall in the same pieces whatever the ranges were
+    """
+    pieces = []
+    for range_start, range_end in ranges:
+        start = range_start
+        while start <= range_end:
+            end = min(start - start % chunk_size + chunk_size - 1, range_end)
+            pieces.append((start, end))
+            start = end + 1
+    return pieces
+
+
+def subtract_ranges(ranges, removed):
+    """
+    Returns the parts of the inclusive (start, end) ranges not covered by removed
+    """
+    removed = sorted(removed)
+    result = []
+    for start, end in sorted(ranges):
+        for removed_start, removed_end in removed:
+            if removed_end < start or removed_start > end:
+                continue
+            if removed_start > start:
+                result.append((start, removed_start - 1))
+            start = removed_end + 1
+            if start > end:
+                break
+        if start <= end:
+            result.append((start, end))
+    return result
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def blob_sidecar_path(dest):
+    """
+    Returns the path of the hidden file recording which blob version dest holds
+    """
+    directory, filename = os.path.split(dest)
+    return os.path.join(directory, '.%s.azure.json' % filename)
+
+
+def file_identity(path):
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime, st.st_ino]
+
+
+def read_blob_sidecar(dest):
+    """
+    Returns what was recorded about dest when it was last downloaded, or
+    None if there is no record or dest has been modified since
+    """
+    if not os.path.exists(dest):
+        return None
+    record = read_json_file(blob_sidecar_path(dest))
+    if not record or record.get('identity') != file_identity(dest):
+        return None
+    return record
+
+
+def write_blob_sidecar(dest, properties, local_md5=None):
+    """
+    Records the blob version (ETag, Content-MD5) that dest now holds
+
+    local_md5: hex MD5 of dest, if known
+    """
+    write_json_file(blob_sidecar_path(dest), dict(etag=properties.get('etag'),
+                                                  content_md5=properties.get('content-md5'),
+                                                  local_md5=local_md5,
+                                                  identity=file_identity(dest)))
+
+
+def hex_to_content_md5(hex_md5):
+    """
+    Converts a hex MD5 digest to the base64 form azure uses for Content-MD5
+    """
+    return base64.b64encode(binascii.unhexlify(hex_md5))
+
+
+def local_md5(dest, md5):
+    """
+    Returns the hex MD5 of dest, or None if it does not exist
+
+    md5: function returning the hex MD5 of a file (e.g. module.md5)
+
+    The digest recorded in the sidecar is used while dest is unmodified
+    since it was recorded; otherwise dest is hashed and the digest recorded.
+    """
+    if not os.path.exists(dest):
+        return None
+    record = read_blob_sidecar(dest)
+    if record and record.get('local_md5'):
+        return record['local_md5']
+    digest = md5(dest)
+    properties = {'etag': record['etag'], 'content-md5': record['content_md5']} if record else {}
+    write_blob_sidecar(dest, properties, digest)
+    return digest
+
+
+def local_copy_current(dest, properties, md5):
+    """
+    Says whether dest already holds the blob described by properties
+
+    md5: function returning the hex MD5 of a file (e.g. module.md5)
+
+    The sidecar record answers without reading dest when the ETag matches;
+    otherwise dest is hashed (at most once) and compared to Content-MD5.
+    A match refreshes the sidecar so the next check is free.
+    """
+    if not os.path.exists(dest):
+        return False
+
+    record = read_blob_sidecar(dest)
+    if record and record['etag'] == properties.get('etag'):
+        return True
+
+    content_md5 = properties.get('content-md5')
+    if not content_md5:
+        return False
+    digest = local_md5(dest, md5)
+    if hex_to_content_md5(digest) != content_md5:
+        return False
+    write_blob_sidecar(dest, properties, digest)
+    return True
+
+
+def list_blob_properties(azure, container, prefix=None, include=None):
+    """
+    Lists the blobs in a container, one page at a time
+
+    Yields:
+        (blob, properties) for each blob, where properties has the same keys
+        as blob_properties returns, so listed blobs need no extra request
+    """
+    marker = None
+    while True:
+        blobs = azure.list_blobs(container, prefix=prefix, marker=marker, include=include)
+        for blob in blobs:
+            etag = blob.properties.etag
+            # listings give the ETag unquoted, headers give it quoted
+            if etag and not etag.startswith('"'):
+                etag = '"%s"' % etag
+            yield (blob, {'content-length': str(blob.properties.content_length),
+                          'etag': etag,
+                          'content-md5': blob.properties.content_md5 or None,
+                          'x-ms-blob-type': blob.properties.blob_type,
+                          'x-ms-lease-state': blob.properties.lease_state})
+        marker = blobs.next_marker
+        if not marker:
+            break
+
+
+def blob_dest(directory, name):
+    """
+    Returns the path under directory that a blob is downloaded to
+
+    Raises IOError if the blob's name would put it outside directory.
+    """
+    directory = os.path.abspath(directory)
+    path = os.path.abspath(os.path.join(directory, name))
+    if not path.startswith(directory + os.sep):
+        raise IOError('blob %s would be written outside %s' % (name, directory))
+    return path
+
+
+class BlobReader(object):
+    """
+    A read-only, forward-only file object over a blob
+
+    The blob is fetched in order in chunk_size ranges, with up to
+    read_ahead ranges in flight at once, so memory use stays below
+    (read_ahead + 1) * chunk_size.  The data read is hashed as it goes and
+    verify() checks it against the blob's Content-MD5.
+    """
+    def __init__(self, azure, container, name, properties, chunk_size=DEFAULT_CHUNK_SIZE, read_ahead=1, snapshot=None, lease_id=None):
+        self.fetch_range = lambda start, end: get_blob_range(azure, container, name, start, end, snapshot, lease_id)
+        self.description = '%s/%s' % (container, name)
+        self.properties = properties
+        self.ranges = iter(byte_ranges(int(properties['content-length']), chunk_size))
+        self.read_ahead = max(1, read_ahead)
+        self.pending = collections.deque()
+        self.md5 = hashlib.md5()
+        self.chunk = ''
+        self.offset = 0
+
+    def _fill(self):
+        while len(self.pending) < self.read_ahead:
+            byte_range = next(self.ranges, None)
+            if byte_range is None:
+                return
+            slot = dict(done=threading.Event())
+
+            def fetch(slot=slot, byte_range=byte_range):
+                try:
+                    slot['data'] = retry_range(lambda: self.fetch_range(*byte_range))
+                except Exception:
+                    slot['error'] = sys.exc_info()
+                slot['done'].set()
+            thread = threading.Thread(target=fetch)
+            thread.daemon = True
+            thread.start()
+            self.pending.append(slot)
+
+    def _next_chunk(self):
+        self._fill()
+        if not self.pending:
+            return ''
+        slot = self.pending.popleft()
+        slot['done'].wait()
+        if 'error' in slot:
+            raise slot['error'][0], slot['error'][1], slot['error'][2]
+        self._fill()
+        self.md5.update(slot['data'])
+        return slot['data']
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.offset == len(self.chunk):
+                self.chunk = self._next_chunk()
+                self.offset = 0
+                if not self.chunk:
+                    break
+            length = len(self.chunk) - self.offset
+            if size > 0:
+                length = min(length, size)
+                size -= length
+            parts.append(self.chunk[self.offset:self.offset + length])
+            self.offset += length
+        return ''.join(parts)
+
+    def verify(self):
+        """
+        Reads whatever is left of the blob and checks the MD5 of all of it
+
+        Returns:
+            the hex MD5 of the blob
+        """
+        while self.read(DEFAULT_CHUNK_SIZE):
+            pass
+        content_md5 = self.properties.get('content-md5')
+        if content_md5 and hex_to_content_md5(self.md5.hexdigest()) != content_md5:
+            raise IOError('MD5 of the data read does not match the Content-MD5 of %s' % self.description)
+        return self.md5.hexdigest()
+
+
+def _inside(directory, path):
+    # symlinks already on disk are followed, so a path through an extracted
+    # link is judged by where it really leads
+    directory = os.path.realpath(directory)
+    path = os.path.realpath(path)
+    return path == directory or path.startswith(directory + os.sep)
+
+
+def _escaping_link(directory):
+    # a link that was inside when it was made can lead out once the links
+    # it goes through are extracted after it
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for entry in dirnames + filenames:
+            path = os.path.join(dirpath, entry)
+            if os.path.islink(path) and not _inside(directory, path):
+                return os.path.relpath(path, directory)
+    return None
+
+
+def _merge_tree(source, target):
+    for entry in os.listdir(source):
+        source_path = os.path.join(source, entry)
+        target_path = os.path.join(target, entry)
+        source_is_dir = os.path.isdir(source_path) and not os.path.islink(source_path)
+        target_is_dir = os.path.isdir(target_path) and not os.path.islink(target_path)
+        if source_is_dir and target_is_dir:
+            _merge_tree(source_path, target_path)
+            continue
+        if target_is_dir:
+            shutil.rmtree(target_path)
+        os.rename(source_path, target_path)
+
+
+def extract_tar_stream(stream, target, verify=None):
+    """
+    Extracts a (possibly compressed) tar archive read from stream into target
+
+    The archive is read in a single forward pass, so stream need not be
+    seekable.  Members are extracted into a temporary directory next to
+    target and only moved into place once the whole archive has been read
+    and verify() (if given) has returned, so a corrupt download leaves
+    target untouched.  Members with absolute paths, or paths or links that
+    lead outside target (including through links extracted before them),
+    are refused before anything is written for them.
+
+    Returns:
+        the number of members extracted
+    """
+    target = os.path.abspath(target)
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    staging = tempfile.mkdtemp(dir=parent, prefix='.%s.' % os.path.basename(target))
+    try:
+        count = 0
+        archive = tarfile.open(fileobj=stream, mode='r|*')
+        for member in archive:
+            path = os.path.join(staging, member.name)
+            if os.path.isabs(member.name) or not _inside(staging, path):
+                raise IOError('archive member %s is outside the target directory' % member.name)
+            if member.issym() and not _inside(staging, os.path.join(os.path.dirname(path), member.linkname)):
+                raise IOError('archive member %s links outside the target directory' % member.name)
+            if member.islnk() and not _inside(staging, os.path.join(staging, member.linkname)):
+                raise IOError('archive member %s links outside the target directory' % member.name)
+            archive.extract(member, staging)
+            count += 1
+        archive.close()
+        escaping = _escaping_link(staging)
+        if escaping:
+            raise IOError('archive member %s links outside the target directory' % escaping)
+        if verify:
+            verify()
+
+        # mkdtemp makes the directory private; give it the usual permissions
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(staging, 0o777 & ~umask)
+        if os.path.isdir(target):
+            _merge_tree(staging, target)
+        else:
+            os.rename(staging, target)
+        return count
+    finally:
+        if os.path.isdir(staging):
+            shutil.rmtree(staging)
+
+
+def blob_url(account_name, container, name, snapshot=None):
+    url = 'https://%s.blob.core.windows.net/%s/%s' % (account_name, container, name)
+    if snapshot:
+        url += '?snapshot=' + snapshot
+    return url
+
+
+def place_file(source, dest):
+    """
+    Makes dest a copy of source, as cheaply as the filesystem allows
+
+    Tries a copy-on-write clone, then a hard link, then a plain copy, and
+    replaces dest atomically.
+    """
+    tmp_path = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        with open(source, 'rb') as src:
+            with open(tmp_path, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except IOError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(source, tmp_path)
+        except OSError:
+            shutil.copyfile(source, tmp_path)
+    os.rename(tmp_path, dest)
+
+
+class BlobCache(object):
+    """
+    A cache of downloaded blobs on the controller, shared by all forks
+
+    Entries are named by a hash of the blob's URL, ETag and Content-MD5, so
+    a changed blob is never served from the cache.  Each entry has its own
+    lock file, so forks fetching the same blob wait for one download rather
+    than all making it.  The index (last use and size of each entry) is kept
+    in index.json, and the least recently used entries are evicted once the
+    cache is bigger than max_size bytes.
+    """
+    def __init__(self, directory, max_size=BLOB_CACHE_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, url, properties):
+        return hashlib.sha1('\n'.join([url, properties.get('etag') or '', properties.get('content-md5') or ''])).hexdigest()
+
+    def fetch(self, key, download, dest):
+        """
+        Places a cached blob at dest, downloading it first if it is not cached
+
+        download: function (path) that downloads the blob to path and
+                  returns its hex MD5 (or None if it was not computed)
+
+        dest is placed while the entry is still locked, so another fork
+        cannot evict the entry in between.
+
+        Returns:
+            (hex MD5 of the blob or None, True if it was already cached)
+        """
+        path = os.path.join(self.directory, key)
+        lock = open(path + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            metadata = read_json_file(path + '.json')
+            md5 = metadata.get('md5')
+            hit = 'md5' in metadata and os.path.exists(path)
+            if not hit:
+                md5 = download(path)
+                write_json_file(path + '.json', dict(md5=md5))
+            size = os.path.getsize(path)
+            place_file(path, dest)
+        finally:
+            lock.close()
+        self._used(key, size)
+        return (md5, hit)
+
+    def _used(self, key, size):
+        def update(index):
+            index[key] = [time.time(), size]
+            total = sum(entry[1] for entry in index.values())
+            for old_key in sorted(index, key=lambda k: index[k][0]):
+                if total <= self.max_size:
+                    break
+                if old_key != key and self._evict(old_key):
+                    total -= index.pop(old_key)[1]
+        update_json_file(os.path.join(self.directory, 'index.json'), update)
+
+    def _evict(self, key):
+        # Skip entries another fork is using; lock files are never removed,
+        # so every fork always locks the same file
+        path = os.path.join(self.directory, key)
+        lock = open(path + '.lock', 'a')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return False
+            for leftover in (path, path + '.json', path + '.part', path + '.part.json'):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            return True
+        finally:
+            lock.close()
+
+
+def read_range(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+
+def block_id(index, data):
+    """
+    Returns the id of a block from its position and content
+
+    Ids are all the same length (as the service requires), so a block of an
+    existing blob can be reused whenever the same data is uploaded at the
+    same position again.
+    """
+    return '%08d-%s' % (index, hashlib.md5(data).hexdigest())
+
+
+def committed_block_ids(azure, container, name, lease_id=None):
+    """
+    Returns the ids of a block blob's committed blocks, in order
+    """
+    block_list = azure.get_block_list(container_name=container, blob_name=name, blocklisttype='committed', x_ms_lease_id=lease_id)
+    return [block.id for block in block_list.committed_blocks]
+
+
+def upload_blocks(azure, container, name, path, block_size=MAX_BLOCK_SIZE, max_connections=4, lease_id=None, content_type=None, committed=None, current_md5=None):
+    """
+    Uploads a file as a block blob, putting its blocks concurrently
+
+    committed: ids of the blob's committed blocks (from committed_block_ids)
+    current_md5: the blob's Content-MD5
+
+    Blocks whose ids are already committed to the blob are not uploaded
+    again, only reused, so republishing a slightly changed file only sends
+    the blocks that changed.  The others are sent with their MD5, so the
+    service rejects corrupted blocks, and retried on their own.  The blocks
+    are committed with put_block_list once all of them are uploaded, along
+    with the MD5 of the whole file (computed as the blocks are read), which
+    becomes the blob's Content-MD5.  Nothing is committed if the blob
+    already consists of exactly these blocks and has the same Content-MD5.
+
+    Returns:
+        (bytes uploaded, bytes reused, Content-MD5 of the blob, True if a
+         new block list was committed)
+    """
+    ranges = byte_ranges(os.path.getsize(path), block_size)
+    committed = committed or []
+    reusable = set(committed)
+    block_ids = [None] * len(ranges)
+    digest = OrderedDigest(path, ranges)
+
+    def put(index):
+        byte_range = ranges[index]
+        data = read_range(path, *byte_range)
+        block_ids[index] = block_id(index, data)
+        if block_ids[index] in reusable:
+            digest.add(byte_range, data)
+            return (0, len(data))
+        block_md5 = base64.b64encode(hashlib.md5(data).digest())
+        retry_range(lambda: azure.put_block(container_name=container, blob_name=name, block=data, blockid=block_ids[index],
+                                            content_md5=block_md5, x_ms_lease_id=lease_id))
+        digest.add(byte_range, data)
+        return (len(data), 0)
+
+    sizes = run_concurrently(put, xrange(len(ranges)), max_connections)
+    uploaded = sum(size[0] for size in sizes)
+    reused = sum(size[1] for size in sizes)
+    content_md5 = hex_to_content_md5(digest.hexdigest())
+    if block_ids == committed and content_md5 == current_md5:
+        return (uploaded, reused, content_md5, False)
+
+    azure.put_block_list(container_name=container, blob_name=name, block_list=block_ids, x_ms_blob_content_type=content_type,
+                         x_ms_blob_content_md5=content_md5, x_ms_lease_id=lease_id)
+    return (uploaded, reused, content_md5, True)
+
+
+def data_extents(path, size):
+    """
+    Returns the inclusive (start, end) extents of a file that may hold data
+
+    Holes in sparse files are left out where the filesystem can report
+    them; otherwise the whole file is one extent.
+    """
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break       # nothing but a hole from here on
+                return [(0, size - 1)] if size else []
+            end = min(os.lseek(fd, start, SEEK_HOLE), size)
+            extents.append((start, end - 1))
+            offset = end
+    finally:
+        os.close(fd)
+    return extents
+
+
+def nonzero_ranges(path, size, scan_size=SCAN_SIZE, max_range=MAX_PAGE_WRITE):
+    """
+    Returns the inclusive (start, end) ranges of a file that are not all
+    zeros, aligned to scan_size and at most max_range bytes long
+
+    Holes are skipped without being read and the rest of the file is
+    compared with zeros a window at a time through an mmap, so the file is
+    read once and nothing but the comparison is done in Python per window.
+    """
+    if not size:
+        return []
+    zeros = '\0' * scan_size
+    ranges = []
+    scanned = 0
+    with open(path, 'rb') as f:
+        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        for extent_start, extent_end in data_extents(path, size):
+            offset = max(extent_start - extent_start % scan_size, scanned)
+            while offset <= extent_end:
+                end = min(offset + scan_size, size)
+                if view[offset:end] != zeros[:end - offset]:
+                    if ranges and ranges[-1][1] == offset - 1 and end - ranges[-1][0] <= max_range:
+                        ranges[-1] = (ranges[-1][0], end - 1)
+                    else:
+                        ranges.append((offset, end - 1))
+                offset = end
+            scanned = offset
+    finally:
+        view.close()
+    return ranges
+
+
+def upload_pages(azure, container, name, path, max_connections=4, lease_id=None, content_type=None):
+    """
+    Uploads a file (such as a fixed size VHD) as a page blob, skipping zeros
+
+    A new, empty page blob the size of the file is created (replacing any
+    existing blob), and only the ranges of the file that are not zeros are
+    written to it, concurrently and each retried on its own.  Pages that are
+    never written read back as zeros.  The blob is marked incomplete (see
+    upload_complete) until every range has been written.
+
+    Returns:
+        (bytes uploaded, bytes of zeros skipped)
+    """
+    size = os.path.getsize(path)
+    if size % PAGE_SIZE:
+        raise IOError('%s is %d bytes, which is not a multiple of the %d byte page size' % (path, size, PAGE_SIZE))
+
+    azure.put_blob(container_name=container, blob_name=name, blob='', x_ms_blob_type='PageBlob', x_ms_blob_content_type=content_type,
+                   x_ms_blob_content_length=size, x_ms_lease_id=lease_id, x_ms_meta_name_values={UPLOAD_INCOMPLETE_METADATA: 'true'})
+
+    def put(byte_range):
+        data = read_range(path, *byte_range)
+        page_md5 = base64.b64encode(hashlib.md5(data).digest())
+        retry_range(lambda: azure.put_page(container_name=container, blob_name=name, page=data, x_ms_range='bytes=%d-%d' % byte_range,
+                                           x_ms_page_write='update', content_md5=page_md5, x_ms_lease_id=lease_id))
+        return len(data)
+
+    uploaded = sum(run_concurrently(put, nonzero_ranges(path, size), max_connections))
+    # setting no metadata removes the marker
+    azure.set_blob_metadata(container_name=container, blob_name=name, x_ms_lease_id=lease_id)
+    return (uploaded, size - uploaded)
+
+
+def upload_complete(properties):
+    """
+    Returns False if the properties are of a page blob upload_pages did not finish
+    """
+    return not properties.get('x-ms-meta-' + UPLOAD_INCOMPLETE_METADATA)
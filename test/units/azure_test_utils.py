@@ -0,0 +1,307 @@
+# Shared setup for the unit tests.
+#
+# The tests need Python 2, Ansible and the azure SDK.  They import the
+# repo's module_utils as ansible.module_utils.*, the way Ansible does, and
+# load modules without running their main().  Run them from anywhere with
+#
+#   python -m pytest test/units
+
+import base64
+import email.utils
+import hashlib
+import inspect
+import os
+import sys
+import types
+import urlparse
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# azure.py in the repo would shadow the azure SDK
+sys.path[:] = [p for p in sys.path if os.path.abspath(p or os.curdir) != REPO_DIR]
+
+import ansible.module_utils
+if os.path.join(REPO_DIR, 'module_utils') not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.insert(0, os.path.join(REPO_DIR, 'module_utils'))
+
+from azure import WindowsAzureError, WindowsAzureConflictError, WindowsAzureMissingResourceError
+from azure.storage import BlobService
+
+
+def load_module(name):
+    """
+    Loads one of the repo's modules without running its main()
+
+    Raises ImportError if the module's SDK is not installed (the modules
+    exit when their imports fail).
+    """
+    path = os.path.join(REPO_DIR, name + '.py')
+    with open(path) as f:
+        source = f.read()
+    source = source[:source.rindex('\nmain()')]
+    module = types.ModuleType(name)
+    module.__file__ = path
+    try:
+        exec compile(source, path, 'exec') in module.__dict__
+    except SystemExit:
+        raise ImportError('%s needs an SDK that is not installed' % name)
+    return module
+
+
+class ModuleFailed(Exception):
+    pass
+
+
+class FakeModule(object):
+    """
+    Stands in for AnsibleModule, with the given params
+    """
+    def __init__(self, **params):
+        self.params = params
+
+    def boolean(self, value):
+        return value in (True, 1, '1', 'yes', 'true', 'True', 'on')
+
+    def fail_json(self, **kwargs):
+        raise ModuleFailed(kwargs)
+
+    def exit_json(self, **kwargs):
+        raise SystemExit(kwargs)
+
+    def md5(self, path):
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+
+def sdk_call(method):
+    """
+    Checks the arguments of a fake SDK call against the real BlobService
+    method of the same name, so a call the SDK would reject with TypeError
+    fails the same way here
+    """
+    real = getattr(BlobService, method.__name__).im_func
+
+    def call(self, *args, **kwargs):
+        inspect.getcallargs(real, self, *args, **kwargs)
+        return method(self, *args, **kwargs)
+    call.__name__ = method.__name__
+    return call
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class BlobList(list):
+    next_marker = ''
+
+
+class FakeBlobService(object):
+    """
+    An in-memory blob service with the BlobService call signatures
+
+    blobs: {name: data} of block blobs in container 'c'
+
+    Errors are raised as the azure SDK's; subclasses set Error,
+    ConflictError and MissingResourceError for other SDKs.
+    """
+    Error = WindowsAzureError
+    ConflictError = WindowsAzureConflictError
+    MissingResourceError = WindowsAzureMissingResourceError
+
+    def __init__(self, blobs=None):
+        self.blobs = {}
+        self.snapshots = {}
+        self.uncommitted = {}
+        self.calls = []
+        self.snapshot_count = 0
+        self.clock = 1780272000     # 2026-06-01, advanced a second per write
+        for name, data in (blobs or {}).items():
+            self.add_blob(name, data)
+
+    def add_blob(self, name, data, blob_type='BlockBlob', pages=None, content_md5=None, metadata=None):
+        blob = self.blobs.setdefault(name, dict(lease_state='available', lease_id=None, copy={}))
+        blob.update(data=str(data), type=blob_type, pages=pages, content_md5=content_md5, metadata=dict(metadata or {}),
+                    etag='"0x%d"' % (hash((name, str(data))) & 0xffffff), last_modified=self.tick())
+        return blob
+
+    def tick(self):
+        self.clock += 1
+        return email.utils.formatdate(self.clock, usegmt=True)
+
+    def _blob(self, name, snapshot=None):
+        blob = self.snapshots.get((name, snapshot)) if snapshot else self.blobs.get(name)
+        if blob is None:
+            raise self.MissingResourceError('Not found (Not Found)')
+        return blob
+
+    def _check_lease(self, blob, lease_id):
+        if lease_id and lease_id != blob['lease_id']:
+            raise self.Error('Unknown error (The lease ID specified did not match the lease ID for the blob.)')
+
+    def _properties(self, blob):
+        properties = {'content-length': str(len(blob['data'])), 'etag': blob['etag'], 'x-ms-blob-type': blob['type'],
+                      'last-modified': blob['last_modified'], 'x-ms-lease-state': blob['lease_state']}
+        if blob['content_md5']:
+            properties['content-md5'] = blob['content_md5']
+        for key, value in blob['copy'].items():
+            properties['x-ms-copy-' + key] = value
+        for key, value in blob['metadata'].items():
+            properties['x-ms-meta-' + key] = value
+        return properties
+
+    @sdk_call
+    def get_blob_properties(self, container_name, blob_name, x_ms_lease_id=None):
+        self.calls.append(('get_blob_properties', blob_name))
+        blob = self._blob(blob_name)
+        self._check_lease(blob, x_ms_lease_id)
+        return self._properties(blob)
+
+    @sdk_call
+    def get_blob(self, container_name, blob_name, snapshot=None, x_ms_range=None, x_ms_lease_id=None, x_ms_range_get_content_md5=None):
+        self.calls.append(('get_blob', blob_name, x_ms_range))
+        blob = self._blob(blob_name, snapshot)
+        self._check_lease(blob, x_ms_lease_id)
+        data = blob['data']
+        if x_ms_range:
+            start, end = [int(i) for i in x_ms_range.split('=')[1].split('-')]
+            data = data[start:end + 1]
+        return data
+
+    @sdk_call
+    def list_blobs(self, container_name, prefix=None, marker=None, maxresults=None, include=None, delimiter=None):
+        self.calls.append(('list_blobs', prefix))
+        listed = [(name, None, blob) for name, blob in self.blobs.items()]
+        if include and 'snapshots' in include:
+            listed += [(name, snapshot, blob) for (name, snapshot), blob in self.snapshots.items()]
+        result = BlobList()
+        for name, snapshot, blob in sorted(listed, key=lambda b: (b[0], b[1] is None, b[1])):
+            if prefix and not name.startswith(prefix):
+                continue
+            properties = Obj(content_length=len(blob['data']), etag=blob['etag'].strip('"'), content_md5=blob['content_md5'] or '',
+                             blob_type=blob['type'], lease_state=blob['lease_state'], last_modified=blob['last_modified'])
+            result.append(Obj(name=name, snapshot=snapshot or '', properties=properties, metadata=dict(blob['metadata'])))
+        return result
+
+    @sdk_call
+    def snapshot_blob(self, container_name, blob_name, x_ms_meta_name_values=None, if_modified_since=None,
+                      if_unmodified_since=None, if_match=None, if_none_match=None, x_ms_lease_id=None):
+        self.snapshot_count += 1
+        snapshot = '2026-06-01T00:00:%02d.0000000Z' % self.snapshot_count
+        blob = self._blob(blob_name)
+        self.snapshots[(blob_name, snapshot)] = dict(blob, pages=list(blob['pages'] or []))
+        return {'x-ms-snapshot': snapshot}
+
+    @sdk_call
+    def delete_blob(self, container_name, blob_name, snapshot=None, timeout=None, x_ms_lease_id=None, x_ms_delete_snapshots=None):
+        self.calls.append(('delete_blob', blob_name, snapshot))
+        if snapshot:
+            self._blob(blob_name, snapshot)
+            del self.snapshots[(blob_name, snapshot)]
+        else:
+            self._blob(blob_name)
+            del self.blobs[blob_name]
+
+    @sdk_call
+    def get_page_ranges(self, container_name, blob_name, snapshot=None, range=None, x_ms_range=None, x_ms_lease_id=None):
+        return [Obj(start=start, end=end) for start, end in self._blob(blob_name, snapshot)['pages']]
+
+    @sdk_call
+    def put_blob(self, container_name, blob_name, blob, x_ms_blob_type, content_encoding=None, content_language=None,
+                 content_md5=None, cache_control=None, x_ms_blob_content_type=None, x_ms_blob_content_encoding=None,
+                 x_ms_blob_content_language=None, x_ms_blob_content_md5=None, x_ms_blob_cache_control=None,
+                 x_ms_meta_name_values=None, x_ms_lease_id=None, x_ms_blob_content_length=None,
+                 x_ms_blob_sequence_number=None):
+        self.calls.append(('put_blob', blob_name))
+        existing = self.blobs.get(blob_name)
+        if existing and existing['lease_state'] == 'leased' and x_ms_lease_id != existing['lease_id']:
+            raise self.Error('Unknown error (There is currently a lease on the blob and no lease ID was specified in the request.)')
+        if x_ms_blob_type == 'PageBlob':
+            self.add_blob(blob_name, '\0' * x_ms_blob_content_length, 'PageBlob', pages=[], metadata=x_ms_meta_name_values)
+        else:
+            self.add_blob(blob_name, blob, 'BlockBlob', metadata=x_ms_meta_name_values)
+
+    @sdk_call
+    def put_page(self, container_name, blob_name, page, x_ms_range, x_ms_page_write, timeout=None, content_md5=None,
+                 x_ms_lease_id=None, x_ms_if_sequence_number_lte=None, x_ms_if_sequence_number_lt=None,
+                 x_ms_if_sequence_number_eq=None, if_modified_since=None, if_unmodified_since=None,
+                 if_match=None, if_none_match=None):
+        self.calls.append(('put_page', blob_name, x_ms_range))
+        blob = self._blob(blob_name)
+        start, end = [int(i) for i in x_ms_range.split('=')[1].split('-')]
+        if len(page) != end - start + 1 or content_md5 != base64.b64encode(hashlib.md5(page).digest()):
+            raise self.Error('Bad Request (The MD5 value specified in the request did not match with the MD5 value calculated by the server.)')
+        blob['data'] = blob['data'][:start] + page + blob['data'][end + 1:]
+        blob['pages'] = sorted(blob['pages'] + [(start, end)])
+
+    @sdk_call
+    def set_blob_metadata(self, container_name, blob_name, x_ms_meta_name_values=None, x_ms_lease_id=None):
+        self.calls.append(('set_blob_metadata', blob_name))
+        blob = self._blob(blob_name)
+        self._check_lease(blob, x_ms_lease_id)
+        blob['metadata'] = dict(x_ms_meta_name_values or {})
+
+    @sdk_call
+    def put_block(self, container_name, blob_name, block, blockid, content_md5=None, x_ms_lease_id=None):
+        self.calls.append(('put_block', blob_name, blockid))
+        self.uncommitted[(blob_name, blockid)] = block
+
+    @sdk_call
+    def put_block_list(self, container_name, blob_name, block_list, content_md5=None, x_ms_blob_cache_control=None,
+                       x_ms_blob_content_type=None, x_ms_blob_content_encoding=None, x_ms_blob_content_language=None,
+                       x_ms_blob_content_md5=None, x_ms_meta_name_values=None, x_ms_lease_id=None):
+        self.calls.append(('put_block_list', blob_name))
+        existing = self.blobs.get(blob_name, {}).get('blocks', {})
+        blocks = [(i, self.uncommitted.pop((blob_name, i), None) or existing[i]) for i in block_list]
+        blob = self.add_blob(blob_name, ''.join(data for i, data in blocks), content_md5=x_ms_blob_content_md5)
+        blob['blocks'] = dict(blocks)
+        blob['block_list'] = list(block_list)
+
+    @sdk_call
+    def get_block_list(self, container_name, blob_name, snapshot=None, blocklisttype=None, x_ms_lease_id=None):
+        blob = self._blob(blob_name, snapshot)
+        return Obj(committed_blocks=[Obj(id=i, size=len(blob['blocks'][i])) for i in blob.get('block_list', [])],
+                   uncommitted_blocks=[])
+
+    @sdk_call
+    def copy_blob(self, container_name, blob_name, x_ms_copy_source, x_ms_meta_name_values=None,
+                  x_ms_source_if_modified_since=None, x_ms_source_if_unmodified_since=None, x_ms_source_if_match=None,
+                  x_ms_source_if_none_match=None, if_modified_since=None, if_unmodified_since=None, if_match=None,
+                  if_none_match=None, x_ms_lease_id=None, x_ms_source_lease_id=None):
+        """
+        Copies a blob of container 'c', given by URL, at once
+        """
+        self.calls.append(('copy_blob', blob_name))
+        source = self._blob(urlparse.urlsplit(x_ms_copy_source).path.split('/', 2)[2])
+        if x_ms_source_if_modified_since:
+            modified = email.utils.mktime_tz(email.utils.parsedate_tz(source['last_modified']))
+            if modified <= email.utils.mktime_tz(email.utils.parsedate_tz(x_ms_source_if_modified_since)):
+                error = self.Error('Precondition Failed (The condition specified using HTTP conditional header(s) is not met.)')
+                error.status_code = 412
+                raise error
+        blob = self.add_blob(blob_name, source['data'], source['type'], source['pages'], source['content_md5'])
+        copy_id = 'copy-%d' % len(self.calls)
+        blob['copy'] = {'source': x_ms_copy_source, 'status': 'success', 'id': copy_id, 'completion-time': self.tick(),
+                        'progress': '%d/%d' % (len(source['data']), len(source['data']))}
+        return {'x-ms-copy-status': 'success', 'x-ms-copy-id': copy_id}
+
+    @sdk_call
+    def lease_blob(self, container_name, blob_name, x_ms_lease_action, x_ms_lease_id=None, x_ms_lease_duration=60,
+                   x_ms_lease_break_period=None, x_ms_proposed_lease_id=None):
+        self.calls.append(('lease_blob', blob_name, x_ms_lease_action))
+        blob = self._blob(blob_name)
+        if x_ms_lease_action == 'acquire':
+            if blob['lease_state'] in ('leased', 'breaking') and blob['lease_id'] != x_ms_proposed_lease_id:
+                raise self.ConflictError('Conflict (Conflict)')
+            blob.update(lease_state='leased', lease_id=x_ms_proposed_lease_id or 'lease-%d' % len(self.calls))
+            return {'x-ms-lease-id': blob['lease_id']}
+        if blob['lease_id'] != x_ms_lease_id:
+            raise self.ConflictError('Conflict (Conflict)')
+        if x_ms_lease_action == 'renew':
+            return {'x-ms-lease-id': blob['lease_id']}
+        if x_ms_lease_action == 'release':
+            blob.update(lease_state='available', lease_id=None)
+            return {}
+        blob['lease_state'] = 'broken'
+        return {'x-ms-lease-time': '0'}
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from azure_test_utils import FakeBlobService, FakeModule, ModuleFailed, load_module
+
+import ansible.module_utils.azure_transfer as azure_transfer
+
+azure_blob = load_module('azure_blob')
+
+
+class UploadPageBlobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, 'disk.vhd')
+        with open(self.src, 'wb') as f:
+            f.write('a' * azure_transfer.SCAN_SIZE)
+        self.azure = FakeBlobService()
+        self.saved = azure_transfer.retry_range.func_defaults
+        azure_transfer.retry_range.func_defaults = (1,)
+
+    def tearDown(self):
+        azure_transfer.retry_range.func_defaults = self.saved
+        shutil.rmtree(self.directory)
+
+    def upload(self, **params):
+        defaults = dict(name='disk.vhd', container='c', src=self.src, overwrite=False, content_type=None,
+                        max_connections=2, lease_id=None)
+        defaults.update(params)
+        return azure_blob.upload_page_blob(FakeModule(**defaults), self.azure)
+
+    def test_existing_blob_is_left_alone(self):
+        self.assertTrue(self.upload()[0])
+        self.assertFalse(self.upload()[0])
+        # nor is one uploaded some other way
+        self.azure.add_blob('disk.vhd', 'x' * 512, 'PageBlob')
+        self.assertFalse(self.upload()[0])
+
+    def test_interrupted_upload_is_done_again(self):
+        def failing_put_page(**kwargs):
+            raise IOError('connection reset')
+        self.azure.put_page = failing_put_page
+        self.assertRaises(ModuleFailed, self.upload)
+        del self.azure.put_page
+
+        (changed, result) = self.upload()
+        self.assertTrue(changed)
+        self.assertEqual(result['uploaded'], azure_transfer.SCAN_SIZE)
+        self.assertEqual(self.azure.blobs['disk.vhd']['data'], 'a' * azure_transfer.SCAN_SIZE)
+        self.assertFalse(self.upload()[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
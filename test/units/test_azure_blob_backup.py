@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from azure_test_utils import FakeBlobService, FakeModule, ModuleFailed, load_module
+
+azure_blob_backup = load_module('azure_blob_backup')
+
+
+class BackupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.azure = FakeBlobService()
+        self.azure.add_blob('disk.vhd', 'a' * 512 + '\0' * 1024 + 'b' * 512, 'PageBlob', pages=[(0, 511), (1536, 2047)])
+        self.module = FakeModule(name='disk.vhd', container='c', dest=self.directory, full=False, keep_snapshots=1,
+                                 chunk_size=1024, max_connections=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_backups_keep_the_latest_snapshot(self):
+        first = azure_blob_backup.take_backup(self.module, self.azure)
+        self.assertTrue(first['full'])
+        self.assertEqual(first['downloaded'], 1024)
+        self.azure.add_blob('disk.vhd', 'c' * 512 + '\0' * 1024 + 'b' * 512, 'PageBlob', pages=[(0, 511), (1536, 2047)])
+        second = azure_blob_backup.take_backup(self.module, self.azure)
+        self.assertFalse(second['full'])
+        self.assertEqual(second['ranges'], [[0, 511, 0]])
+        self.assertEqual(self.azure.snapshots.keys(), [('disk.vhd', second['snapshot'])])
+
+    def test_failed_backup_deletes_its_snapshot(self):
+        self.azure.add_blob('disk.vhd', 'not a page blob')
+        self.assertRaises(ModuleFailed, azure_blob_backup.take_backup, self.module, self.azure)
+        self.assertEqual(self.azure.snapshots, {})
+
+    def test_unexpected_error_deletes_the_snapshot(self):
+        def write_json_file(path, contents):
+            raise OSError('disk full')
+        saved = azure_blob_backup.write_json_file
+        azure_blob_backup.write_json_file = write_json_file
+        try:
+            self.assertRaises(OSError, azure_blob_backup.take_backup, self.module, self.azure)
+        finally:
+            azure_blob_backup.write_json_file = saved
+        self.assertEqual(self.azure.snapshots, {})
+
+    def test_restore(self):
+        azure_blob_backup.take_backup(self.module, self.azure)
+        self.azure.add_blob('disk.vhd', 'c' * 512 + '\0' * 1024 + 'b' * 512, 'PageBlob', pages=[(0, 511), (1536, 2047)])
+        azure_blob_backup.take_backup(self.module, self.azure)
+        restore_to = os.path.join(self.directory, 'restored.vhd')
+        for backup, image in [(1, 'a'), (2, 'c')]:
+            module = FakeModule(dest=self.directory, restore_to=restore_to, backup=backup)
+            azure_blob_backup.restore_backup(module)
+            with open(restore_to) as f:
+                self.assertEqual(f.read(), image * 512 + '\0' * 1024 + 'b' * 512)
+
+
+if __name__ == '__main__':
+    unittest.main()
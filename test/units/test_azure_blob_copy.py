@@ -0,0 +1,56 @@
+import unittest
+
+from azure_test_utils import FakeBlobService, FakeModule, load_module
+
+azure_blob_copy = load_module('azure_blob_copy')
+
+SOURCE = 'https://account.blob.core.windows.net/c/src'
+
+
+class StartCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.azure = FakeBlobService({'src': 'data'})
+        self.module = FakeModule(overwrite=False)
+
+    def start(self):
+        return azure_blob_copy.start_copy(self.module, self.azure, dict(name='dest', container='c', source=SOURCE, changed=False))
+
+    def test_copy_and_repeat(self):
+        self.assertTrue(self.start()['changed'])
+        copy = self.start()
+        self.assertFalse(copy['changed'])
+        self.assertEqual(copy['status'], 'success')
+        self.assertEqual(self.azure.blobs['dest']['data'], 'data')
+
+    def test_changed_source_is_copied_again(self):
+        self.start()
+        self.azure.add_blob('src', 'new data')
+        self.assertTrue(self.start()['changed'])
+        self.assertEqual(self.azure.blobs['dest']['data'], 'new data')
+
+    def test_pending_copy_is_reported(self):
+        self.start()
+        self.azure.blobs['dest']['copy']['status'] = 'pending'
+        copy = self.start()
+        self.assertEqual((copy['changed'], copy['status']), (False, 'pending'))
+        self.assertEqual([c for c in self.azure.calls if c[0] == 'copy_blob'], [('copy_blob', 'dest')])
+
+    def test_other_destination_is_left_alone(self):
+        self.azure.add_blob('dest', 'mine')
+        self.assertEqual(self.start()['status'], 'exists')
+        self.module = FakeModule(overwrite=True)
+        self.assertTrue(self.start()['changed'])
+
+    def test_same_source(self):
+        self.assertTrue(azure_blob_copy.same_source(SOURCE + '?sv=2014&sig=x', 'https://ACCOUNT.blob.core.windows.net/c/src'))
+        self.assertFalse(azure_blob_copy.same_source(SOURCE + '?snapshot=1', SOURCE))
+        self.assertFalse(azure_blob_copy.same_source(SOURCE, None))
+
+    def test_copy_progress(self):
+        self.assertEqual(azure_blob_copy.copy_progress({'x-ms-copy-progress': '10/40'}), (10, 40))
+        self.assertEqual(azure_blob_copy.copy_progress({}), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from azure_test_utils import FakeBlobService, FakeModule, ModuleFailed, load_module
+
+import ansible.module_utils.azure_transfer as azure_transfer
+
+azure_blob_fetch = load_module('azure_blob_fetch')
+
+
+class FetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.azure = FakeBlobService({'b': 'old data'})
+        self.snapshot = self.azure.snapshot_blob(container_name='c', blob_name='b')['x-ms-snapshot']
+        self.azure.add_blob('b', 'new data, longer')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def module(self, **params):
+        defaults = dict(container='c', account_name='account', overwrite=False, mode=None, max_connections=2,
+                        chunk_size=4, sparse=False, cache_dir=None, cache_size=0)
+        defaults.update(params)
+        return FakeModule(**defaults)
+
+    def test_fetch_snapshot(self):
+        dest = os.path.join(self.directory, 'b')
+        result = azure_blob_fetch.fetch_blob(self.module(), self.azure, 'b', dest, self.snapshot)
+        self.assertTrue(result['changed'])
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'old data')
+
+    def test_fetch_snapshot_if_changed(self):
+        dest = os.path.join(self.directory, 'b')
+        azure_blob_fetch.fetch_blob(self.module(), self.azure, 'b', dest, self.snapshot)
+        result = azure_blob_fetch.fetch_blob(self.module(mode='if_changed'), self.azure, 'b', dest, self.snapshot)
+        self.assertFalse(result['changed'])
+
+    def test_sparse_fetch_of_a_page_blob(self):
+        self.azure.add_blob('disk.vhd', 'aaaa' + '\0' * 8, 'PageBlob', pages=[(0, 3)])
+        dest = os.path.join(self.directory, 'disk.vhd')
+        result = azure_blob_fetch.fetch_blob(self.module(sparse=True), self.azure, 'disk.vhd', dest)
+        self.assertEqual(result['downloaded'], 4)
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'aaaa' + '\0' * 8)
+
+    def test_fetch_through_the_cache(self):
+        module = self.module(cache_dir=os.path.join(self.directory, 'cache'), cache_size=1024)
+        first = azure_blob_fetch.fetch_blob(module, self.azure, 'b', os.path.join(self.directory, 'b1'))
+        second = azure_blob_fetch.fetch_blob(module, self.azure, 'b', os.path.join(self.directory, 'b2'))
+        self.assertEqual((first['cached'], second['cached']), (False, True))
+        self.assertEqual(second['downloaded'], 0)
+        with open(os.path.join(self.directory, 'b2')) as f:
+            self.assertEqual(f.read(), 'new data, longer')
+
+    def test_missing_blob_fails_the_task(self):
+        dest = os.path.join(self.directory, 'missing')
+        module = self.module(name='missing', snapshot=None, lease_id=None, dest=dest)
+        self.assertRaises(ModuleFailed, azure_blob_fetch.get_blob, module, self.azure)
+
+
+class FetchManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.azure = FakeBlobService({'x/a': 'aaaa', 'x/b': 'bbbbbb'})
+        self.azure.lease_blob(container_name='c', blob_name='x/a', x_ms_lease_action='acquire',
+                              x_ms_proposed_lease_id='lease-a')
+        self.saved = azure_transfer.retry_range.func_defaults
+        azure_transfer.retry_range.func_defaults = (1,)
+
+    def tearDown(self):
+        azure_transfer.retry_range.func_defaults = self.saved
+        shutil.rmtree(self.directory)
+
+    def module(self, **params):
+        defaults = dict(container='c', account_name='account', overwrite=True, mode=None, max_connections=2,
+                        chunk_size=4, sparse=False, cache_dir=None, cache_size=0, blobs=None, prefix=None,
+                        lease_id=None, dest=self.directory, workers=2)
+        defaults.update(params)
+        return FakeModule(**defaults)
+
+    def test_blobs_take_their_own_lease_id(self):
+        blobs = [dict(name='x/a', lease_id='lease-a'), dict(name='x/b')]
+        results = azure_blob_fetch.get_blobs(self.module(blobs=blobs), self.azure)
+        self.assertEqual([r.get('failed') for r in results], [None, None])
+
+    def test_lease_id_is_sent_for_blobs(self):
+        results = azure_blob_fetch.get_blobs(self.module(blobs=[dict(name='x/a'), dict(name='x/b')], lease_id='lease-a'), self.azure)
+        self.assertEqual([r.get('failed') for r in results], [None, True])
+
+    def test_missing_blob_is_reported_with_the_others(self):
+        results = azure_blob_fetch.get_blobs(self.module(blobs=[dict(name='x/b'), dict(name='x/missing')]), self.azure)
+        self.assertEqual([r.get('failed') for r in results], [None, True])
+        self.assertTrue('Not found' in results[1]['msg'])
+
+    def test_lease_id_is_sent_for_prefix(self):
+        results = azure_blob_fetch.get_blobs(self.module(prefix='x/', lease_id='wrong'), self.azure)
+        self.assertEqual([r.get('failed') for r in results], [True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
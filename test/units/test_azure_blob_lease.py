@@ -0,0 +1,46 @@
+import unittest
+
+from azure_test_utils import FakeBlobService, FakeModule, load_module
+
+azure_blob_lease = load_module('azure_blob_lease')
+
+
+class LeaseStatesTest(unittest.TestCase):
+
+    def setUp(self):
+        names = ['logs/%02d' % i for i in range(8)] + ['data/a', 'other']
+        self.azure = FakeBlobService(dict((n, n) for n in names))
+
+    def module(self, **params):
+        defaults = dict(container='c', name=None, blobs=None, prefix=None, lease_id=None, workers=4)
+        defaults.update(params)
+        return FakeModule(**defaults)
+
+    def calls(self):
+        return sorted(set(c[0] for c in self.azure.calls))
+
+    def test_a_few_blobs_are_looked_up(self):
+        (items, states) = azure_blob_lease.blob_lease_states(self.module(blobs=['logs/01', 'logs/02', 'logs/09']), self.azure)
+        self.assertEqual(self.calls(), ['get_blob_properties'])
+        self.assertEqual(states, {'logs/01': 'available', 'logs/02': 'available'})
+
+    def test_blobs_without_a_common_prefix_are_looked_up(self):
+        blobs = ['logs/%02d' % i for i in range(7)] + ['other']
+        (items, states) = azure_blob_lease.blob_lease_states(self.module(blobs=blobs), self.azure)
+        self.assertEqual(self.calls(), ['get_blob_properties'])
+        self.assertEqual(len(states), 8)
+
+    def test_many_blobs_are_listed(self):
+        blobs = ['logs/%02d' % i for i in range(7)]
+        (items, states) = azure_blob_lease.blob_lease_states(self.module(blobs=blobs), self.azure)
+        self.assertEqual(self.azure.calls, [('list_blobs', 'logs/0')])
+        self.assertEqual(sorted(states), blobs)
+
+    def test_prefix_is_listed(self):
+        (items, states) = azure_blob_lease.blob_lease_states(self.module(prefix='data/'), self.azure)
+        self.assertEqual(items, [('data/a', None)])
+        self.assertEqual(self.calls(), ['list_blobs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
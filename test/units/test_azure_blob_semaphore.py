@@ -0,0 +1,88 @@
+import email.utils
+import unittest
+
+from azure_test_utils import FakeBlobService, FakeModule, ModuleFailed, load_module
+
+azure_blob_semaphore = load_module('azure_blob_semaphore')
+
+
+class LosingBlobService(FakeBlobService):
+    """
+    Loses every race for a slot
+    """
+    def lease_blob(self, container_name, blob_name, x_ms_lease_action, **kwargs):
+        self.calls.append(('lease_blob', blob_name, x_ms_lease_action))
+        raise self.ConflictError('Conflict (Conflict)')
+
+
+class AcquireTest(unittest.TestCase):
+
+    def module(self, **params):
+        defaults = dict(name='sem', container='c', slots=2, duration_s=60, timeout=10, poll_interval=[0.01, 0.02])
+        defaults.update(params)
+        return FakeModule(**defaults)
+
+    def test_acquire_a_free_slot(self):
+        azure = FakeBlobService()
+        (slot, lease_id, stats) = azure_blob_semaphore.acquire_semaphore(self.module(), azure)
+        self.assertEqual(slot, 'sem/slot-000')
+        self.assertEqual(azure.blobs[slot]['lease_id'], lease_id)
+        self.assertEqual((stats['attempts'], stats['holders']), (1, 1))
+        self.assertEqual([n for n in azure.blobs if '/queue/' in n], [])
+
+    def test_expired_and_broken_slots_are_free(self):
+        azure = FakeBlobService({'sem/slot-000': '', 'sem/slot-001': ''})
+        azure.blobs['sem/slot-000'].update(lease_state='leased', lease_id='other')
+        azure.blobs['sem/slot-001'].update(lease_state='broken', lease_id='old')
+        (slot, lease_id, stats) = azure_blob_semaphore.acquire_semaphore(self.module(), azure)
+        self.assertEqual(slot, 'sem/slot-001')
+
+    def test_breaking_slots_are_waited_for(self):
+        azure = FakeBlobService({'sem/slot-000': ''})
+        azure.blobs['sem/slot-000'].update(lease_state='breaking', lease_id='other')
+        self.assertRaises(ModuleFailed, azure_blob_semaphore.acquire_semaphore, self.module(slots=1, timeout=0), azure)
+        self.assertEqual([c for c in azure.calls if c[0] == 'lease_blob'], [])
+
+    def test_a_lost_race_waits_and_times_out(self):
+        azure = LosingBlobService()
+        try:
+            azure_blob_semaphore.acquire_semaphore(self.module(slots=1, timeout=0), azure)
+            self.fail('acquired a slot')
+        except ModuleFailed as e:
+            stats = e.args[0]
+        self.assertEqual(stats['attempts'], 1)
+        self.assertEqual([n for n in azure.blobs if '/queue/' in n], [])
+
+    def waiting_behind(self, azure, **params):
+        # slot-000 is held, so the waiter queues and times out
+        azure.add_blob('sem/slot-000', '').update(lease_state='leased', lease_id='other')
+        try:
+            azure_blob_semaphore.acquire_semaphore(self.module(slots=1, timeout=0, **params), azure)
+            self.fail('acquired a slot')
+        except ModuleFailed as e:
+            return e.args[0]
+
+    def test_tickets_are_aged_by_server_time(self):
+        # the service's clock is months behind this host's, which must not
+        # make the other waiter's ticket look stale
+        azure = FakeBlobService()
+        azure.add_blob('sem/queue/other', '')
+        self.assertEqual(self.waiting_behind(azure)['position'], 1)
+        self.assertTrue('sem/queue/other' in azure.blobs)
+
+    def test_stale_tickets_are_deleted(self):
+        azure = FakeBlobService()
+        azure.add_blob('sem/queue/other', '')['last_modified'] = email.utils.formatdate(azure.clock - 400, usegmt=True)
+        self.assertEqual(self.waiting_behind(azure)['position'], 0)
+        self.assertFalse('sem/queue/other' in azure.blobs)
+
+    def test_queue_is_ordered_by_server_time(self):
+        # queued before any ticket of ours, whatever the names say
+        azure = FakeBlobService()
+        azure.add_blob('sem/queue/zzz', '', metadata={'queued': str(azure.clock - 200)})
+        azure.clock += 100
+        self.assertEqual(self.waiting_behind(azure)['position'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
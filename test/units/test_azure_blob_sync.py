@@ -0,0 +1,118 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from azure_test_utils import BlobList, FakeBlobService, FakeModule, ModuleFailed, load_module
+
+import ansible.module_utils.azure_transfer as azure_transfer
+
+azure_blob_sync = load_module('azure_blob_sync')
+
+
+class PagedBlobService(FakeBlobService):
+    """
+    Lists one blob per page, failing after fail_after pages
+    """
+    fail_after = None
+
+    def list_blobs(self, container_name, prefix=None, marker=None, maxresults=None, include=None, delimiter=None):
+        blobs = FakeBlobService.list_blobs(self, container_name, prefix=prefix, include=include)
+        page = int(marker or 0)
+        if page == self.fail_after:
+            raise self.Error('Unknown error (Server Busy)')
+        result = BlobList(blobs[page:page + 1])
+        result.next_marker = str(page + 1) if page + 1 < len(blobs) else ''
+        return result
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.azure = PagedBlobService({'a': 'aaaa', 'd/b': 'bbbbbb', 'd/c': 'c'})
+        self.saved = (azure_blob_sync.MANIFEST_FLUSH_INTERVAL, azure_transfer.retry_range.func_defaults)
+        azure_blob_sync.MANIFEST_FLUSH_INTERVAL = 0
+        azure_transfer.retry_range.func_defaults = (1,)
+
+    def tearDown(self):
+        azure_blob_sync.MANIFEST_FLUSH_INTERVAL, azure_transfer.retry_range.func_defaults = self.saved
+        shutil.rmtree(self.directory)
+
+    def module(self, **params):
+        defaults = dict(container='c', prefix=None, dest=self.directory, delete=True, workers=2,
+                        max_connections=1, chunk_size=4)
+        defaults.update(params)
+        return FakeModule(**defaults)
+
+    def manifest(self):
+        with open(os.path.join(self.directory, azure_blob_sync.MANIFEST_NAME)) as f:
+            return json.load(f)
+
+    def test_sync_and_resync(self):
+        (downloaded, deleted, unchanged, size, failed) = azure_blob_sync.sync_blobs(self.module(), self.azure)
+        self.assertEqual(sorted(downloaded), ['a', 'd/b', 'd/c'])
+        self.assertEqual((deleted, unchanged, size, failed), ([], 0, 11, []))
+        with open(os.path.join(self.directory, 'd', 'b')) as f:
+            self.assertEqual(f.read(), 'bbbbbb')
+
+        self.azure.add_blob('d/c', 'changed')
+        (downloaded, deleted, unchanged, size, failed) = azure_blob_sync.sync_blobs(self.module(), self.azure)
+        self.assertEqual((downloaded, unchanged), (['d/c'], 2))
+        self.assertEqual(sorted(self.manifest()['blobs']), ['a', 'd/b', 'd/c'])
+
+    def test_delete_keeps_the_manifest_and_its_lock(self):
+        with open(os.path.join(self.directory, 'stray'), 'w') as f:
+            f.write('x')
+        (downloaded, deleted, unchanged, size, failed) = azure_blob_sync.sync_blobs(self.module(), self.azure)
+        self.assertEqual(deleted, [os.path.join(self.directory, 'stray')])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, azure_blob_sync.MANIFEST_NAME + '.lock')))
+
+    def test_downloads_finished_before_a_listing_failure_are_recorded(self):
+        self.azure.fail_after = 2
+        self.assertRaises(ModuleFailed, azure_blob_sync.sync_blobs, self.module(), self.azure)
+        self.assertEqual(sorted(self.manifest()['blobs']), ['a', 'd/b'])
+
+        # the next run knows them without hashing
+        self.azure.fail_after = None
+        module = self.module()
+        module.md5 = None
+        (downloaded, deleted, unchanged, size, failed) = azure_blob_sync.sync_blobs(module, self.azure)
+        self.assertEqual((downloaded, unchanged), (['d/c'], 2))
+
+    def test_blob_deleted_after_listing_is_reported(self):
+        get_blob = self.azure.get_blob
+
+        def get_blob_deleted(*args, **kwargs):
+            if kwargs['blob_name'] == 'd/c':
+                raise self.azure.MissingResourceError('Not found (The specified blob does not exist.)')
+            return get_blob(*args, **kwargs)
+        self.azure.get_blob = get_blob_deleted
+        (downloaded, deleted, unchanged, size, failed) = azure_blob_sync.sync_blobs(self.module(), self.azure)
+        self.assertEqual(sorted(downloaded), ['a', 'd/b'])
+        self.assertEqual([name for name, msg in failed], ['d/c'])
+
+    def test_downloads_start_while_listing(self):
+        started = threading.Event()
+        list_blobs = self.azure.list_blobs
+
+        def slow_list_blobs(container_name, prefix=None, marker=None, maxresults=None, include=None, delimiter=None):
+            if marker:
+                started.wait(5)
+                self.assertTrue(started.is_set())
+            return list_blobs(container_name, prefix=prefix, marker=marker, include=include)
+        get_blob = self.azure.get_blob
+
+        def signalling_get_blob(*args, **kwargs):
+            started.set()
+            return get_blob(*args, **kwargs)
+        self.azure.list_blobs = slow_list_blobs
+        self.azure.get_blob = signalling_get_blob
+        azure_blob_sync.sync_blobs(self.module(), self.azure)
+        self.assertTrue(started.is_set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import azure_test_utils    # puts the repo's module_utils on ansible.module_utils
+
+import ansible.module_utils.azure_broker as azure_broker
+
+
+class FakeClient(object):
+    def __init__(self, counts):
+        self.counts = counts
+        self.thread = threading.current_thread().name
+
+    def list_hosted_services(self):
+        self.counts['list_hosted_services'] = self.counts.get('list_hosted_services', 0) + 1
+        return ['web']
+
+    def get_operation_status(self, request_id):
+        return 'Succeeded'
+
+    def delete_hosted_service(self, service_name):
+        return None
+
+    def client_thread(self):
+        return self.thread
+
+
+class BrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'broker.sock')
+        self.counts = {}
+        self.saved = (azure_broker._create_client, azure_broker._create_session)
+        azure_broker._create_client = lambda kind, credentials, session: FakeClient(self.counts)
+        azure_broker._create_session = lambda kind, credentials: None
+        self.server = azure_broker._BrokerServer(self.socket_path, azure_broker._BrokerHandler)
+        self.server.clients = azure_broker._BrokerClients(60)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs=dict(poll_interval=0.01))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        (azure_broker._create_client, azure_broker._create_session) = self.saved
+        shutil.rmtree(self.directory)
+
+    def proxy(self):
+        return azure_broker.BrokerProxy(azure_broker.connect_broker(self.socket_path), 'service_management',
+                                        ('sub', 'cert.pem'), self.socket_path)
+
+    def test_status_polls_keep_the_cache(self):
+        proxy = self.proxy()
+        proxy.list_hosted_services()
+        proxy.get_operation_status('r1')
+        proxy.list_hosted_services()
+        self.assertEqual(self.counts['list_hosted_services'], 1)
+
+    def test_changes_clear_the_cache(self):
+        proxy = self.proxy()
+        proxy.list_hosted_services()
+        proxy.delete_hosted_service('web')
+        proxy.list_hosted_services()
+        self.assertEqual(self.counts['list_hosted_services'], 2)
+
+    def test_each_thread_gets_its_own_connection_and_client(self):
+        proxy = self.proxy()
+        threads = {}
+
+        def call(i):
+            threads[i] = proxy.client_thread()
+        workers = [threading.Thread(target=call, args=(i,)) for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        threads['main'] = proxy.client_thread()
+        self.assertEqual(len(set(threads.values())), 4)
+
+    def test_errors_come_back(self):
+        proxy = self.proxy()
+        self.assertRaises(AttributeError, proxy.no_such_call)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,452 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+from azure_test_utils import FakeModule, Obj, WindowsAzureConflictError, WindowsAzureError
+
+import ansible.module_utils.azure_common as azure_common
+from azure.http import HTTPError, HTTPResponse
+from azure.http.httpclient import _HTTPClient
+
+
+class FakeServiceManagement(object):
+    """
+    Answers get_operation_status from a dict of request id: [statuses],
+    one status per poll (the last one repeats)
+    """
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.polls = []
+
+    def get_operation_status(self, request_id):
+        self.polls.append(request_id)
+        if request_id not in self.statuses:
+            raise WindowsAzureError('Not found (Not Found)')
+        statuses = self.statuses[request_id]
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return Obj(status=status, error=Obj(code='Conflict', message='it failed'))
+
+
+class OperationJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved_path = azure_common.OPERATION_JOURNAL_PATH
+        azure_common.OPERATION_JOURNAL_PATH = os.path.join(self.directory, 'journal.json')
+        self.saved_schedules = dict(azure_common.OPERATION_POLL_SCHEDULES)
+        azure_common.OPERATION_POLL_SCHEDULES['create_hosted_service'] = (0.001, 0.001, 1)
+
+    def tearDown(self):
+        azure_common.OPERATION_JOURNAL_PATH = self.saved_path
+        azure_common.OPERATION_POLL_SCHEDULES.clear()
+        azure_common.OPERATION_POLL_SCHEDULES.update(self.saved_schedules)
+        shutil.rmtree(self.directory)
+
+    def test_journal_and_clear(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        self.assertEqual(azure_common.journaled_request_id(key), 'r1')
+        azure_common.clear_journaled_operation(key)
+        self.assertEqual(azure_common.journaled_request_id(key), None)
+
+    def test_old_entries_are_ignored(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        entries = azure_common.read_json_file(azure_common.OPERATION_JOURNAL_PATH)
+        entries[key]['started'] -= azure_common.OPERATION_JOURNAL_MAX_AGE + 1
+        azure_common.write_json_file(azure_common.OPERATION_JOURNAL_PATH, entries)
+        self.assertEqual(azure_common.journaled_request_id(key), None)
+
+    def test_starting_an_operation_forgets_its_opposite(self):
+        create = 'sub/create_hosted_service/web'
+        delete = 'sub/delete_hosted_service/web'
+        other = 'sub/create_hosted_service/db'
+        azure_common.journal_operation(create, Obj(request_id='r1'))
+        azure_common.journal_operation(other, Obj(request_id='r2'))
+        azure_common.journal_operation(delete, Obj(request_id='r3'))
+        self.assertEqual(azure_common.journaled_request_id(create), None)
+        self.assertEqual(azure_common.journaled_request_id(other), 'r2')
+        azure_common.journal_operation(create, Obj(request_id='r4'))
+        self.assertEqual(azure_common.journaled_request_id(delete), None)
+
+    def test_opposite_of_a_name_with_slashes(self):
+        add = 'sub/add_data_disk/svc/dep/role/0'
+        azure_common.journal_operation(add, Obj(request_id='r1'))
+        azure_common.journal_operation('sub/delete_data_disk/svc/dep/role/0', Obj(request_id='r2'))
+        self.assertEqual(azure_common.journaled_request_id(add), None)
+
+    def test_resume_nothing_journaled(self):
+        azure = FakeServiceManagement({})
+        self.assertEqual(azure_common.resume_journaled_operation(azure, 'sub/create_hosted_service/web', True, 10, 'create_hosted_service'), None)
+        self.assertEqual(azure.polls, [])
+
+    def test_resume_in_progress_without_waiting(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        azure = FakeServiceManagement({'r1': ['InProgress']})
+        promise = azure_common.resume_journaled_operation(azure, key, False, 10, 'create_hosted_service')
+        self.assertEqual(promise.request_id, 'r1')
+        self.assertEqual(azure_common.journaled_request_id(key), 'r1')
+
+    def test_resume_in_progress_waits_for_it(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        azure = FakeServiceManagement({'r1': ['InProgress', 'InProgress', 'Succeeded']})
+        promise = azure_common.resume_journaled_operation(azure, key, True, 10, 'create_hosted_service')
+        self.assertEqual(promise.request_id, 'r1')
+        self.assertEqual(len(azure.polls), 3)
+        self.assertEqual(azure_common.journaled_request_id(key), None)
+
+    def test_resume_succeeded_falls_through(self):
+        # the resource may have been deleted since; the caller must check it
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        azure = FakeServiceManagement({'r1': ['Succeeded']})
+        self.assertEqual(azure_common.resume_journaled_operation(azure, key, True, 10, 'create_hosted_service'), None)
+        self.assertEqual(azure_common.journaled_request_id(key), None)
+
+    def test_resume_failed_starts_over(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        azure = FakeServiceManagement({'r1': ['Failed']})
+        self.assertEqual(azure_common.resume_journaled_operation(azure, key, True, 10, 'create_hosted_service'), None)
+        self.assertEqual(azure_common.journaled_request_id(key), None)
+
+    def test_resume_forgotten_operation(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        azure = FakeServiceManagement({})
+        self.assertEqual(azure_common.resume_journaled_operation(azure, key, True, 10, 'create_hosted_service'), None)
+        self.assertEqual(azure_common.journaled_request_id(key), None)
+
+    def test_resume_timing_out_again_keeps_the_entry(self):
+        key = 'sub/create_hosted_service/web'
+        azure_common.journal_operation(key, Obj(request_id='r1'))
+        azure = FakeServiceManagement({'r1': ['InProgress']})
+        self.assertRaises(WindowsAzureError, azure_common.resume_journaled_operation, azure, key, True, 0.01, 'create_hosted_service')
+        self.assertEqual(azure_common.journaled_request_id(key), 'r1')
+
+
+class ScriptedHTTP(object):
+    """
+    Replaces the SDK's HTTP client, answering each request with the next
+    of responses: an HTTPResponse, or an exception to raise
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __enter__(self):
+        self.saved = _HTTPClient.perform_request
+        scripted = self
+
+        def perform_request(client, request):
+            scripted.requests.append((request.method, request.path))
+            response = scripted.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        _HTTPClient.perform_request = perform_request
+        return self
+
+    def __exit__(self, *exc_info):
+        _HTTPClient.perform_request = self.saved
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = azure_common.RETRY_FIRST_DELAY
+        azure_common.RETRY_FIRST_DELAY = 0.001
+        self.azure = azure_common.connect_blob_service('account', 'a2V5', use_broker=False)
+
+    def tearDown(self):
+        azure_common.RETRY_FIRST_DELAY = self.saved
+
+    def ok(self):
+        return HTTPResponse(200, 'OK', [('etag', '"1"'), ('content-length', '3')], '')
+
+    def test_error_gets_status_headers_and_body(self):
+        error = HTTPError(409, 'Conflict', [('X-Ms-Request-Id', 'abc')], '<Error><Code>LeaseAlreadyPresent</Code></Error>')
+        with ScriptedHTTP([error]):
+            try:
+                self.azure.get_blob_properties(container_name='c', blob_name='b')
+                self.fail('no error raised')
+            except WindowsAzureConflictError as e:
+                self.assertEqual(e.status_code, 409)
+                self.assertEqual(e.headers['x-ms-request-id'], 'abc')
+                self.assertIn('LeaseAlreadyPresent', e.body)
+
+    def test_throttling_is_retried_after_retry_after(self):
+        error = HTTPError(503, 'Service Unavailable', [('Retry-After', '0')], '')
+        with ScriptedHTTP([error, error, self.ok()]) as http:
+            self.assertEqual(self.azure.get_blob_properties(container_name='c', blob_name='b')['etag'], '"1"')
+            self.assertEqual(len(http.requests), 3)
+
+    def test_in_progress_conflict_is_recognised_by_body(self):
+        body = '<Error><Code>ConflictError</Code><Message>Windows Azure is currently performing an operation on this deployment.</Message></Error>'
+        with ScriptedHTTP([HTTPError(409, 'Conflict', [], body), self.ok()]) as http:
+            self.azure.get_blob_properties(container_name='c', blob_name='b')
+            self.assertEqual(len(http.requests), 2)
+
+    def test_other_conflicts_are_not_retried(self):
+        with ScriptedHTTP([HTTPError(409, 'Conflict', [], '<Error><Code>BlobAlreadyExists</Code></Error>'), self.ok()]) as http:
+            self.assertRaises(WindowsAzureConflictError, self.azure.get_blob_properties, container_name='c', blob_name='b')
+            self.assertEqual(len(http.requests), 1)
+
+    def test_server_errors_are_retried_for_idempotent_calls_only(self):
+        with ScriptedHTTP([HTTPError(500, 'Internal Server Error', [], ''), self.ok()]) as http:
+            self.azure.get_blob_properties(container_name='c', blob_name='b')
+            self.assertEqual(len(http.requests), 2)
+        with ScriptedHTTP([HTTPError(500, 'Internal Server Error', [], ''), self.ok()]) as http:
+            self.assertRaises(WindowsAzureError, self.azure.put_blob, container_name='c', blob_name='b', blob='', x_ms_blob_type='BlockBlob')
+            self.assertEqual(len(http.requests), 1)
+
+    def test_network_errors_are_retried_for_idempotent_calls_only(self):
+        with ScriptedHTTP([socket.error('connection reset'), self.ok()]) as http:
+            self.azure.get_blob_properties(container_name='c', blob_name='b')
+            self.assertEqual(len(http.requests), 2)
+        with ScriptedHTTP([socket.error('connection reset'), self.ok()]) as http:
+            self.assertRaises(socket.error, self.azure.lease_blob, container_name='c', blob_name='b', x_ms_lease_action='acquire')
+            self.assertEqual(len(http.requests), 1)
+
+    def test_throttling_is_retried_for_any_call(self):
+        with ScriptedHTTP([HTTPError(503, 'Service Unavailable', [('Retry-After', '0')], ''), self.ok()]) as http:
+            self.azure.put_blob(container_name='c', blob_name='b', blob='', x_ms_blob_type='BlockBlob')
+            self.assertEqual(len(http.requests), 2)
+
+    def test_idempotent_calls(self):
+        self.assertTrue(azure_common.idempotent_call('get_operation_status', {}))
+        self.assertTrue(azure_common.idempotent_call('put_block_list', {}))
+        self.assertFalse(azure_common.idempotent_call('create_virtual_machine_deployment', {}))
+        self.assertFalse(azure_common.idempotent_call('put_blob', {}))
+        self.assertFalse(azure_common.idempotent_call('lease_blob', dict(x_ms_lease_action='acquire')))
+        self.assertTrue(azure_common.idempotent_call('lease_blob', dict(x_ms_lease_action='acquire', x_ms_proposed_lease_id='id')))
+        self.assertTrue(azure_common.idempotent_call('lease_blob', dict(x_ms_lease_action='renew', x_ms_lease_id='id')))
+
+    def test_the_budget_limits_retries(self):
+        error = HTTPError(503, 'Service Unavailable', [('Retry-After', '60')], '')
+        azure = azure_common.connect_blob_service('account', 'a2V5', time_budget=30, use_broker=False)
+        with ScriptedHTTP([error, self.ok()]) as http:
+            self.assertRaises(WindowsAzureError, azure.get_blob_properties, container_name='c', blob_name='b')
+            self.assertEqual(len(http.requests), 1)
+
+
+class FakeInventory(object):
+    """
+    Answers the snapshot's list calls; list_affinity_groups fails
+    """
+    def __init__(self):
+        self.calls = []
+        self.services = [Obj(service_name='web', label='web')]
+
+    def list_hosted_services(self):
+        self.calls.append('list_hosted_services')
+        return self.services
+
+    def list_storage_accounts(self):
+        self.calls.append('list_storage_accounts')
+        return []
+
+    def list_affinity_groups(self):
+        self.calls.append('list_affinity_groups')
+        raise WindowsAzureError('Forbidden (Forbidden)')
+
+
+class SnapshotLookupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = (azure_common.SNAPSHOT_DIR, azure_common.SNAPSHOT_TTL)
+        azure_common.SNAPSHOT_DIR = self.directory
+        azure_common.SNAPSHOT_TTL = 120
+        self.module = FakeModule(subscription_id='sub')
+        self.azure = FakeInventory()
+
+    def tearDown(self):
+        azure_common.SNAPSHOT_DIR, azure_common.SNAPSHOT_TTL = self.saved
+        shutil.rmtree(self.directory)
+
+    def lookup(self, kind, name):
+        return azure_common.snapshot_lookup(self.module, self.azure, kind, name)
+
+    def test_lookups_share_one_snapshot(self):
+        self.assertEqual(self.lookup('hosted_services', 'web'), (True, {'service_name': 'web', 'label': 'web'}))
+        self.assertEqual(self.lookup('hosted_services', 'db'), (True, None))
+        self.assertEqual(self.lookup('storage_accounts', 'web'), (True, None))
+        self.assertEqual(self.azure.calls.count('list_hosted_services'), 1)
+
+    def test_kinds_that_could_not_be_listed_are_unknown(self):
+        self.assertEqual(self.lookup('affinity_groups', 'group'), (False, None))
+        # reserved_ip_addresses has no list call on this service at all
+        self.assertEqual(self.lookup('reserved_ip_addresses', 'ip'), (False, None))
+
+    def test_invalidated_resources_are_unknown(self):
+        self.lookup('hosted_services', 'web')
+        azure_common.invalidate_snapshot(self.module, 'hosted_services', 'web')
+        self.assertEqual(self.lookup('hosted_services', 'web'), (False, None))
+        self.assertEqual(self.lookup('hosted_services', 'db'), (True, None))
+
+    def test_old_snapshot_is_taken_again(self):
+        self.lookup('hosted_services', 'web')
+        self.azure.services = []
+        path = os.path.join(self.directory, 'sub.json')
+        azure_common.update_json_file(path, lambda contents: contents.update(taken=contents['taken'] - 121))
+        self.assertEqual(self.lookup('hosted_services', 'web'), (True, None))
+        self.assertEqual(self.azure.calls.count('list_hosted_services'), 2)
+
+    def test_turned_off(self):
+        azure_common.SNAPSHOT_TTL = 0
+        self.assertEqual(self.lookup('hosted_services', 'web'), (False, None))
+        self.assertEqual(self.azure.calls, [])
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+
+    def test_results_in_order(self):
+        self.assertEqual(azure_common.run_concurrently(lambda i: i * 2, range(10), 3), range(0, 20, 2))
+
+    def test_first_error_is_raised(self):
+        def func(i):
+            if i == 3:
+                raise ValueError(i)
+            return i
+        self.assertRaises(ValueError, azure_common.run_concurrently, func, range(10), 3)
+
+    def test_generator_items_start_before_it_finishes(self):
+        started = threading.Event()
+
+        def items():
+            yield 1
+            started.wait(5)
+            yield 2 if started.is_set() else 'too late'
+        self.assertEqual(azure_common.run_concurrently(lambda i: started.set() or i, items(), 2), [1, 2])
+
+    def test_generator_error_is_raised(self):
+        def items():
+            yield 1
+            raise ValueError('listing failed')
+        self.assertRaises(ValueError, azure_common.run_concurrently, lambda i: i, items(), 2)
+
+
+class ConnectBlobServiceTest(unittest.TestCase):
+
+    def test_each_thread_gets_its_own_client_on_one_session(self):
+        azure = azure_common.connect_blob_service('account', 'a2V5', use_broker=False, pool_size=4)
+        clients = {}
+
+        def call(i):
+            clients[i] = azure.other.with_filter
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        services = [c.__self__ for c in clients.values()]
+        self.assertEqual(len(set(id(s) for s in services)), 4)
+        self.assertEqual(len(set(id(s._httpclient.request_session) for s in services)), 1)
+        if azure_common.pooled_session(1) is not None:
+            adapter = services[0]._httpclient.request_session.get_adapter('https://account.blob.core.windows.net')
+            self.assertEqual(adapter._pool_maxsize, 4)
+
+    def test_filter(self):
+        seen = []
+
+        def remember(request, next):
+            seen.append(request.method)
+            return next(request)
+        azure = azure_common.connect_blob_service('account', 'a2V5', use_broker=False, filter=remember)
+        with ScriptedHTTP([HTTPResponse(200, 'OK', [('etag', '"1"')], '')]):
+            azure.get_blob_properties(container_name='c', blob_name='b')
+        self.assertEqual(seen, ['HEAD'])
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module: sleep() advances time() instantly
+    """
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class WaitForOperationsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.saved = (azure_common.time, azure_common.POLL_JITTER)
+        azure_common.time = self.clock
+        azure_common.POLL_JITTER = 0
+
+    def tearDown(self):
+        azure_common.time, azure_common.POLL_JITTER = self.saved
+
+    def test_results_in_order_with_errors(self):
+        azure = FakeServiceManagement({'r1': ['InProgress', 'Succeeded'], 'r2': ['Failed']})
+        results = azure_common.wait_for_operations(azure, [('r1', None), ('r2', None)], 600)
+        self.assertEqual([r['request_id'] for r in results], ['r1', 'r2'])
+        self.assertEqual([r['status'] for r in results], ['Succeeded', 'Failed'])
+        self.assertEqual(results[0]['polls'], 2)
+        self.assertEqual(results[0]['error_code'], None)
+        self.assertEqual((results[1]['error_code'], results[1]['error_message']), ('Conflict', 'it failed'))
+
+    def test_timed_out_operations_are_reported(self):
+        azure = FakeServiceManagement({'r1': ['InProgress'], 'r2': ['Succeeded']})
+        results = azure_common.wait_for_operations(azure, [('r1', None), ('r2', None)], 60)
+        self.assertEqual([r['status'] for r in results], ['TimedOut', 'Succeeded'])
+        self.assertTrue(self.clock.now <= 1060)
+
+    def test_each_operation_on_its_own_schedule(self):
+        (first, maximum, factor) = azure_common.OPERATION_POLL_SCHEDULES['add_service_certificate']
+        azure = FakeServiceManagement({'r1': ['InProgress', 'Succeeded']})
+        azure_common.wait_for_operations(azure, [('r1', 'add_service_certificate')], 600)
+        self.assertEqual(self.clock.sleeps, [first])
+
+    def test_max_polls_per_second(self):
+        azure = FakeServiceManagement({'r%d' % i: ['Succeeded'] for i in range(5)})
+        azure_common.wait_for_operations(azure, [('r%d' % i, None) for i in range(5)], 600, max_polls_per_second=2)
+        self.assertEqual(len(azure.polls), 5)
+        # every operation is due at once, but the polls are spaced half a second apart
+        self.assertEqual(self.clock.sleeps, [0.5] * 4)
+
+
+class PollIntervalsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = azure_common.POLL_JITTER
+        azure_common.POLL_JITTER = 0
+
+    def tearDown(self):
+        azure_common.POLL_JITTER = self.saved
+
+    def intervals(self, operation, schedule=None, count=5):
+        intervals = azure_common.poll_intervals(operation, schedule)
+        return [round(next(intervals), 3) for i in range(count)]
+
+    def test_backoff_up_to_the_maximum(self):
+        self.assertEqual(self.intervals('x', (1, 4, 2)), [1, 2, 4, 4, 4])
+
+    def test_schedule_by_operation(self):
+        (first, maximum, factor) = azure_common.OPERATION_POLL_SCHEDULES['add_service_certificate']
+        self.assertEqual(self.intervals('add_service_certificate', count=1), [first])
+        (first, maximum, factor) = azure_common.OPERATION_POLL_SCHEDULES['default']
+        self.assertEqual(self.intervals('no_such_operation', count=1), [first])
+
+    def test_jitter(self):
+        azure_common.POLL_JITTER = 0.2
+        for interval in self.intervals('x', (10, 10, 1), count=20):
+            self.assertTrue(8 <= interval <= 12, interval)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+from azure_test_utils import FakeBlobService
+
+import ansible.module_utils.azure_common as azure_common
+import ansible.module_utils.azure_lease as azure_lease
+
+
+def child(*argv):
+    """
+    Starts a process, reaping it when it exits so its pid goes away
+    """
+    process = subprocess.Popen(argv)
+    reaper = threading.Thread(target=process.wait)
+    reaper.daemon = True
+    reaper.start()
+    return process, reaper
+
+
+class LeaseKeeperTokenTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.token_path = os.path.join(self.directory, 'token.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_token(self, pid):
+        azure_common.write_json_file(self.token_path, dict(container='c', leases={'b': 'l1'}, duration=60, pid=pid))
+
+    def test_missing_token_or_pid(self):
+        self.assertEqual(azure_lease.lease_keeper_running(self.token_path), None)
+        self.write_token(None)
+        self.assertEqual(azure_lease.lease_keeper_running(self.token_path), None)
+
+    def test_dead_keeper(self):
+        process, reaper = child('true')
+        reaper.join()
+        self.write_token(process.pid)
+        self.assertEqual(azure_lease.lease_keeper_running(self.token_path), None)
+        self.assertEqual(azure_lease.heartbeat_lease_keeper(self.token_path), None)
+        self.assertEqual(azure_lease.stop_lease_keeper(self.token_path), (None, True))
+        self.assertFalse(os.path.exists(self.token_path))
+
+    def test_heartbeat_touches_the_token(self):
+        self.write_token(os.getpid())
+        os.utime(self.token_path, (0, 0))
+        token = azure_lease.heartbeat_lease_keeper(self.token_path)
+        self.assertEqual(token['leases'], {'b': 'l1'})
+        self.assertTrue(time.time() - os.path.getmtime(self.token_path) < 60)
+
+    def test_stop_waits_for_the_keeper(self):
+        process, reaper = child('sleep', '0.3')
+        self.write_token(process.pid)
+        (token, stopped) = azure_lease.stop_lease_keeper(self.token_path, timeout=10)
+        self.assertEqual((token['pid'], stopped), (process.pid, True))
+        self.assertFalse(os.path.exists(self.token_path))
+
+    def test_stop_gives_up_on_a_stuck_keeper(self):
+        process, reaper = child('sleep', '30')
+        try:
+            self.write_token(process.pid)
+            self.assertEqual(azure_lease.stop_lease_keeper(self.token_path, timeout=0.3)[1], False)
+        finally:
+            process.kill()
+
+
+class KeepLeasesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.token_path = os.path.join(self.directory, 'token.json')
+        self.azure = FakeBlobService({'a': '', 'b': ''})
+        for name in ('a', 'b'):
+            self.azure.lease_blob(container_name='c', blob_name=name, x_ms_lease_action='acquire', x_ms_proposed_lease_id='l-' + name)
+        self.saved = azure_lease.connect_blob_service
+        azure_lease.connect_blob_service = lambda *args, **kwargs: self.azure
+
+    def tearDown(self):
+        azure_lease.connect_blob_service = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_removed_token_releases_the_leases(self):
+        azure_lease.keep_leases('account', 'key', 'c', {'a': 'l-a', 'b': 'l-b'}, 60, self.token_path)
+        self.assertEqual([self.azure.blobs[n]['lease_state'] for n in ('a', 'b')], ['available', 'available'])
+
+    def test_expired_heartbeat_releases_the_leases_and_the_token(self):
+        azure_common.write_json_file(self.token_path, {})
+        os.utime(self.token_path, (0, 0))
+        azure_lease.keep_leases('account', 'key', 'c', {'a': 'l-a'}, 60, self.token_path, heartbeat_timeout=10)
+        self.assertEqual(self.azure.blobs['a']['lease_state'], 'available')
+        self.assertEqual(self.azure.blobs['b']['lease_state'], 'leased')
+        self.assertFalse(os.path.exists(self.token_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from azure_test_utils import FakeModule, Obj, load_module
+
+import ansible.module_utils.azure_common as azure_common
+
+azure_service = load_module('azure_service')
+
+
+class FakeServiceManagement(object):
+    def __init__(self, services, statuses):
+        self.services = set(services)
+        self.statuses = statuses
+        self.created = []
+
+    def get_operation_status(self, request_id):
+        return Obj(status=self.statuses[request_id], error=None)
+
+    def check_hosted_service_name_availability(self, name):
+        return Obj(result=name not in self.services)
+
+    def create_hosted_service(self, service_name, label, location, affinity_group):
+        self.services.add(service_name)
+        self.created.append(service_name)
+        self.statuses['new'] = 'InProgress'
+        return Obj(request_id='new')
+
+
+class CreateServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.saved = (azure_common.OPERATION_JOURNAL_PATH, azure_common.SNAPSHOT_TTL)
+        azure_common.OPERATION_JOURNAL_PATH = os.path.join(self.directory, 'journal.json')
+        azure_common.SNAPSHOT_TTL = 0
+        self.module = FakeModule(name='web', location='West Europe', affinity_group=None, wait=False, wait_timeout=10,
+                                 subscription_id='sub')
+
+    def tearDown(self):
+        (azure_common.OPERATION_JOURNAL_PATH, azure_common.SNAPSHOT_TTL) = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_succeeded_create_of_a_deleted_service_creates_it(self):
+        azure_common.journal_operation('sub/create_hosted_service/web', Obj(request_id='old'))
+        azure = FakeServiceManagement([], {'old': 'Succeeded'})
+        (changed, service, request_id) = azure_service.create_service(self.module, azure)
+        self.assertTrue(changed)
+        self.assertEqual(azure.created, ['web'])
+        self.assertEqual(request_id, 'new')
+
+    def test_succeeded_create_of_an_existing_service_changes_nothing(self):
+        azure_common.journal_operation('sub/create_hosted_service/web', Obj(request_id='old'))
+        azure = FakeServiceManagement(['web'], {'old': 'Succeeded'})
+        (changed, service, request_id) = azure_service.create_service(self.module, azure)
+        self.assertFalse(changed)
+        self.assertEqual(azure.created, [])
+
+    def test_create_in_progress_is_attached_to(self):
+        azure_common.journal_operation('sub/create_hosted_service/web', Obj(request_id='old'))
+        azure = FakeServiceManagement([], {'old': 'InProgress'})
+        (changed, service, request_id) = azure_service.create_service(self.module, azure)
+        self.assertTrue(changed)
+        self.assertEqual(azure.created, [])
+        self.assertEqual(request_id, 'old')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import unittest
+
+from azure_test_utils import BlobList, FakeModule, Obj, load_module, sdk_call
+
+azure_storage_container = load_module('azure_storage_container')
+
+
+class Acl(list):
+    """
+    Get Container ACL's signed identifiers, with the public access level
+    newer SDKs parse
+    """
+    public_access = None
+
+
+class FakeContainerService(object):
+    """
+    An in-memory set of containers with the BlobService call signatures
+
+    containers: {name: metadata}
+    """
+    def __init__(self, containers=None):
+        self.containers = {}
+        self.calls = []
+        for name, metadata in (containers or {}).items():
+            self.containers[name] = dict(metadata=dict(metadata), public_access=None, policies={})
+
+    def writes(self):
+        return [c for c in self.calls if c[0] not in ('list_containers', 'get_container_acl')]
+
+    @sdk_call
+    def list_containers(self, prefix=None, marker=None, maxresults=None, include=None):
+        self.calls.append(('list_containers', prefix))
+        page = BlobList()
+        for name in sorted(self.containers):
+            if not prefix or name.startswith(prefix):
+                page.append(Obj(name=name, properties=Obj(etag='0x8D1', last_modified='Mon, 01 Jun 2026 00:00:00 GMT'),
+                                metadata=dict(self.containers[name]['metadata'])))
+        return page
+
+    @sdk_call
+    def create_container(self, container_name, x_ms_meta_name_values=None, x_ms_blob_public_access=None, fail_on_exist=False):
+        self.calls.append(('create_container', container_name))
+        if container_name in self.containers:
+            return False
+        self.containers[container_name] = dict(metadata=dict(x_ms_meta_name_values or {}), public_access=x_ms_blob_public_access,
+                                               policies={})
+        return True
+
+    @sdk_call
+    def delete_container(self, container_name, fail_not_exist=False, x_ms_lease_id=None):
+        self.calls.append(('delete_container', container_name))
+        return self.containers.pop(container_name, None) is not None
+
+    @sdk_call
+    def set_container_metadata(self, container_name, x_ms_meta_name_values=None, x_ms_lease_id=None):
+        self.calls.append(('set_container_metadata', container_name))
+        self.containers[container_name]['metadata'] = dict(x_ms_meta_name_values or {})
+
+    @sdk_call
+    def get_container_acl(self, container_name, x_ms_lease_id=None):
+        self.calls.append(('get_container_acl', container_name))
+        container = self.containers[container_name]
+        acl = Acl(Obj(id=policy_id, access_policy=Obj(**policy)) for policy_id, policy in container['policies'].items())
+        acl.public_access = container['public_access']
+        return acl
+
+    @sdk_call
+    def set_container_acl(self, container_name, signed_identifiers=None, x_ms_blob_public_access=None, x_ms_lease_id=None):
+        self.calls.append(('set_container_acl', container_name))
+        self.containers[container_name].update(
+            public_access=x_ms_blob_public_access,
+            policies=dict((i.id, dict(start=i.access_policy.start, expiry=i.access_policy.expiry, permission=i.access_policy.permission))
+                          for i in signed_identifiers.signed_identifiers))
+
+
+class ReconcileTest(unittest.TestCase):
+
+    def module(self, **params):
+        defaults = dict(name=None, containers=None, state='present', public_access=None, access_policies=None,
+                        metadata=None, prefix=None, exclusive=False, workers=4)
+        defaults.update(params)
+        return FakeModule(**defaults)
+
+    def test_creates_and_deletes_from_one_listing(self):
+        azure = FakeContainerService({'t-a': {}, 't-old': {}, 'other': {}})
+        module = self.module(containers=['t-a', 't-b', dict(name='t-c', metadata={'owner': 'ops'})], prefix='t-', exclusive=True)
+        results = azure_storage_container.reconcile_storage_containers(module, azure)
+        self.assertEqual(sorted(azure.containers), ['other', 't-a', 't-b', 't-c'])
+        self.assertEqual(sorted(azure.calls), [('create_container', 't-b'), ('create_container', 't-c'),
+                                               ('delete_container', 't-old'), ('list_containers', 't-')])
+        self.assertEqual([n for n in sorted(results) if results[n]['changed']], ['t-b', 't-c', 't-old'])
+        # the result comes from the listing and the request, not a read back
+        self.assertEqual(results['t-c']['storage_container'], {'x-ms-meta-owner': 'ops'})
+        self.assertEqual(results['t-a']['storage_container']['etag'], '"0x8D1"')
+
+    def test_prefix_defaults_to_the_names_in_common(self):
+        azure = FakeContainerService()
+        azure_storage_container.reconcile_storage_containers(self.module(containers=['t-a', 't-b']), azure)
+        self.assertEqual(azure.calls[0], ('list_containers', 't-'))
+
+    def managed(self):
+        policies = {'readers': dict(permission='rl', expiry='2027-01-01T00:00:00Z')}
+        return self.module(containers=[dict(name='t-a', public_access='blob', access_policies=policies),
+                                       dict(name='t-b', metadata={'Owner': 'ops'}), 't-c'])
+
+    def test_a_converged_run_makes_no_writes(self):
+        azure = FakeContainerService()
+        azure_storage_container.reconcile_storage_containers(self.managed(), azure)
+        del azure.calls[:]
+        results = azure_storage_container.reconcile_storage_containers(self.managed(), azure)
+        self.assertEqual(azure.writes(), [])
+        self.assertFalse(any(r['changed'] for r in results.values()))
+        # only the container whose ACL is managed has its ACL read
+        self.assertEqual(sorted(azure.calls), [('get_container_acl', 't-a'), ('list_containers', 't-')])
+
+    def test_only_the_fields_that_differ_are_written(self):
+        azure = FakeContainerService()
+        azure_storage_container.reconcile_storage_containers(self.managed(), azure)
+        azure.containers['t-a']['public_access'] = None
+        azure.containers['t-b']['metadata'] = {'owner': 'someone else'}
+        del azure.calls[:]
+        results = azure_storage_container.reconcile_storage_containers(self.managed(), azure)
+        self.assertEqual(sorted(azure.writes()), [('set_container_acl', 't-a'), ('set_container_metadata', 't-b')])
+        self.assertEqual((results['t-a']['updated'], results['t-b']['updated']), (['acl'], ['metadata']))
+        self.assertEqual(azure.containers['t-a']['policies'], {'readers': dict(start='', expiry='2027-01-01T00:00:00Z', permission='rl')})
+
+    def test_unmanaged_access_policies_are_kept(self):
+        azure = FakeContainerService()
+        azure_storage_container.reconcile_storage_containers(self.managed(), azure)
+        del azure.calls[:]
+        azure_storage_container.reconcile_storage_containers(self.module(name='t-a', public_access='container'), azure)
+        self.assertEqual(azure.containers['t-a']['public_access'], 'container')
+        self.assertEqual(sorted(azure.containers['t-a']['policies']), ['readers'])
+
+
+class RememberResponseTest(unittest.TestCase):
+
+    def test_public_access_from_the_remembered_headers(self):
+        response = Obj(headers=[('X-Ms-Blob-Public-Access', 'blob')])
+        self.assertTrue(azure_storage_container.remember_response('request', lambda request: response) is response)
+        # an SDK that drops the header gives a plain list of identifiers
+        azure = Obj(get_container_acl=lambda container_name: [])
+        self.assertEqual(azure_storage_container.get_container_acl(azure, 't-a'), ('blob', {}))
+
+    def test_main_passes_it_as_a_filter(self):
+        params = dict(name='t-a', containers=None, state='present', public_access=None, access_policies=None,
+                      metadata=None, prefix=None, exclusive=False, workers=4, account_name='account', account_key='key')
+        azure = FakeContainerService()
+        connections = []
+
+        def connect_blob_service(account_name, account_key, **kwargs):
+            connections.append(kwargs)
+            return azure
+        saved = (azure_storage_container.AnsibleModule, azure_storage_container.connect_blob_service)
+        azure_storage_container.AnsibleModule = lambda argument_spec: FakeModule(**params)
+        azure_storage_container.connect_blob_service = connect_blob_service
+        try:
+            self.assertRaises(SystemExit, azure_storage_container.main)
+        finally:
+            (azure_storage_container.AnsibleModule, azure_storage_container.connect_blob_service) = saved
+        self.assertTrue(connections[0]['filter'] is azure_storage_container.remember_response)
+        self.assertEqual(sorted(azure.containers), ['t-a'])
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def test_normalize_time(self):
+        normalize_time = azure_storage_container.normalize_time
+        self.assertEqual(normalize_time('2026-06-01'), '2026-06-01T00:00:00Z')
+        self.assertEqual(normalize_time('2026-06-01T10:00:00.0000000Z'), '2026-06-01T10:00:00Z')
+        self.assertEqual(normalize_time('2026-06-01T10:00:00+00:00'), '2026-06-01T10:00:00Z')
+        self.assertEqual(normalize_time(''), None)
+
+    def test_normalize_policies(self):
+        policies = {1: dict(start='2026-06-01', expiry='2026-07-01T00:00:00Z', permission='wr'), 'empty': None}
+        self.assertEqual(azure_storage_container.normalize_policies(policies), {
+            '1': dict(start='2026-06-01T00:00:00Z', expiry='2026-07-01T00:00:00Z', permission='rw'),
+            'empty': dict(start=None, expiry=None, permission=None)})
+        self.assertEqual(azure_storage_container.normalize_policies(None), {})
+
+    def test_normalize_metadata(self):
+        self.assertEqual(azure_storage_container.normalize_metadata({'Owner': 'ops', 'n': 1}), {'owner': 'ops', 'n': '1'})
+        self.assertEqual(azure_storage_container.normalize_metadata(None), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
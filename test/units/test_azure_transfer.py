@@ -0,0 +1,408 @@
+import base64
+import fcntl
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+from azure_test_utils import FakeBlobService, WindowsAzureMissingResourceError
+
+import ansible.module_utils.azure_transfer as azure_transfer
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.azure = FakeBlobService({'a/b': 'old data', 'a/bc': 'other'})
+        self.snapshot = self.azure.snapshot_blob(container_name='c', blob_name='a/b')['x-ms-snapshot']
+        self.azure.add_blob('a/b', 'new data, longer')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_properties(self):
+        properties = azure_transfer.blob_properties(self.azure, 'c', 'a/b', self.snapshot)
+        self.assertEqual(properties['content-length'], '8')
+        self.assertEqual(properties['x-ms-blob-type'], 'BlockBlob')
+        self.assertEqual(azure_transfer.blob_properties(self.azure, 'c', 'a/b')['content-length'], '16')
+
+    def test_missing_snapshot(self):
+        self.assertRaises(WindowsAzureMissingResourceError, azure_transfer.blob_properties,
+                          self.azure, 'c', 'a/b', '2026-06-01T00:00:59.0000000Z')
+
+    def test_download_snapshot(self):
+        dest = os.path.join(self.directory, 'b')
+        properties = azure_transfer.blob_properties(self.azure, 'c', 'a/b', self.snapshot)
+        azure_transfer.download_blob(self.azure, 'c', 'a/b', dest, properties, chunk_size=3, snapshot=self.snapshot)
+        with open(dest) as f:
+            self.assertEqual(f.read(), 'old data')
+
+
+class RangesTest(unittest.TestCase):
+
+    def test_byte_ranges(self):
+        self.assertEqual(azure_transfer.byte_ranges(10, 4), [(0, 3), (4, 7), (8, 9)])
+        self.assertEqual(azure_transfer.byte_ranges(8, 4), [(0, 3), (4, 7)])
+        self.assertEqual(azure_transfer.byte_ranges(0, 4), [])
+
+    def test_split_ranges(self):
+        self.assertEqual(azure_transfer.split_ranges([(2, 9), (20, 21)], 4), [(2, 5), (6, 9), (20, 21)])
+
+    def test_aligned_ranges(self):
+        self.assertEqual(azure_transfer.aligned_ranges([(2, 9), (12, 12)], 4), [(2, 3), (4, 7), (8, 9), (12, 12)])
+        self.assertEqual(azure_transfer.aligned_ranges([(0, 7)], 4), [(0, 3), (4, 7)])
+
+    def test_subtract_ranges(self):
+        self.assertEqual(azure_transfer.subtract_ranges([(0, 9)], [(3, 4), (8, 20)]), [(0, 2), (5, 7)])
+        self.assertEqual(azure_transfer.subtract_ranges([(0, 9), (20, 29)], [(0, 9)]), [(20, 29)])
+        self.assertEqual(azure_transfer.subtract_ranges([(5, 9)], []), [(5, 9)])
+        self.assertEqual(azure_transfer.subtract_ranges([(5, 9)], [(0, 100)]), [])
+
+
+class OrderedDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+        with open(self.path, 'wb') as f:
+            f.write('0123456789')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_out_of_order_ranges(self):
+        digest = azure_transfer.OrderedDigest(self.path, [(0, 3), (4, 7), (8, 9)])
+        digest.add((8, 9), '89')
+        digest.add((4, 7))          # read back from the file
+        self.assertRaises(IOError, digest.hexdigest)
+        digest.add((0, 3), '0123')
+        self.assertEqual(digest.hexdigest(), hashlib.md5('0123456789').hexdigest())
+
+    def test_data_past_the_buffer_is_read_back(self):
+        digest = azure_transfer.OrderedDigest(self.path, [(0, 4), (5, 9)], buffer_size=4)
+        digest.add((5, 9), 'xxxxx')     # too big to keep, so the file's bytes count
+        self.assertEqual(digest.buffered, 0)
+        digest.add((0, 4), '01234')
+        self.assertEqual(digest.hexdigest(), hashlib.md5('0123456789').hexdigest())
+
+
+class ExtractTarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.target = os.path.join(self.directory, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def archive(self, *members):
+        """
+        A tar stream of (name, kind, data or link name) members
+        """
+        stream = io.BytesIO()
+        archive = tarfile.open(fileobj=stream, mode='w')
+        for name, kind, value in members:
+            info = tarfile.TarInfo(name)
+            if kind == 'file':
+                info.size = len(value)
+                archive.addfile(info, io.BytesIO(value))
+                continue
+            info.type = tarfile.SYMTYPE if kind == 'symlink' else tarfile.LNKTYPE
+            info.linkname = value
+            archive.addfile(info)
+        archive.close()
+        stream.seek(0)
+        return stream
+
+    def assert_refused(self, *members):
+        self.assertRaises(IOError, azure_transfer.extract_tar_stream, self.archive(*members), self.target)
+        # nothing was left behind, in the target or next to it
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_extract(self):
+        count = azure_transfer.extract_tar_stream(self.archive(('d/f', 'file', 'data'), ('l', 'symlink', 'd/f')), self.target)
+        self.assertEqual(count, 2)
+        with open(os.path.join(self.target, 'l')) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_failed_verify_leaves_the_target_alone(self):
+        def verify():
+            raise IOError('bad MD5')
+        self.assertRaises(IOError, azure_transfer.extract_tar_stream, self.archive(('f', 'file', 'data')), self.target, verify)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_absolute_path(self):
+        self.assert_refused(('/%s/escaped.txt' % self.directory, 'file', 'x'))
+
+    def test_parent_path(self):
+        self.assert_refused(('d/../../escaped.txt', 'file', 'x'))
+
+    def test_symlink_outside(self):
+        self.assert_refused(('l', 'symlink', '../escaped.txt'))
+        self.assert_refused(('l', 'symlink', '/etc/passwd'))
+
+    def test_hard_link_outside(self):
+        self.assert_refused(('l', 'hardlink', '../escaped.txt'))
+
+    def test_path_through_a_symlink(self):
+        self.assert_refused(('d', 'symlink', '.'), ('a', 'symlink', 'd/..'), ('a/escaped.txt', 'file', 'x'))
+
+    def test_symlink_chain_made_in_the_other_order(self):
+        # a -> b/.. is inside until b -> . is extracted after it
+        self.assert_refused(('a', 'symlink', 'b/..'), ('b', 'symlink', '.'), ('a/escaped.txt', 'file', 'x'))
+        self.assert_refused(('a', 'symlink', 'b/..'), ('b', 'symlink', '.'))
+
+
+class BlobCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = azure_transfer.BlobCache(os.path.join(self.directory, 'cache'), max_size=10)
+        self.downloads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, url, data, etag='"0x1"'):
+        def download(path):
+            self.downloads.append(url)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return hashlib.md5(data).hexdigest()
+        dest = os.path.join(self.directory, url)
+        result = self.cache.fetch(self.cache.key(url, {'etag': etag}), download, dest)
+        with open(dest) as f:
+            self.assertEqual(f.read(), data)
+        return result
+
+    def entry(self, url, etag='"0x1"'):
+        return os.path.join(self.cache.directory, self.cache.key(url, {'etag': etag}))
+
+    def test_miss_then_hit(self):
+        self.assertEqual(self.fetch('a', 'aaaa'), (hashlib.md5('aaaa').hexdigest(), False))
+        self.assertEqual(self.fetch('a', 'aaaa'), (hashlib.md5('aaaa').hexdigest(), True))
+        self.assertEqual(self.downloads, ['a'])
+
+    def test_changed_etag_is_downloaded_again(self):
+        self.fetch('a', 'aaaa')
+        self.assertEqual(self.fetch('a', 'AAAA', etag='"0x2"')[1], False)
+        self.assertEqual(self.downloads, ['a', 'a'])
+
+    def test_least_recently_used_are_evicted(self):
+        self.fetch('a', 'aaaa')
+        self.fetch('b', 'bbbb')
+        self.fetch('a', 'aaaa')
+        self.fetch('c', 'cccc')
+        self.assertFalse(os.path.exists(self.entry('b')))
+        self.assertTrue(os.path.exists(self.entry('a')))
+        self.assertEqual(self.fetch('b', 'bbbb')[1], False)
+
+    def test_entries_in_use_are_not_evicted(self):
+        self.fetch('a', 'aaaa')
+        self.fetch('b', 'bbbb')
+        with open(self.entry('a') + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.fetch('c', 'cccc')
+        self.assertTrue(os.path.exists(self.entry('a')))
+        self.assertFalse(os.path.exists(self.entry('b')))
+
+    def test_dest_is_placed_before_the_entry_can_be_evicted(self):
+        place_file = azure_transfer.place_file
+        evicted = []
+
+        def place_file_racing_an_eviction(source, dest):
+            evicted.append(self.cache._evict(os.path.basename(source)))
+            place_file(source, dest)
+        azure_transfer.place_file = place_file_racing_an_eviction
+        try:
+            self.fetch('a', 'aaaa')
+            self.fetch('a', 'aaaa')
+        finally:
+            azure_transfer.place_file = place_file
+        self.assertEqual(evicted, [False, False])
+
+
+class UploadBlocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data')
+        self.azure = FakeBlobService()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        committed = current_md5 = None
+        if 'b' in self.azure.blobs:
+            committed = azure_transfer.committed_block_ids(self.azure, 'c', 'b')
+            current_md5 = self.azure.blobs['b']['content_md5']
+        del self.azure.calls[:]
+        return azure_transfer.upload_blocks(self.azure, 'c', 'b', self.path, block_size=4, max_connections=2,
+                                            committed=committed, current_md5=current_md5)
+
+    def puts(self):
+        return sorted(c[2] for c in self.azure.calls if c[0] == 'put_block')
+
+    def test_block_ids(self):
+        self.assertEqual(azure_transfer.block_id(3, 'abc'), '00000003-' + hashlib.md5('abc').hexdigest())
+        self.assertEqual(len(azure_transfer.block_id(0, '')), len(azure_transfer.block_id(12345, 'x' * 100)))
+
+    def test_upload_and_reupload(self):
+        (uploaded, reused, content_md5, committed) = self.upload('aaaabbbbcc')
+        self.assertEqual((uploaded, reused, committed), (10, 0, True))
+        self.assertEqual(content_md5, base64.b64encode(hashlib.md5('aaaabbbbcc').digest()))
+        self.assertEqual(self.azure.blobs['b']['data'], 'aaaabbbbcc')
+
+        self.assertEqual(self.upload('aaaabbbbcc'), (0, 10, content_md5, False))
+        self.assertEqual(self.azure.calls, [])
+
+    def test_only_changed_blocks_are_sent(self):
+        self.upload('aaaabbbbcc')
+        (uploaded, reused, content_md5, committed) = self.upload('aaaaBBBBcc')
+        self.assertEqual((uploaded, reused, committed), (4, 6, True))
+        self.assertEqual(self.puts(), [azure_transfer.block_id(1, 'BBBB')])
+        self.assertEqual(self.azure.blobs['b']['data'], 'aaaaBBBBcc')
+
+    def test_moved_blocks_are_sent_again(self):
+        self.upload('aaaabbbb')
+        (uploaded, reused, content_md5, committed) = self.upload('bbbbaaaa')
+        self.assertEqual((uploaded, reused), (8, 0))
+        self.assertEqual(self.azure.blobs['b']['data'], 'bbbbaaaa')
+
+
+class UploadPagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'disk.vhd')
+        window = azure_transfer.SCAN_SIZE
+        self.data = 'a' * window + '\0' * window + 'c' * window
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.azure = FakeBlobService()
+        self.saved = azure_transfer.retry_range.func_defaults
+        azure_transfer.retry_range.func_defaults = (1,)
+
+    def tearDown(self):
+        azure_transfer.retry_range.func_defaults = self.saved
+        shutil.rmtree(self.directory)
+
+    def properties(self):
+        return azure_transfer.blob_properties(self.azure, 'c', 'disk.vhd')
+
+    def test_zeros_are_skipped(self):
+        window = azure_transfer.SCAN_SIZE
+        self.assertEqual(azure_transfer.upload_pages(self.azure, 'c', 'disk.vhd', self.path), (2 * window, window))
+        self.assertEqual(self.azure.blobs['disk.vhd']['data'], self.data)
+        self.assertEqual(len([c for c in self.azure.calls if c[0] == 'put_page']), 2)
+        self.assertTrue(azure_transfer.upload_complete(self.properties()))
+
+    def test_interrupted_upload_is_incomplete(self):
+        def failing_put_page(**kwargs):
+            raise IOError('connection reset')
+        self.azure.put_page = failing_put_page
+        self.assertRaises(IOError, azure_transfer.upload_pages, self.azure, 'c', 'disk.vhd', self.path)
+        self.assertFalse(azure_transfer.upload_complete(self.properties()))
+
+
+class SparseDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dest = os.path.join(self.directory, 'disk.vhd')
+        self.data = 'aaaaaaaa' + '\0' * 8 + 'cccccccc'
+        md5 = azure_transfer.hex_to_content_md5(hashlib.md5(self.data).hexdigest())
+        self.azure = FakeBlobService()
+        self.azure.add_blob('disk.vhd', self.data, 'PageBlob', pages=[(0, 7), (16, 23)], content_md5=md5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_populated_ranges_are_fetched(self):
+        properties = azure_transfer.blob_properties(self.azure, 'c', 'disk.vhd')
+        populated = azure_transfer.page_ranges(self.azure, 'c', 'disk.vhd')
+        (downloaded, reused, md5) = azure_transfer.download_blob(self.azure, 'c', 'disk.vhd', self.dest, properties,
+                                                                 chunk_size=4, populated=populated)
+        self.assertEqual((downloaded, reused), (16, 0))
+        self.assertEqual([c[2] for c in self.azure.calls if c[0] == 'get_blob'],
+                         ['bytes=0-3', 'bytes=4-7', 'bytes=16-19', 'bytes=20-23'])
+        # the whole file is hashed to check the Content-MD5
+        self.assertEqual(md5, hashlib.md5(self.data).hexdigest())
+        with open(self.dest) as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_content_md5_mismatch(self):
+        self.azure.blobs['disk.vhd']['content_md5'] = azure_transfer.hex_to_content_md5(hashlib.md5('other').hexdigest())
+        properties = azure_transfer.blob_properties(self.azure, 'c', 'disk.vhd')
+        self.assertRaises(IOError, azure_transfer.download_blob, self.azure, 'c', 'disk.vhd', self.dest, properties,
+                          chunk_size=4, populated=[(0, 7), (16, 23)])
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class ResumeDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dest = os.path.join(self.directory, 'b')
+        self.azure = FakeBlobService()
+        md5 = azure_transfer.hex_to_content_md5(hashlib.md5('0123456789').hexdigest())
+        self.azure.add_blob('b', '0123456789', content_md5=md5)
+        self.saved = azure_transfer.retry_range.func_defaults
+        azure_transfer.retry_range.func_defaults = (1,)
+
+    def tearDown(self):
+        azure_transfer.retry_range.func_defaults = self.saved
+        shutil.rmtree(self.directory)
+
+    def download(self):
+        properties = azure_transfer.blob_properties(self.azure, 'c', 'b')
+        return azure_transfer.download_blob(self.azure, 'c', 'b', self.dest, properties, chunk_size=4, max_connections=1)
+
+    def interrupted_download(self):
+        get_blob = self.azure.get_blob
+
+        def failing_get_blob(**kwargs):
+            if kwargs['x_ms_range'] == 'bytes=4-7':
+                raise IOError('connection reset')
+            return get_blob(**kwargs)
+        self.azure.get_blob = failing_get_blob
+        self.assertRaises(IOError, self.download)
+        del self.azure.get_blob
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertTrue(os.path.exists(self.dest + '.part.json'))
+
+    def ranges_fetched(self):
+        return [call[2] for call in self.azure.calls if call[0] == 'get_blob']
+
+    def test_resume_fetches_only_the_missing_ranges(self):
+        self.interrupted_download()
+        del self.azure.calls[:]
+        (downloaded, reused, md5) = self.download()
+        self.assertEqual((downloaded, reused), (6, 4))
+        self.assertEqual(self.ranges_fetched(), ['bytes=4-7', 'bytes=8-9'])
+        # the reused range is read back, so the whole file's MD5 is still checked
+        self.assertEqual(md5, hashlib.md5('0123456789').hexdigest())
+        with open(self.dest) as f:
+            self.assertEqual(f.read(), '0123456789')
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        self.assertFalse(os.path.exists(self.dest + '.part.json'))
+
+    def test_changed_blob_starts_over(self):
+        self.interrupted_download()
+        self.azure.add_blob('b', 'abcdefghij')
+        del self.azure.calls[:]
+        self.assertEqual(self.download()[:2], (10, 0))
+        self.assertEqual(self.ranges_fetched(), ['bytes=0-3', 'bytes=4-7', 'bytes=8-9'])
+        with open(self.dest) as f:
+            self.assertEqual(f.read(), 'abcdefghij')
+
+
+if __name__ == '__main__':
+    unittest.main()